@@ -0,0 +1,75 @@
+"""
+Module: bench_keyword_matcher.py
+
+Microbenchmark for common.keyword_matcher.KeywordMatcher against the
+per-keyword `kw.lower() in text.lower()` loops it replaces, as the keyword
+list grows. Run from the repo root:
+
+    PYTHONPATH=. python benchmarks/bench_keyword_matcher.py
+"""
+
+import argparse
+import random
+import string
+import time
+
+from common.keyword_matcher import KeywordMatcher
+
+
+def random_word(rng, min_len=4, max_len=12):
+    return "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(min_len, max_len)))
+
+
+def make_texts(rng, count, words_per_text):
+    vocab = [random_word(rng) for _ in range(5000)]
+    return [" ".join(rng.choice(vocab) for _ in range(words_per_text)) for _ in range(count)]
+
+
+def naive_any(keywords, text):
+    return any(kw.lower() in text.lower() for kw in keywords)
+
+
+def naive_all(keywords, text):
+    return all(kw.lower() in text.lower() for kw in keywords)
+
+
+def timed(fn, texts):
+    start = time.perf_counter()
+    results = [fn(t) for t in texts]
+    return time.perf_counter() - start, results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    parser.add_argument("--texts", type=int, default=2000)
+    parser.add_argument("--words_per_text", type=int, default=60)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    texts = make_texts(rng, args.texts, args.words_per_text)
+
+    print(f"{'keywords':>9} {'build ms':>9} {'naive any ms':>13} {'matcher any ms':>15} "
+          f"{'naive all ms':>13} {'matcher all ms':>15} {'speedup any':>12}")
+    for size in args.sizes:
+        keywords = [random_word(rng).title() for _ in range(size)]
+
+        start = time.perf_counter()
+        matcher = KeywordMatcher(keywords)
+        build = time.perf_counter() - start
+
+        t_naive_any, naive_any_res = timed(lambda t: naive_any(keywords, t), texts)
+        t_any, any_res = timed(matcher.any_match, texts)
+        t_naive_all, naive_all_res = timed(lambda t: naive_all(keywords, t), texts)
+        t_all, all_res = timed(matcher.all_match, texts)
+
+        assert any_res == naive_any_res, "any_match disagrees with naive loop"
+        assert all_res == naive_all_res, "all_match disagrees with naive loop"
+
+        print(f"{size:>9} {build * 1e3:>9.1f} {t_naive_any * 1e3:>13.1f} {t_any * 1e3:>15.1f} "
+              f"{t_naive_all * 1e3:>13.1f} {t_all * 1e3:>15.1f} {t_naive_any / t_any:>11.1f}x")
+
+
+if __name__ == "__main__":
+    main()
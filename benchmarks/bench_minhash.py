@@ -0,0 +1,79 @@
+"""
+Module: bench_minhash.py
+
+Compares common.minhash.MinHashEngine with the per-line `datasketch.MinHash`
++ per-word `update()` path used by the dedup stages: checks the signatures
+are identical and reports lines/sec for both. Run from the repo root:
+
+    PYTHONPATH=. python benchmarks/bench_minhash.py
+"""
+
+import argparse
+import random
+import string
+import time
+
+import numpy as np
+from datasketch import MinHash
+
+from common.minhash import MinHashEngine
+
+
+def make_lines(rng, count, vocab_size, min_words, max_words):
+    vocab = ["".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 10)))
+             for _ in range(vocab_size)]
+    return [" ".join(rng.choice(vocab) for _ in range(rng.randint(min_words, max_words)))
+            for _ in range(count)]
+
+
+def datasketch_signatures(lines, num_perm):
+    rows = []
+    for line in lines:
+        m = MinHash(num_perm=num_perm)
+        for word in line.split():
+            m.update(word.encode('utf-8'))
+        rows.append(m.hashvalues)
+    return np.array(rows)
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=20000)
+    parser.add_argument("--num_perm", type=int, default=128)
+    parser.add_argument("--vocab_size", type=int, default=20000)
+    parser.add_argument("--min_words", type=int, default=3)
+    parser.add_argument("--max_words", type=int, default=40)
+    parser.add_argument("--batch_lines", type=int, default=1024)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    lines = make_lines(random.Random(args.seed), args.lines, args.vocab_size, args.min_words, args.max_words)
+    engine = MinHashEngine(num_perm=args.num_perm)
+    batches = [lines[i:i + args.batch_lines] for i in range(0, len(lines), args.batch_lines)]
+
+    base_time, expected = timed(datasketch_signatures, lines, args.num_perm)
+    engine_time, signatures = timed(lambda: np.vstack([engine.signatures(b) for b in batches]))
+    objects_time, _ = timed(lambda: [m for b in batches for m in engine.minhashes(b)])
+
+    print(f"📄 {len(lines)} lines, {args.num_perm} permutations, scheme {engine.scheme}")
+    print(f"{'path':>28} {'seconds':>9} {'lines/sec':>11} {'speedup':>8}")
+    for name, seconds in (("datasketch update() per word", base_time),
+                          ("engine signature matrix", engine_time),
+                          ("engine + MinHash objects", objects_time)):
+        print(f"{name:>28} {seconds:>9.3f} {len(lines) / seconds:>11.0f} {base_time / seconds:>7.1f}x")
+
+    if np.array_equal(expected, signatures):
+        print("✅ Signatures identical to datasketch")
+    else:
+        mismatched = int(np.sum(np.any(expected != signatures, axis=1)))
+        print(f"❌ {mismatched} signatures differ from datasketch")
+
+
+if __name__ == "__main__":
+    main()
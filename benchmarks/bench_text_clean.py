@@ -0,0 +1,127 @@
+"""
+Module: bench_text_clean.py
+
+Compares common.text_clean with the replace/NFKC/regex chains it replaced
+in text_filter.py and text_normalize.py: checks the outputs are identical
+and reports lines/sec for both, plus normalization of filter output (where
+`is_normalized` lets most lines through untouched). Run from the repo root:
+
+    PYTHONPATH=. python benchmarks/bench_text_clean.py [--sample <local text file>]
+"""
+
+import argparse
+import random
+import re
+import string
+import time
+import unicodedata
+
+from common import text_clean
+
+# Reference implementations (as they were in the stages)
+url_pattern = re.compile(r'(https?://\S+|www\.\S+)', re.IGNORECASE)
+code_pattern = re.compile(r'`[^`]+`|```[\s\S]+?```', re.IGNORECASE)
+html_tag_pattern = re.compile(r'<[^>]+>')
+non_printable_pattern = re.compile(r'[^\x20-\x7E]+')
+
+
+def reference_clean_unicode(text):
+    text = text.replace('\u2028', ' ').replace('\u2029', ' ')
+    text = text.replace('“', '"').replace('”', '"').replace('‘', "'").replace('’', "'")
+    text = text.replace('–', '-').replace('—', '-')
+    return unicodedata.normalize('NFKC', text)
+
+
+def reference_filter_clean(text):
+    text = reference_clean_unicode(text)
+    text = url_pattern.sub('', text)
+    text = code_pattern.sub('', text)
+    text = html_tag_pattern.sub('', text)
+    text = non_printable_pattern.sub('', text)
+    return ' '.join(text.split())
+
+
+def reference_normalize_line(line):
+    text = reference_clean_unicode(line)
+    text = url_pattern.sub('', text)
+    text = non_printable_pattern.sub('', text)
+    text = re.sub(r'\s+', ' ', text)
+    return text.strip()
+
+
+def kernel_filter_clean(text):
+    text = text_clean.clean_unicode(text)
+    text = text_clean.remove_urls(text)
+    text = text_clean.remove_code(text)
+    text = text_clean.remove_html_tags(text)
+    text = text_clean.remove_non_printable(text)
+    return text_clean.collapse_whitespace(text)
+
+
+def kernel_normalize_line(line):
+    return line if text_clean.is_normalized(line) else text_clean.normalize_line(line)
+
+
+EXTRAS = [
+    "https://example.com/page?q=1", "www.Example.org", "HTTP://SHOUT.COM", "`code()`", "<b>bold</b>",
+    "“quoted”", "‘single’", "a – b — c", "café", "ﬁne", "½",
+    "\u2028", "\t", "  ", "\x07", "\u00a0", "日本", "<", "`", "wwwx.", "://", "ſtrange",
+]
+
+
+def make_lines(rng, count):
+    vocab = ["".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 10))) for _ in range(5000)]
+    lines = []
+    for _ in range(count):
+        words = [rng.choice(vocab) for _ in range(rng.randint(3, 30))]
+        # Mostly plain ASCII prose, like most web text lines
+        for _ in range(rng.choice([0, 0, 0, 0, 1, 2])):
+            words.insert(rng.randrange(len(words) + 1), rng.choice(EXTRAS))
+        lines.append(" ".join(words))
+    return lines
+
+
+def timed(fn, lines):
+    start = time.perf_counter()
+    results = [fn(line) for line in lines]
+    return time.perf_counter() - start, results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=100000)
+    parser.add_argument("--sample", help="Local text file to use instead of synthetic lines")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.sample:
+        with open(args.sample, encoding='utf-8') as f:
+            lines = [line.strip() for line in f if line.strip()][:args.lines]
+    else:
+        lines = make_lines(random.Random(args.seed), args.lines)
+
+    t_ref_filter, ref_filtered = timed(reference_filter_clean, lines)
+    t_filter, filtered = timed(kernel_filter_clean, lines)
+    assert filtered == ref_filtered, "filter cleaning differs from the reference chain"
+
+    t_ref_norm, ref_normalized = timed(reference_normalize_line, lines)
+    t_norm, normalized = timed(kernel_normalize_line, lines)
+    assert normalized == ref_normalized, "normalize_line differs from the reference chain"
+
+    # Normalize stage on text the filter already cleaned
+    cleaned = [line for line in filtered if line]
+    t_ref_again, ref_again = timed(reference_normalize_line, cleaned)
+    t_again, again = timed(kernel_normalize_line, cleaned)
+    assert again == ref_again, "normalizing filter output differs from the reference chain"
+    skipped = sum(1 for line in cleaned if text_clean.is_normalized(line))
+
+    print(f"{'pass':<28} {'lines':>8} {'reference l/s':>14} {'kernel l/s':>12} {'speedup':>8}")
+    for name, count, t_ref, t_new in (("filter clean", len(lines), t_ref_filter, t_filter),
+                                      ("normalize raw lines", len(lines), t_ref_norm, t_norm),
+                                      ("normalize filter output", len(cleaned), t_ref_again, t_again)):
+        print(f"{name:<28} {count:>8} {count / t_ref:>14,.0f} {count / t_new:>12,.0f} {t_ref / t_new:>7.1f}x")
+    print(f"Identical outputs; {skipped / max(len(cleaned), 1):.1%} of filter output lines already normalized")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Module: bench_toxicity_backends.py
+
+Compares the toxicity backends (fp32 torch, int8 quantized torch, ONNX
+Runtime) on a local sample file: load time, throughput, peak memory, and
+score drift against the fp32 baseline. Each backend runs in its own
+process so memory numbers are not shared. Run from the repo root:
+
+    PYTHONPATH=. python benchmarks/bench_toxicity_backends.py --sample data/sample_filtered.txt
+"""
+
+import argparse
+import json
+import multiprocessing
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from common.shards import open_shard
+
+TOXICITY_THRESHOLD = 0.5
+
+
+def read_sample(path, limit):
+    """
+    Content lines of a filter-stage file ([DOC_START]/URL lines skipped).
+    """
+    texts = []
+    with open_shard(path, 'r') as f:
+        for line in f:
+            text = line.strip()
+            if not text or text == "[DOC_START]" or text.startswith("URL:"):
+                continue
+            texts.append(text)
+            if len(texts) >= limit:
+                break
+    return texts
+
+
+def run_backend(name, texts, batch_size, threads, onnx_dir):
+    """
+    Child-process task: load one backend and score the sample in batches of
+    similar length, returning scores in sample order plus timings.
+    """
+    from filtering.toxicity_backends import load_backend
+
+    start = time.perf_counter()
+    backend = load_backend(name, threads, onnx_dir)
+    load_s = time.perf_counter() - start
+
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    backend.score(texts[:2])  # warm-up
+    scores = [0.0] * len(texts)
+    start = time.perf_counter()
+    for offset in range(0, len(order), batch_size):
+        batch = order[offset:offset + batch_size]
+        for i, score in zip(batch, backend.score([texts[i] for i in batch])):
+            scores[i] = score
+    score_s = time.perf_counter() - start
+
+    return {
+        "backend": name,
+        "load_s": round(load_s, 2),
+        "lines_per_sec": round(len(texts) / score_s, 1) if score_s > 0 else None,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "scores": scores,
+    }
+
+
+def drift(baseline, scores):
+    baseline = np.asarray(baseline)
+    scores = np.asarray(scores)
+    diff = np.abs(scores - baseline)
+    flips = int(np.sum((baseline >= TOXICITY_THRESHOLD) != (scores >= TOXICITY_THRESHOLD)))
+    return {
+        "mean_abs_diff": round(float(diff.mean()), 5),
+        "max_abs_diff": round(float(diff.max()), 5),
+        "decision_flips": flips,
+        "decision_agreement": round(1 - flips / len(scores), 5),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sample", required=True, help="Local (or s3://) filtered text file")
+    parser.add_argument("--limit", type=int, default=2000, help="Content lines to score")
+    parser.add_argument("--backends", nargs="+", default=["torch", "quantized", "onnx"])
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--onnx_dir", default="models/detoxify-original-onnx")
+    parser.add_argument("--output", help="Write the results as JSON here")
+    args = parser.parse_args()
+
+    texts = read_sample(args.sample, args.limit)
+    print(f"📄 {len(texts)} sample lines from {args.sample}")
+
+    backends = ["torch"] + [name for name in args.backends if name != "torch"]
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for name in backends:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            results.append(pool.submit(run_backend, name, texts, args.batch_size,
+                                       args.threads, args.onnx_dir).result())
+
+    baseline = results[0]["scores"]
+    print(f"{'backend':>10} {'load s':>7} {'lines/sec':>10} {'peak RSS MB':>12} "
+          f"{'mean |d|':>9} {'max |d|':>8} {'flips':>6}")
+    for result in results:
+        result.update(drift(baseline, result["scores"]))
+        print(f"{result['backend']:>10} {result['load_s']:>7} {result['lines_per_sec']:>10} "
+              f"{result['peak_rss_mb']:>12} {result['mean_abs_diff']:>9} {result['max_abs_diff']:>8} "
+              f"{result['decision_flips']:>6}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump([{k: v for k, v in r.items() if k != "scores"} for r in results], f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
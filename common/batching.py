@@ -0,0 +1,59 @@
+"""
+Module: batching.py
+
+Ordered micro-batching for model inference inside a streaming stage.
+"""
+
+
+def predict_in_order(items, predict, batch_size, window=None, sort_key=None):
+    """
+    Runs `predict` over batches of texts while preserving input order.
+
+    Args:
+        items: iterable of (payload, text) pairs. A text of None marks an item
+            that needs no prediction (e.g. [DOC_START]/URL lines); it is
+            passed through in place.
+        predict: callable taking a list of texts and returning one
+            prediction per text.
+        batch_size: number of texts per `predict` call.
+        window: number of texts buffered before predicting (default:
+            `batch_size`). A larger window with `sort_key` lets batches be
+            bucketed by similar length.
+        sort_key: optional key used to order texts inside a window before
+            splitting it into batches.
+
+    Yields:
+        (payload, prediction) in input order; prediction is None for items
+        without text.
+    """
+    batch_size = max(1, batch_size)
+    window = max(batch_size, window or batch_size)
+    buffer = []
+    pending = 0
+
+    for payload, text in items:
+        buffer.append((payload, text))
+        if text is not None:
+            pending += 1
+        if pending >= window:
+            yield from _flush(buffer, predict, batch_size, sort_key)
+            buffer = []
+            pending = 0
+
+    if buffer:
+        yield from _flush(buffer, predict, batch_size, sort_key)
+
+
+def _flush(buffer, predict, batch_size, sort_key):
+    positions = [i for i, (_, text) in enumerate(buffer) if text is not None]
+    if sort_key is not None:
+        positions.sort(key=lambda i: sort_key(buffer[i][1]))
+
+    predictions = [None] * len(buffer)
+    for start in range(0, len(positions), batch_size):
+        batch = positions[start:start + batch_size]
+        for i, prediction in zip(batch, predict([buffer[i][1] for i in batch])):
+            predictions[i] = prediction
+
+    for (payload, _), prediction in zip(buffer, predictions):
+        yield payload, prediction
@@ -0,0 +1,76 @@
+"""
+Module: decision_cache.py
+
+LRU cache for per-line decisions, bounded by an approximate memory budget.
+Common Crawl repeats the same navigation, cookie and footer lines millions
+of times; caching what a stage decided for a line turns each repeat into a
+dict lookup. Entries are keyed on the line itself, not on a hash of it, so
+two different lines can never share an entry.
+"""
+
+import sys
+from collections import OrderedDict
+
+# Approximate bytes per entry besides the key and value themselves: the
+# OrderedDict slot and link and the (value, size) tuple.
+ENTRY_OVERHEAD = 128
+
+
+def value_size(value):
+    """
+    Rough in-memory size of a cached value (a tuple of small items).
+    """
+    if isinstance(value, tuple):
+        return sum(sys.getsizeof(item) for item in value)
+    return sys.getsizeof(value)
+
+
+class DecisionCache:
+    """
+    Maps a line (the string key) to a cached decision, evicting least
+    recently used entries once the estimated size exceeds `max_bytes`.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value):
+        size = ENTRY_OVERHEAD + sys.getsizeof(key) + value_size(value)
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[1]
+        self._entries[key] = (value, size)
+        self.bytes += size
+
+        while self.bytes > self.max_bytes and self._entries:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,213 @@
+"""
+Module: exact_index.py
+
+Compact membership indexes for exact-duplicate detection on 64-bit line
+hashes: an array-backed open-addressing hash set (exact; kept between a
+quarter and half full, so 16-32 bytes per line, briefly 48 while it
+doubles) and a scalable Bloom filter (a few bytes per line, with a
+configurable false-positive rate).
+"""
+
+import hashlib
+import math
+from array import array
+
+INDEX_KINDS = ("set", "bloom")
+BLOOM_FP_RATE = 1e-6
+BLOOM_CAPACITY = 10_000_000
+
+
+def line_hash(text):
+    """
+    Stable 64-bit hash of a line (same value in every process and run).
+    """
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class HashSet:
+    """
+    Set of 64-bit hashes in a flat `array('Q')` with linear probing, kept at
+    most half full (and at least a quarter full after `_grow`). Slot value 0 marks an empty slot, so hash 0 is stored
+    as 1.
+    """
+
+    kind = "set"
+
+    def __init__(self, capacity=1024):
+        size = 1 << max(4, (2 * capacity - 1).bit_length())
+        self._slots = array('Q', bytes(8 * size))
+        self._mask = size - 1
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, h):
+        h = h or 1
+        slots = self._slots
+        mask = self._mask
+        i = h & mask
+        while True:
+            value = slots[i]
+            if value == h:
+                return True
+            if value == 0:
+                return False
+            i = (i + 1) & mask
+
+    def add(self, h):
+        """
+        Adds `h`; returns True if it was already present.
+        """
+        h = h or 1
+        slots = self._slots
+        mask = self._mask
+        i = h & mask
+        while True:
+            value = slots[i]
+            if value == h:
+                return True
+            if value == 0:
+                break
+            i = (i + 1) & mask
+
+        slots[i] = h
+        self._count += 1
+        if 2 * self._count > len(slots):
+            self._grow()
+        return False
+
+    def add_many(self, hashes):
+        """
+        Adds each of `hashes` in order; returns whether each was already present.
+        """
+        return [self.add(h) for h in hashes]
+
+    def _grow(self):
+        old = self._slots
+        self._slots = array('Q', bytes(16 * len(old)))
+        self._mask = len(self._slots) - 1
+        self._count = 0
+        for value in old:
+            if value:
+                self.add(value)
+
+    @property
+    def nbytes(self):
+        return len(self._slots) * self._slots.itemsize
+
+
+class _Bloom:
+    """
+    One fixed-size Bloom filter; bit positions come from enhanced double
+    hashing of the two 32-bit halves of the 64-bit hash.
+    """
+
+    def __init__(self, capacity, fp_rate):
+        self.capacity = capacity
+        bits = max(64, int(math.ceil(-capacity * math.log(fp_rate) / (math.log(2) ** 2))))
+        self.num_bits = bits
+        self.num_hashes = max(1, round(bits / capacity * math.log(2)))
+        self.bits = bytearray((bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, h):
+        m = self.num_bits
+        x = (h & 0xFFFFFFFF) % m
+        y = (h >> 32) % m
+        positions = []
+        for i in range(self.num_hashes):
+            positions.append(x)
+            x = (x + y) % m
+            y = (y + i) % m
+        return positions
+
+    def __contains__(self, h):
+        bits = self.bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(h))
+
+    def add(self, h):
+        """
+        Sets the bits of `h` in one pass; returns True if all were set.
+        """
+        bits = self.bits
+        present = True
+        for p in self._positions(h):
+            mask = 1 << (p & 7)
+            if not bits[p >> 3] & mask:
+                present = False
+                bits[p >> 3] |= mask
+        if not present:
+            self.count += 1
+        return present
+
+
+class BloomFilter:
+    """
+    Scalable Bloom filter: when the current filter reaches its capacity a
+    new one with twice the capacity and half the false-positive rate is
+    added, so the overall rate stays around `fp_rate` (the sum of a
+    geometric series) however many lines are indexed.
+    """
+
+    kind = "bloom"
+
+    def __init__(self, capacity=BLOOM_CAPACITY, fp_rate=BLOOM_FP_RATE):
+        self.fp_rate = fp_rate
+        self._filters = [_Bloom(capacity, fp_rate / 2)]
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, h):
+        return any(h in f for f in self._filters)
+
+    def add(self, h):
+        """
+        Adds `h`; returns True if it was (probably) already present.
+        """
+        filters = self._filters
+        if len(filters) > 1 and any(h in f for f in filters[:-1]):
+            return True
+        current = filters[-1]
+        if current.count >= current.capacity:
+            if h in current:
+                return True
+            current = _Bloom(current.capacity * 2, self.fp_rate / 2 ** (len(filters) + 1))
+            filters.append(current)
+        if current.add(h):
+            return True
+        self._count += 1
+        return False
+
+    def add_many(self, hashes):
+        """
+        Adds each of `hashes` in order; returns whether each was (probably)
+        already present.
+        """
+        return [self.add(h) for h in hashes]
+
+    @property
+    def nbytes(self):
+        return sum(len(f.bits) for f in self._filters)
+
+
+def make_exact_index(kind="set", fp_rate=BLOOM_FP_RATE, capacity=BLOOM_CAPACITY):
+    if kind == "bloom":
+        return BloomFilter(capacity, fp_rate)
+    if kind == "set":
+        return HashSet()
+    raise ValueError(f"unknown exact index {kind!r}, expected one of {INDEX_KINDS}")
+
+
+def index_stats(index):
+    """
+    Size of an index and its memory cost per million distinct lines.
+    """
+    return {
+        "kind": index.kind,
+        "entries": len(index),
+        "bytes": index.nbytes,
+        "bytes_per_million_lines": round(index.nbytes / len(index) * 1_000_000) if len(index) else None,
+    }
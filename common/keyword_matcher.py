@@ -0,0 +1,159 @@
+"""
+Module: keyword_matcher.py
+
+Case-insensitive multi-keyword substring matcher shared by ingestion,
+filtering and deduplication.
+
+The keyword list is folded into a trie once and compiled into a single
+regular expression, so a scan over the text runs in C in one pass no matter
+how many keywords there are (the same idea as Aho-Corasick: shared prefixes
+are only tested once per text position).
+"""
+
+import re
+
+# Below this many keywords, a direct `in` check per keyword on the lowered
+# text is faster than a regex scan.
+SCAN_MIN_KEYWORDS = 24
+# all_match() checks this many of the longest (rarest) keywords directly
+# before scanning, since most texts fail an all-match early.
+ALL_MATCH_PRECHECK = 8
+
+
+def _trie_pattern(node):
+    """
+    Render a trie node as a regex fragment. Longer continuations are tried
+    before ending at a terminal node, so each match is the longest keyword
+    starting at that position.
+    """
+    terminal = "" in node
+    branches = []
+    single_chars = []
+    for char in sorted(k for k in node if k):
+        child = node[char]
+        if list(child) == [""]:
+            single_chars.append(char)
+        else:
+            branches.append(re.escape(char) + _trie_pattern(child))
+
+    if len(single_chars) == 1:
+        branches.append(re.escape(single_chars[0]))
+    elif single_chars:
+        branches.append("[" + "".join(re.escape(c) for c in single_chars) + "]")
+
+    if not branches:
+        return ""
+    if len(branches) == 1 and not terminal:
+        return branches[0]
+
+    pattern = "(?:" + "|".join(branches) + ")"
+    return pattern + "?" if terminal else pattern
+
+
+class KeywordMatcher:
+    """
+    Answers any-match, all-match and which-keyword-matched queries for a
+    fixed keyword list with a single pass over the text.
+
+    Matching is plain case-insensitive substring matching, the same as
+    `keyword.lower() in text.lower()`.
+    """
+
+    def __init__(self, keywords):
+        self.keywords = [str(k) for k in keywords]
+        self._lowered = {}
+        for keyword in self.keywords:
+            self._lowered.setdefault(keyword.lower(), keyword)
+        # An empty keyword matches every text, as `'' in text` does
+        self._matches_everything = "" in self._lowered
+
+        trie = {}
+        for keyword in self._lowered:
+            node = trie
+            for char in keyword:
+                node = node.setdefault(char, {})
+            node[""] = True
+        self._trie = trie
+
+        body = _trie_pattern(trie) if self._lowered.keys() - {""} else ""
+        self._search = re.compile(body) if body else None
+        self._scan = re.compile(f"(?=({body}))") if body else None
+        self._contained = {k: self._substrings(k) for k in self._lowered if k}
+        self._by_length = sorted(self._lowered, key=len, reverse=True)
+        self._direct = len(self._lowered) < SCAN_MIN_KEYWORDS
+
+    def _substrings(self, keyword):
+        """
+        All keywords occurring inside `keyword`, including itself.
+        """
+        found = set()
+        for start in range(len(keyword)):
+            node = self._trie
+            for end in range(start, len(keyword)):
+                node = node.get(keyword[end])
+                if node is None:
+                    break
+                if "" in node:
+                    found.add(keyword[start:end + 1])
+        return frozenset(found)
+
+    def __len__(self):
+        return len(self._lowered)
+
+    def __bool__(self):
+        return bool(self._lowered)
+
+    def any_match(self, text):
+        """
+        True if at least one keyword occurs in the text.
+        """
+        if self._matches_everything:
+            return True
+        if self._search is None:
+            return False
+        text = text.lower()
+        if self._direct:
+            return any(k in text for k in self._lowered)
+        return self._search.search(text) is not None
+
+    def first_match(self, text):
+        """
+        The keyword (as configured) with the leftmost occurrence, or None.
+        """
+        if self._matches_everything:
+            return self._lowered[""]
+        if self._search is None:
+            return None
+        match = self._search.search(text.lower())
+        return self._lowered[match.group()] if match else None
+
+    def find_all(self, text):
+        """
+        Set of every keyword (as configured) that occurs in the text.
+        """
+        found = set()
+        if self._matches_everything:
+            found.add("")
+        if self._scan is not None:
+            longest = {m.group(1) for m in self._scan.finditer(text.lower())}
+            for keyword in longest:
+                found |= self._contained[keyword]
+        return {self._lowered[k] for k in found}
+
+    def all_match(self, text):
+        """
+        True if every keyword occurs in the text (vacuously true when empty).
+        """
+        if self._scan is None:
+            return True
+        text = text.lower()
+        if self._direct:
+            return all(k in text for k in self._lowered)
+        if not all(k in text for k in self._by_length[:ALL_MATCH_PRECHECK]):
+            return False
+        remaining = set(self._lowered) - {""}
+        for m in self._scan.finditer(text):
+            remaining -= self._contained[m.group(1)]
+            if not remaining:
+                return True
+        return False
@@ -0,0 +1,388 @@
+"""
+Module: lsh_index.py
+
+Persistent, memory-mapped MinHash LSH index, so a new crawl can be
+deduplicated against every earlier run without re-hashing old data.
+
+An index is a local directory (local disk or EFS):
+
+    meta.json             parameters (threshold, bands, rows and the MinHash
+                          engine's num_perm, seed, ngram and scheme) and
+                          the list of segments
+    segment-00000/        one segment per flush:
+        bands.npy           sorted uint64 band keys of inserted items
+        exact.npy           sorted uint64 exact hashes of seen lines
+
+Segments are opened with `np.load(mmap_mode='r')`, so opening an index
+costs nothing up front and lookups touch only the pages they search.
+New insertions go into a bounded buffer (sorted uint64 NumPy runs plus a
+small set of the most recent values) and are appended as a new segment
+once the buffer holds BUFFER_ITEMS values, and by `flush()` at the end of
+a run (or written directly with `add_segment()`). Segments flushed before a
+crash stay in the index, so re-run only inputs whose output was not
+written. Once there are more than MAX_SEGMENTS segments they are merged
+into one by a streaming k-way merge of the mapped segments, which holds
+only a block of each segment in memory.
+
+Many readers may share an index, but only one process may write to it at
+a time. Segments replaced by a compaction are kept (listed as "retired" in
+meta.json) until the next compaction, so a reader that opened the index
+before a compaction can still map them.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+import numpy as np
+from datasketch import MinHashLSH
+
+META_FILE = "meta.json"
+MAX_SEGMENTS = 8
+
+# Buffered values (band keys plus exact hashes) that trigger a new segment
+BUFFER_ITEMS = 8 * 1024 * 1024
+# Recent values held in a set before they are sorted into a NumPy run
+RECENT_ITEMS = 64 * 1024
+# Values read from each segment per step of a compaction merge
+MERGE_BLOCK = 1024 * 1024
+
+
+def lsh_params(threshold, num_perm):
+    """
+    Band count and rows per band, as chosen by datasketch's MinHashLSH.
+    """
+    lsh = MinHashLSH(threshold=threshold, num_perm=num_perm)
+    return lsh.b, lsh.r
+
+
+def band_keys(signatures, bands, rows):
+    """
+    64-bit key per (item, band): a hash of the band index and the band's
+    slice of the signature. Equal keys mean the same LSH bucket.
+    """
+    signatures = np.atleast_2d(signatures)
+    keys = np.empty((len(signatures), bands), dtype=np.uint64)
+    for band in range(bands):
+        block = np.ascontiguousarray(signatures[:, band * rows:(band + 1) * rows])
+        salt = band.to_bytes(8, 'little')
+        for i, row in enumerate(block):
+            digest = hashlib.blake2b(row.tobytes(), digest_size=8, salt=salt).digest()
+            keys[i, band] = int.from_bytes(digest, 'little')
+    return keys
+
+
+def _sorted_contains(array, values):
+    """
+    Membership of each of `values` in the sorted `array`.
+    """
+    if len(array) == 0:
+        return np.zeros(len(values), dtype=bool)
+    positions = np.searchsorted(array, values)
+    positions[positions == len(array)] = 0
+    return array[positions] == values
+
+
+def _merge_sorted(tables, block=MERGE_BLOCK):
+    """
+    Yields the union of the sorted, duplicate-free arrays `tables` as sorted
+    blocks without duplicates, reading at most `block` values of each table
+    per step (so memory is bounded by the block size, not the tables).
+    """
+    cursors = [0] * len(tables)
+    while True:
+        live = [i for i, table in enumerate(tables) if cursors[i] < len(table)]
+        if not live:
+            return
+        # Every value up to `cutoff` lies within the next block of each table
+        cutoff = min(tables[i][min(cursors[i] + block, len(tables[i])) - 1] for i in live)
+        parts = []
+        for i in live:
+            window = tables[i][cursors[i]:cursors[i] + block]
+            stop = int(np.searchsorted(window, cutoff, side='right'))
+            parts.append(np.asarray(window[:stop]))
+            cursors[i] += stop
+        yield np.unique(np.concatenate(parts))
+
+
+def _save_merged(path, tables):
+    """
+    Writes the merge of sorted `tables` to the .npy file `path`, one block
+    at a time: a first pass counts the merged values, a second fills a
+    memory-mapped output of that size.
+    """
+    count = sum(len(merged) for merged in _merge_sorted(tables))
+    if not count:
+        np.save(path, np.empty(0, dtype=np.uint64))
+        return
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint64, shape=(count,))
+    offset = 0
+    for merged in _merge_sorted(tables):
+        out[offset:offset + len(merged)] = merged
+        offset += len(merged)
+    out.flush()
+    del out
+
+
+class _KeyBuffer:
+    """
+    Unflushed uint64 values: the most recent ones in a small set, older ones
+    in sorted NumPy runs. Runs are merged as they grow (each run is more
+    than twice the size of the next), so there are only O(log n) of them.
+    """
+
+    def __init__(self, recent_items=RECENT_ITEMS):
+        self.recent_items = recent_items
+        self._recent = set()
+        self._runs = []
+
+    def __len__(self):
+        return len(self._recent) + sum(len(run) for run in self._runs)
+
+    @property
+    def nbytes(self):
+        # Set table plus one int object per recent value
+        recent = sys.getsizeof(self._recent) + 32 * len(self._recent) if self._recent else 0
+        return recent + sum(run.nbytes for run in self._runs)
+
+    def _in_runs(self, values):
+        hits = np.zeros(len(values), dtype=bool)
+        for run in self._runs:
+            hits |= _sorted_contains(run, values)
+        return hits
+
+    def contains(self, values):
+        """
+        Membership of each of the uint64 array `values`.
+        """
+        hits = self._in_runs(values)
+        if self._recent:
+            hits |= np.fromiter((v in self._recent for v in values.tolist()), dtype=bool, count=len(values))
+        return hits
+
+    def add(self, values):
+        self._recent.update(values.tolist())
+        if len(self._recent) >= self.recent_items:
+            self._spill()
+
+    def _spill(self):
+        run = np.sort(np.fromiter(self._recent, dtype=np.uint64, count=len(self._recent)))
+        self._recent.clear()
+        run = run[~self._in_runs(run)]
+        if len(run):
+            self._runs.append(run)
+        while len(self._runs) > 1 and len(self._runs[-2]) <= 2 * len(self._runs[-1]):
+            newer = self._runs.pop()
+            self._runs[-1] = np.union1d(self._runs[-1], newer)
+
+    def drain(self):
+        """
+        Every buffered value as one sorted array; empties the buffer.
+        """
+        values = np.unique(np.concatenate(
+            self._runs + [np.fromiter(self._recent, dtype=np.uint64, count=len(self._recent))]))
+        self._runs = []
+        self._recent.clear()
+        return values
+
+
+class _ExactTier:
+    """
+    `add(h)` view over the index's exact hashes, with the same contract as
+    common.exact_index.HashSet: returns True if `h` was already present.
+    """
+
+    kind = "persistent"
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return self.index.exact_count()
+
+    def add(self, h):
+        return self.index.add_exact(h)
+
+    def add_many(self, hashes):
+        return self.index.add_exact_many(hashes)
+
+    @property
+    def nbytes(self):
+        return sum(t.nbytes for t in self.index._exact_tables) + self.index._new_exact.nbytes
+
+
+class PersistentLSHIndex:
+    """
+    Band tables plus exact-hash set of every item inserted by earlier runs
+    and this one.
+
+    `query(minhash)` / `insert(key, minhash)` mirror MinHashLSH (a query
+    hit means the item shares a bucket with an inserted item), so stages
+    can use the index in place of an in-memory MinHashLSH; `exact` is the
+    matching exact-duplicate tier.
+    """
+
+    def __init__(self, path, threshold, engine, buffer_items=BUFFER_ITEMS):
+        self.path = path
+        self.buffer_items = buffer_items
+        self.bands, self.rows = lsh_params(threshold, engine.num_perm)
+        params = {"threshold": threshold, "bands": self.bands, "rows": self.rows,
+                  "num_perm": engine.num_perm, "seed": engine.seed, "ngram": engine.ngram,
+                  "scheme": engine.scheme}
+
+        meta_path = os.path.join(path, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding='utf-8') as f:
+                meta = json.load(f)
+            stored = {name: meta[name] for name in params}
+            if stored != params:
+                raise ValueError(f"LSH index at {path} was built with {stored}, not {params}")
+            self.segments = meta["segments"]
+            self.retired = meta.get("retired", [])
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.segments = []
+            self.retired = []
+        self.params = params
+
+        self._band_tables = [self._load(segment, "bands") for segment in self.segments]
+        self._exact_tables = [self._load(segment, "exact") for segment in self.segments]
+        self._new_bands = _KeyBuffer()
+        self._new_exact = _KeyBuffer()
+        self.exact = _ExactTier(self)
+
+    def _load(self, segment, name):
+        return np.load(os.path.join(self.path, segment, f"{name}.npy"), mmap_mode='r')
+
+    def _keys(self, minhash):
+        return band_keys(np.asarray(minhash.hashvalues), self.bands, self.rows)[0]
+
+    # Band tables
+    def query_keys(self, keys):
+        """
+        For a (items, bands) key matrix: whether each item shares a bucket
+        with any inserted item.
+        """
+        keys = np.atleast_2d(np.asarray(keys, dtype=np.uint64))
+        flat = keys.ravel()
+        hits = self._new_bands.contains(flat)
+        for table in self._band_tables:
+            hits |= _sorted_contains(table, flat)
+        return hits.reshape(keys.shape).any(axis=1)
+
+    def insert_keys(self, keys):
+        self._new_bands.add(np.asarray(keys, dtype=np.uint64).ravel())
+        self._flush_if_full()
+
+    def query(self, minhash):
+        return bool(self.query_keys(self._keys(minhash))[0])
+
+    def insert(self, key, minhash):
+        self.insert_keys(self._keys(minhash))
+
+    # Exact hashes
+    def add_exact(self, h):
+        return bool(self.add_exact_many([h])[0])
+
+    def add_exact_many(self, hashes):
+        """
+        Adds a batch of exact hashes; returns, per hash, whether it was
+        already present, counting earlier hashes of the same batch (the
+        same answers as calling `add_exact` on each in order).
+        """
+        values = np.asarray(hashes, dtype=np.uint64)
+        present = self._new_exact.contains(values)
+        for table in self._exact_tables:
+            present |= _sorted_contains(table, values)
+        _, first = np.unique(values, return_index=True)
+        repeated = np.ones(len(values), dtype=bool)
+        repeated[first] = False
+        present |= repeated
+        self._new_exact.add(values[~present])
+        self._flush_if_full()
+        return present
+
+    def exact_count(self):
+        return sum(len(table) for table in self._exact_tables) + len(self._new_exact)
+
+    @property
+    def nbytes(self):
+        tables = self._band_tables + self._exact_tables
+        return sum(table.nbytes for table in tables) + self._new_bands.nbytes + self._new_exact.nbytes
+
+    # Persistence
+    def _write_segment(self, name, bands, exact, save=np.save):
+        tmp = os.path.join(self.path, f".{name}.tmp")
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        save(os.path.join(tmp, "bands.npy"), bands)
+        save(os.path.join(tmp, "exact.npy"), exact)
+        os.replace(tmp, os.path.join(self.path, name))
+
+    def _write_meta(self):
+        tmp = os.path.join(self.path, META_FILE + ".tmp")
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(dict(self.params, segments=self.segments, retired=self.retired), f, indent=2)
+        os.replace(tmp, os.path.join(self.path, META_FILE))
+
+    def _next_segment_name(self):
+        last = max((int(s.split("-")[1]) for s in self.segments + self.retired), default=-1)
+        return f"segment-{last + 1:05d}"
+
+    def add_segment(self, bands=(), exact=(), compact=True):
+        """
+        Appends arrays of band keys and exact hashes as one new segment.
+        With `compact=False` the caller compacts after a series of segments.
+        """
+        name = self._next_segment_name()
+        self._write_segment(name, np.unique(np.asarray(bands, dtype=np.uint64)),
+                            np.unique(np.asarray(exact, dtype=np.uint64)))
+        self.segments.append(name)
+        self._write_meta()
+        self._band_tables.append(self._load(name, "bands"))
+        self._exact_tables.append(self._load(name, "exact"))
+
+        if compact and len(self.segments) > MAX_SEGMENTS:
+            self.compact()
+
+    def _flush_if_full(self):
+        if len(self._new_bands) + len(self._new_exact) >= self.buffer_items:
+            self.flush()
+
+    def flush(self):
+        """
+        Appends buffered insertions as a new segment.
+        """
+        if not len(self._new_bands) and not len(self._new_exact):
+            return
+        self.add_segment(self._new_bands.drain(), self._new_exact.drain())
+
+    def compact(self):
+        """
+        Merges every segment into one sorted segment, streaming a k-way
+        merge of the mapped segments to disk in blocks. The merged segments
+        are retired rather than deleted; segments retired by the previous
+        compaction are deleted now.
+        """
+        if len(self.segments) <= 1:
+            return
+        name = self._next_segment_name()
+        self._write_segment(name, self._band_tables, self._exact_tables, save=_save_merged)
+        expired = self.retired
+        self.retired = list(self.segments)
+        self.segments = [name]
+        self._write_meta()
+        self._band_tables = [self._load(name, "bands")]
+        self._exact_tables = [self._load(name, "exact")]
+        for segment in expired:
+            shutil.rmtree(os.path.join(self.path, segment), ignore_errors=True)
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "segments": len(self.segments),
+            "band_keys": sum(len(t) for t in self._band_tables) + len(self._new_bands),
+            "exact_hashes": self.exact_count(),
+            "bytes": self.nbytes,
+        }
@@ -0,0 +1,156 @@
+"""
+Module: metrics.py
+
+Per-task stage metrics. Every task writes its own small JSON record under
+
+    s3://my-cc-pipeline-s3/logs/metrics/<run_id>/<stage>/<task>.json
+
+so concurrent tasks never read-modify-write a shared log file. The
+compaction stage (reporting/compact_metrics.py) merges a run's records into
+a single report.
+"""
+
+import json
+import os
+import re
+import time
+import uuid
+from collections import defaultdict
+from smart_open import open as s3_open
+
+# PIPELINE_METRICS_PREFIX (e.g. a local directory) overrides it for local runs
+METRICS_PREFIX = os.environ.get("PIPELINE_METRICS_PREFIX", "s3://my-cc-pipeline-s3/logs/metrics")
+
+# Step Functions passes the execution name; an ad-hoc run gets its own
+# folder (set PIPELINE_RUN_ID to group several ad-hoc commands)
+RUN_ID_ENV = "PIPELINE_RUN_ID"
+DEFAULT_RUN_ID = f"adhoc-{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+# Exported so worker processes of an ad-hoc run (spawned pools) share its id
+os.environ.setdefault(RUN_ID_ENV, DEFAULT_RUN_ID)
+
+
+def current_run_id():
+    return os.environ.get(RUN_ID_ENV, DEFAULT_RUN_ID)
+
+
+def utf8_len(text):
+    """
+    Encoded size of `text` without encoding it in the common ASCII case.
+    """
+    return len(text) if text.isascii() else len(text.encode('utf-8'))
+
+
+def task_name(source):
+    """
+    File-name-safe task id derived from an input key, path or URL.
+    """
+    return re.sub(r"[^A-Za-z0-9._-]+", "__", source).strip("_") or "task"
+
+
+class StageMetrics:
+    """
+    Counters, byte totals and timing for one task of one stage.
+
+    Stages keep their hot-loop counters as locals and copy them in with
+    `update()` at the end; `records` is the unit used for records/sec.
+    """
+
+    def __init__(self, stage, task, run_id=None):
+        self.stage = stage
+        self.task = task_name(task)
+        self.source = task
+        self.run_id = run_id or current_run_id()
+        self.counts = defaultdict(int)
+        self.records = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.extra = {}
+        self.started_at = time.time()
+        self.finished_at = None
+
+    def update(self, **counts):
+        for name, value in counts.items():
+            self.counts[name] += value
+
+    def stop(self):
+        if self.finished_at is None:
+            self.finished_at = time.time()
+
+    def to_dict(self):
+        self.stop()
+        wall_time = self.finished_at - self.started_at
+        return {
+            "run_id": self.run_id,
+            "stage": self.stage,
+            "task": self.task,
+            "source": self.source,
+            "started_at": self.started_at,
+            "wall_time_s": round(wall_time, 3),
+            "records": self.records,
+            "records_per_sec": round(self.records / wall_time, 2) if wall_time > 0 else None,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "counts": dict(self.counts),
+            "extra": self.extra,
+        }
+
+    def path(self, prefix=METRICS_PREFIX):
+        return f"{prefix}/{self.run_id}/{self.stage}/{self.task}.json"
+
+    def write(self, prefix=METRICS_PREFIX):
+        """
+        Writes this task's record (one small PUT, independent of other tasks).
+        """
+        record = self.to_dict()
+        path = self.path(prefix)
+        if "://" not in path:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with s3_open(path, 'w', encoding='utf-8') as f:
+            json.dump(record, f)
+        return record
+
+
+def merge_records(records):
+    """
+    Aggregates task records into a per-stage report.
+    """
+    stages = {}
+    for record in records:
+        stage = stages.setdefault(record["stage"], {
+            "tasks": 0,
+            "records": 0,
+            "bytes_in": 0,
+            "bytes_out": 0,
+            "task_wall_time_s": 0.0,
+            "max_task_wall_time_s": 0.0,
+            "first_started_at": None,
+            "last_finished_at": None,
+            "counts": defaultdict(int),
+        })
+        stage["tasks"] += 1
+        stage["records"] += record["records"]
+        stage["bytes_in"] += record["bytes_in"]
+        stage["bytes_out"] += record["bytes_out"]
+        stage["task_wall_time_s"] += record["wall_time_s"]
+        stage["max_task_wall_time_s"] = max(stage["max_task_wall_time_s"], record["wall_time_s"])
+        finished = record["started_at"] + record["wall_time_s"]
+        if stage["first_started_at"] is None or record["started_at"] < stage["first_started_at"]:
+            stage["first_started_at"] = record["started_at"]
+        if stage["last_finished_at"] is None or finished > stage["last_finished_at"]:
+            stage["last_finished_at"] = finished
+        for name, value in record["counts"].items():
+            stage["counts"][name] += value
+
+    for stage in stages.values():
+        stage["counts"] = dict(stage["counts"])
+        elapsed = stage["last_finished_at"] - stage["first_started_at"]
+        stage["elapsed_s"] = round(elapsed, 3)
+        stage["task_wall_time_s"] = round(stage["task_wall_time_s"], 3)
+        # Throughput of one task vs the whole (possibly parallel) stage
+        stage["records_per_task_sec"] = (
+            round(stage["records"] / stage["task_wall_time_s"], 2) if stage["task_wall_time_s"] else None
+        )
+        stage["records_per_sec"] = round(stage["records"] / elapsed, 2) if elapsed > 0 else None
+
+    return stages
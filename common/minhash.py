@@ -0,0 +1,143 @@
+"""
+Module: minhash.py
+
+Batched MinHash signatures with NumPy. Produces the same hash values as
+building a `datasketch.MinHash` per text and calling `update()` once per
+token, but hashes each distinct token once and applies all permutations to
+all tokens of a batch as array operations. Signatures can be turned back
+into `datasketch.MinHash` objects for `MinHashLSH`.
+"""
+
+import hashlib
+import numpy as np
+from datasketch import MinHash
+
+# Tokens per permutation block (block size: CHUNK_TOKENS x num_perm values)
+CHUNK_TOKENS = 8192
+# Distinct tokens whose 32-bit hash is remembered between batches
+HASH_CACHE_SIZE = 1_000_000
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH_32 = np.uint64((1 << 32) - 1)
+
+
+def sha1_hash32(token):
+    """
+    datasketch's default token hash: the first 4 bytes of SHA-1, little endian.
+    """
+    return int.from_bytes(hashlib.sha1(token.encode('utf-8')).digest()[:4], 'little')
+
+
+def _fmix32(hv):
+    """
+    MurmurHash3 32-bit finalizer (datasketch's affine32 pre-mix).
+    """
+    hv = hv ^ (hv >> np.uint32(16))
+    hv = hv * np.uint32(0x85EBCA6B)
+    hv = hv ^ (hv >> np.uint32(13))
+    hv = hv * np.uint32(0xC2B2AE35)
+    return hv ^ (hv >> np.uint32(16))
+
+
+class MinHashEngine:
+    """
+    Computes MinHash signature matrices for batches of texts.
+
+    Tokens are whitespace-separated words, or word n-grams with `ngram` > 1
+    (a text shorter than n words is one shingle). Permutation parameters
+    and the permutation scheme are taken from `datasketch.MinHash` itself,
+    so signatures match it for both the "legacy" scheme and the "affine32"
+    scheme of newer datasketch releases.
+    """
+
+    def __init__(self, num_perm=128, seed=1, ngram=1, chunk_tokens=CHUNK_TOKENS):
+        self.num_perm = num_perm
+        self.seed = seed
+        self.ngram = ngram
+        self.chunk_tokens = chunk_tokens
+
+        prototype = MinHash(num_perm=num_perm, seed=seed)
+        self.scheme = getattr(prototype, "scheme", "legacy")
+        if self.scheme not in ("legacy", "affine32"):
+            raise ValueError(f"unsupported MinHash scheme {self.scheme!r}")
+        self.permutations = prototype.permutations
+        self.empty = prototype.hashvalues.copy()
+        self.dtype = self.empty.dtype
+        self._minhash_kwargs = {"scheme": self.scheme} if hasattr(prototype, "scheme") else {}
+        self._a, self._b = (np.asarray(p, dtype=self.dtype) for p in self.permutations)
+        self._hash_cache = {}
+
+    def shingles(self, text):
+        words = text.split()
+        n = self.ngram
+        if n <= 1:
+            return words
+        if len(words) <= n:
+            return [" ".join(words)] if words else []
+        return [" ".join(words[i:i + n]) for i in range(len(words) - n + 1)]
+
+    def _token_hashes(self, tokens):
+        cache = self._hash_cache
+        if len(cache) > HASH_CACHE_SIZE:
+            cache.clear()
+        hashes = []
+        for token in tokens:
+            h = cache.get(token)
+            if h is None:
+                h = cache[token] = sha1_hash32(token)
+            hashes.append(h)
+        return hashes
+
+    def _permute(self, hv):
+        """
+        Permuted hash values, shape (len(hv), num_perm).
+        """
+        if self.scheme == "legacy":
+            hv = hv.astype(np.uint64)[:, None]
+            return np.bitwise_and((hv * self._a + self._b) % _MERSENNE_PRIME, _MAX_HASH_32)
+        hv = _fmix32(hv.astype(np.uint32))[:, None]
+        return hv * self._a + self._b
+
+    def signatures(self, texts):
+        """
+        Signature matrix, shape (len(texts), num_perm); a text without
+        tokens keeps datasketch's empty hash values.
+        """
+        result = np.tile(self.empty, (len(texts), 1))
+        batch_rows = []
+        batch_counts = []
+        batch_tokens = []
+
+        def flush():
+            if not batch_rows:
+                return
+            permuted = self._permute(np.array(self._token_hashes(batch_tokens), dtype=np.uint64))
+            starts = np.cumsum([0] + batch_counts[:-1])
+            result[batch_rows] = np.minimum.reduceat(permuted, starts, axis=0)
+            batch_rows.clear()
+            batch_counts.clear()
+            batch_tokens.clear()
+
+        with np.errstate(over='ignore'):
+            for row, text in enumerate(texts):
+                tokens = self.shingles(text)
+                if not tokens:
+                    continue
+                if batch_tokens and len(batch_tokens) + len(tokens) > self.chunk_tokens:
+                    flush()
+                batch_rows.append(row)
+                batch_counts.append(len(tokens))
+                batch_tokens.extend(tokens)
+            flush()
+
+        return result
+
+    def to_minhash(self, hashvalues):
+        """
+        A `datasketch.MinHash` with the given signature row, for LSH.
+        """
+        return MinHash(num_perm=self.num_perm, seed=self.seed, hashvalues=hashvalues,
+                       permutations=self.permutations, **self._minhash_kwargs)
+
+    def minhashes(self, texts):
+        return [self.to_minhash(row) for row in self.signatures(texts)]
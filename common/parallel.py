@@ -0,0 +1,55 @@
+"""
+Module: parallel.py
+
+Bounded fan-out helpers for running stage work in a process or thread pool
+without queueing the whole input up front.
+"""
+
+import os
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+
+
+def available_cpus():
+    """
+    Number of CPUs this process may run on (respects container CPU sets).
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def bounded_map(executor, fn, items, max_pending, ordered=True):
+    """
+    Like `executor.map(fn, items)` but keeps at most `max_pending` tasks
+    submitted at once, so a long or lazy `items` iterable is consumed only
+    as results are taken.
+
+    With `ordered=False`, results are yielded as tasks complete.
+    """
+    max_pending = max(1, max_pending)
+    pending = deque() if ordered else set()
+
+    for item in items:
+        if len(pending) >= max_pending:
+            if ordered:
+                yield pending.popleft().result()
+            else:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        future = executor.submit(fn, item)
+        if ordered:
+            pending.append(future)
+        else:
+            pending.add(future)
+
+    if ordered:
+        while pending:
+            yield pending.popleft().result()
+    else:
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
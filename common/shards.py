@@ -0,0 +1,177 @@
+"""
+Module: shards.py
+
+Streaming, optionally compressed, size-sharded text output for stage files,
+plus helpers so downstream stages find and read those shards transparently.
+
+Shard naming for a base path `.../X_extracted`:
+- single uncompressed file:  X_extracted.txt   (the original layout)
+- compressed:                X_extracted.txt.gz / X_extracted.txt.zst
+- sharded by size:           X_extracted-00000.txt[.gz|.zst], -00001, ...
+"""
+
+import gzip
+import io
+import re
+from smart_open import open as s3_open
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_SUFFIXES = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+# S3 multipart part size used by smart_open while streaming a shard
+DEFAULT_PART_SIZE = 16 * 1024 * 1024
+
+
+def shard_path(base_path, index=None, compression="none"):
+    """
+    Full path of shard `index` of `base_path` (no index for an unsharded file).
+    """
+    number = f"-{index:05d}" if index is not None else ""
+    return f"{base_path}{number}.txt{COMPRESSION_SUFFIXES[compression]}"
+
+
+def is_shard_key(key, tag):
+    """
+    True if `key` is a stage file for `tag` (e.g. "_extracted"), in any of
+    the sharded or compressed layouts.
+    """
+    return re.search(rf"{re.escape(tag)}(?:-\d{{5}})?\.txt(?:\.gz|\.zst)?$", key) is not None
+
+
+def _require_zstandard():
+    if zstandard is None:
+        raise ImportError("zstd compression requires the `zstandard` package")
+
+
+def open_shard(path, mode='r'):
+    """
+    Open a stage file in text mode, compressing or decompressing according
+    to its extension. Works for s3:// URIs and local paths.
+    """
+    if path.endswith(".zst"):
+        _require_zstandard()
+        raw = s3_open(path, mode[0] + 'b', compression='disable')
+        if mode.startswith('r'):
+            stream = zstandard.ZstdDecompressor().stream_reader(raw, closefd=True)
+        else:
+            stream = zstandard.ZstdCompressor().stream_writer(raw, closefd=True)
+        return io.TextIOWrapper(stream, encoding='utf-8')
+
+    # smart_open handles .gz by extension
+    return s3_open(path, mode, encoding='utf-8')
+
+
+class _CountingWriter(io.RawIOBase):
+    """
+    Pass-through binary writer that counts the bytes reaching the sink.
+    """
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.bytes_written = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.sink.write(data)
+        self.bytes_written += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.sink.close()
+        super().close()
+
+
+class ShardedWriter:
+    """
+    Writes text records to one or more shards, streaming each shard to S3 as
+    multipart parts instead of buffering the whole output in memory.
+
+    A record is never split across shards; a new shard is started before a
+    record once the current shard's stored (compressed) size reaches
+    `shard_size`. Nothing is created until the first record is written.
+    """
+
+    def __init__(self, base_path, compression="none", shard_size=None, part_size=DEFAULT_PART_SIZE):
+        if compression not in COMPRESSION_SUFFIXES:
+            raise ValueError(f"Unknown compression: {compression}")
+        if compression == "zstd":
+            _require_zstandard()
+        self.base_path = base_path
+        self.compression = compression
+        self.shard_size = shard_size or None
+        self.part_size = part_size
+        self.paths = []
+        self.records = 0
+        self.bytes_in = 0
+        self.bytes_written = 0
+        self._sink = None
+        self._stream = None
+
+    def _open_next(self):
+        index = len(self.paths) if self.shard_size else None
+        path = shard_path(self.base_path, index, self.compression)
+        transport_params = {"min_part_size": self.part_size} if path.startswith("s3://") else None
+        raw = s3_open(path, 'wb', compression='disable', transport_params=transport_params)
+        self._sink = _CountingWriter(raw)
+
+        if self.compression == "gzip":
+            self._stream = gzip.GzipFile(fileobj=self._sink, mode='wb')
+        elif self.compression == "zstd":
+            self._stream = zstandard.ZstdCompressor().stream_writer(self._sink, closefd=False)
+        else:
+            self._stream = self._sink
+        self.paths.append(path)
+
+    def _close_current(self):
+        if self._stream is None:
+            return
+        if self._stream is not self._sink:
+            self._stream.close()
+        self._sink.close()
+        self.bytes_written += self._sink.bytes_written
+        self._stream = None
+        self._sink = None
+
+    def write_record(self, text):
+        """
+        Append one record (already newline-terminated) to the current shard.
+        """
+        if self._stream is not None and self.shard_size and self._sink.bytes_written >= self.shard_size:
+            self._close_current()
+        if self._stream is None:
+            self._open_next()
+
+        data = text.encode('utf-8')
+        self._stream.write(data)
+        self.bytes_in += len(data)
+        self.records += 1
+
+    def close(self):
+        self._close_current()
+
+    def abort(self):
+        """
+        Drop the shard in progress without completing its upload.
+        """
+        if self._sink is not None and hasattr(self._sink.sink, "terminate"):
+            self._sink.sink.terminate()
+            self._stream = None
+            self._sink = None
+        else:
+            self._close_current()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
@@ -0,0 +1,93 @@
+"""
+Module: text_clean.py
+
+Line-cleaning kernel shared by the filter and normalize stages.
+
+Gives the same results as chaining `str.replace`, NFKC and one regex
+substitution per pattern, but does less work per line:
+- the punctuation replacements are one `str.translate` table;
+- ASCII lines skip the table and NFKC (both leave ASCII unchanged), and
+  other lines skip NFKC when they are already in NFKC form;
+- each regex pass runs only if the line contains the characters its
+  pattern needs (e.g. "://" or "www." for URLs, "<" for tags), and the
+  non-printable pass only if the line is not printable ASCII already.
+
+The passes still run in the original order, since one removal can create
+a match for a later pattern. `is_normalized` recognizes lines that
+`normalize_line` would return unchanged (e.g. lines the filter stage
+already cleaned), so normalization can pass them through without work.
+"""
+
+import re
+import unicodedata
+
+UNICODE_TABLE = str.maketrans({
+    '\u2028': ' ', '\u2029': ' ',
+    '\u201c': '"', '\u201d': '"', '\u2018': "'", '\u2019': "'",
+    '\u2013': '-', '\u2014': '-',
+})
+
+url_pattern = re.compile(r'(https?://\S+|www\.\S+)', re.IGNORECASE)
+code_pattern = re.compile(r'`[^`]+`|```[\s\S]+?```', re.IGNORECASE)
+html_tag_pattern = re.compile(r'<[^>]+>')
+non_printable_pattern = re.compile(r'[^\x20-\x7E]+')
+
+
+def clean_unicode(text):
+    """
+    Unicode separators to spaces, curly quotes and dashes to ASCII, then NFKC.
+    """
+    if text.isascii():
+        return text
+    text = text.translate(UNICODE_TABLE)
+    if unicodedata.is_normalized('NFKC', text):
+        return text
+    return unicodedata.normalize('NFKC', text)
+
+
+def may_contain_url(text):
+    return "://" in text or ("." in text and "www." in text.lower())
+
+
+def remove_urls(text):
+    return url_pattern.sub('', text) if may_contain_url(text) else text
+
+
+def remove_code(text):
+    return code_pattern.sub('', text) if "`" in text else text
+
+
+def remove_html_tags(text):
+    return html_tag_pattern.sub('', text) if "<" in text else text
+
+
+def is_printable_ascii(text):
+    return text.isascii() and text.isprintable()
+
+
+def remove_non_printable(text):
+    return text if is_printable_ascii(text) else non_printable_pattern.sub('', text)
+
+
+def collapse_whitespace(text):
+    return ' '.join(text.split())
+
+
+def normalize_line(line):
+    """
+    The normalize stage's cleaning: unicode cleanup, URLs and non-printable
+    characters removed, whitespace collapsed.
+    """
+    text = clean_unicode(line)
+    text = remove_urls(text)
+    text = remove_non_printable(text)
+    return collapse_whitespace(text)
+
+
+def is_normalized(line):
+    """
+    True if `normalize_line(line) == line` is guaranteed: printable ASCII,
+    single spaces, no leading or trailing space, nothing URL-like.
+    """
+    return (is_printable_ascii(line) and "  " not in line and line == line.strip()
+            and not may_contain_url(line))
@@ -0,0 +1,223 @@
+"""
+Module: token_shards.py
+
+Binary token shards: a flat array of token ids per shard plus an offset
+index per document, so a trainer can memory-map the tokenized corpus and
+slice documents out of it without parsing JSON.
+
+Layout for a base path `.../X`:
+- X-00000.bin    token ids of every document in the shard, back to back
+                 (little-endian uint16, or uint32 for vocabularies over 65536)
+- X-00000.idx    .npy array of uint64 token offsets, one per document plus
+                 a final end offset: document i is bin[idx[i]:idx[i + 1]]
+- X.json         manifest: dtype, totals and each shard's first doc id,
+                 document and token counts
+
+Documents keep their sequential ids across shards (shard k starts at
+`first_id`) and are never split between shards.
+"""
+
+import bisect
+import io
+import json
+import os
+import numpy as np
+from smart_open import open as s3_open
+from common.shards import DEFAULT_PART_SIZE, _CountingWriter
+
+BIN_SUFFIX = ".bin"
+INDEX_SUFFIX = ".idx"
+MANIFEST_SUFFIX = ".json"
+
+
+def dtype_for_vocab(vocab_size):
+    """
+    Smallest token dtype that holds every id of a `vocab_size` vocabulary.
+    """
+    return np.dtype('<u2') if vocab_size <= 1 << 16 else np.dtype('<u4')
+
+
+def token_shard_path(base_path, index, suffix):
+    return f"{base_path}-{index:05d}{suffix}"
+
+
+class TokenShardWriter:
+    """
+    Streams documents' token ids into size-sharded .bin files, writing each
+    shard's offset index when the shard is closed and the manifest on
+    `close()`.
+
+    A new shard is started before a document once the current shard holds
+    `shard_size` bytes of tokens. Nothing is created until the first
+    document is written.
+    """
+
+    def __init__(self, base_path, dtype, shard_size=None, part_size=DEFAULT_PART_SIZE):
+        self.base_path = base_path
+        self.dtype = np.dtype(dtype).newbyteorder('<')
+        self.shard_size = shard_size or None
+        self.part_size = part_size
+        self.shards = []
+        self.documents = 0
+        self.tokens = 0
+        self.bytes_written = 0
+        self._sink = None
+        self._offsets = None
+
+    def _open(self, path, mode):
+        transport_params = {"min_part_size": self.part_size} if path.startswith("s3://") else None
+        return s3_open(path, mode, compression='disable', transport_params=transport_params)
+
+    def _open_next(self):
+        path = token_shard_path(self.base_path, len(self.shards), BIN_SUFFIX)
+        self._sink = _CountingWriter(self._open(path, 'wb'))
+        self._offsets = [0]
+        self.shards.append({
+            "bin": os.path.basename(path),
+            "index": os.path.basename(token_shard_path(self.base_path, len(self.shards), INDEX_SUFFIX)),
+            "first_id": self.documents,
+            "documents": 0,
+            "tokens": 0,
+        })
+
+    def _close_current(self):
+        if self._sink is None:
+            return
+        self._sink.close()
+        self.bytes_written += self._sink.bytes_written
+
+        buffer = io.BytesIO()
+        np.save(buffer, np.asarray(self._offsets, dtype='<u8'))
+        index_path = token_shard_path(self.base_path, len(self.shards) - 1, INDEX_SUFFIX)
+        with self._open(index_path, 'wb') as f:
+            f.write(buffer.getvalue())
+        self.bytes_written += buffer.tell()
+        self._sink = None
+        self._offsets = None
+
+    def write_document(self, tokens):
+        """
+        Appends one document's token ids to the current shard.
+        """
+        if self._sink is not None and self.shard_size and self._sink.bytes_written >= self.shard_size:
+            self._close_current()
+        if self._sink is None:
+            self._open_next()
+
+        array = np.asarray(tokens, dtype=self.dtype)
+        self._sink.write(array.tobytes())
+        self._offsets.append(self._offsets[-1] + len(array))
+        shard = self.shards[-1]
+        shard["documents"] += 1
+        shard["tokens"] += len(array)
+        self.documents += 1
+        self.tokens += len(array)
+
+    def manifest(self):
+        return {
+            "dtype": self.dtype.name,
+            "documents": self.documents,
+            "tokens": self.tokens,
+            "shards": self.shards,
+        }
+
+    def close(self):
+        self._close_current()
+        with s3_open(self.base_path + MANIFEST_SUFFIX, 'w', encoding='utf-8') as f:
+            json.dump(self.manifest(), f, indent=2)
+
+    def abort(self):
+        """
+        Drop the shard in progress without completing its upload (no manifest
+        is written).
+        """
+        if self._sink is not None and hasattr(self._sink.sink, "terminate"):
+            self._sink.sink.terminate()
+        elif self._sink is not None:
+            self._sink.close()
+        self._sink = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+class TokenShard:
+    """
+    One memory-mapped shard. `document(i)` and `token_range(start, stop)`
+    return NumPy views into the mapped file (no copy, nothing read until
+    the data is touched).
+    """
+
+    def __init__(self, bin_path, index_path, dtype, first_id=0):
+        self.dtype = np.dtype(dtype)
+        self.first_id = first_id
+        if os.path.getsize(bin_path):
+            self.tokens = np.memmap(bin_path, dtype=self.dtype, mode='r')
+        else:
+            # mmap cannot map an empty file (a shard of empty documents)
+            self.tokens = np.empty(0, dtype=self.dtype)
+        self.offsets = np.load(index_path, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def num_tokens(self):
+        return len(self.tokens)
+
+    def document(self, i):
+        """
+        Tokens of the shard's `i`-th document (doc id `first_id + i`).
+        """
+        if not 0 <= i < len(self):
+            raise IndexError(f"document {i} out of range for a shard of {len(self)}")
+        return self.tokens[int(self.offsets[i]):int(self.offsets[i + 1])]
+
+    def token_range(self, start, stop):
+        return self.tokens[start:stop]
+
+
+class TokenShards:
+    """
+    Reader for a local copy of a binary tokenized output, opened from its
+    manifest (`base_path` + ".json"). Documents are looked up by their
+    global doc id; shards are mapped as they are first used.
+    """
+
+    def __init__(self, base_path):
+        with open(base_path + MANIFEST_SUFFIX, encoding='utf-8') as f:
+            self.manifest = json.load(f)
+        self.directory = os.path.dirname(base_path)
+        self.dtype = np.dtype(self.manifest["dtype"]).newbyteorder('<')
+        self._first_ids = [shard["first_id"] for shard in self.manifest["shards"]]
+        self._shards = {}
+
+    def __len__(self):
+        return self.manifest["documents"]
+
+    @property
+    def num_shards(self):
+        return len(self.manifest["shards"])
+
+    def shard(self, index):
+        if index not in self._shards:
+            info = self.manifest["shards"][index]
+            self._shards[index] = TokenShard(os.path.join(self.directory, info["bin"]),
+                                             os.path.join(self.directory, info["index"]),
+                                             self.dtype, info["first_id"])
+        return self._shards[index]
+
+    def document(self, doc_id):
+        """
+        Tokens of document `doc_id` as a view into its shard's mapping.
+        """
+        if not 0 <= doc_id < len(self):
+            raise IndexError(f"doc id {doc_id} out of range for {len(self)} documents")
+        index = bisect.bisect_right(self._first_ids, doc_id) - 1
+        return self.shard(index).document(doc_id - self._first_ids[index])
@@ -0,0 +1,96 @@
+"""
+Module: work.py
+
+Work distribution for stages that process every file under an S3 prefix:
+fully paginated listing, deterministic assignment of keys to shards, and
+explicit manifests, so a stage can run as N parallel workers.
+"""
+
+import hashlib
+import json
+import os
+from smart_open import open as s3_open
+from common.shards import is_shard_key
+
+
+def list_keys(s3, bucket, prefix, tag):
+    """
+    All stage files for `tag` under `prefix`, across every listing page,
+    in sorted order.
+    """
+    keys = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if is_shard_key(obj['Key'], tag):
+                keys.append(obj['Key'])
+    return sorted(keys)
+
+
+def list_inputs(root, tag, s3=None):
+    """
+    Full paths of the stage files for `tag` under `root`, in sorted order.
+    `root` is an s3://bucket/prefix URI (listed with `s3`, a boto3 client)
+    or a local directory searched recursively, so stages can run locally.
+    """
+    if root.startswith("s3://"):
+        bucket, _, prefix = root[len("s3://"):].partition("/")
+        return [f"s3://{bucket}/{key}" for key in list_keys(s3, bucket, prefix, tag)]
+
+    paths = []
+    for dirpath, _, filenames in os.walk(root):
+        paths.extend(os.path.join(dirpath, name) for name in filenames if is_shard_key(name, tag))
+    return sorted(paths)
+
+
+def shard_of(key, num_shards):
+    """
+    Shard index for a key. Stable across runs, processes and listing order.
+    """
+    digest = hashlib.md5(key.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % num_shards
+
+
+def select_shard(keys, shard_index, num_shards):
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"shard index {shard_index} out of range for {num_shards} shards")
+    return [key for key in keys if shard_of(key, num_shards) == shard_index]
+
+
+def load_manifest(path, bucket):
+    """
+    Keys from a local or S3 manifest: a JSON list (or {"keys": [...]}) or one
+    key per line. Full s3://<bucket>/ URIs are accepted.
+    """
+    with s3_open(path, 'r', encoding='utf-8') as f:
+        text = f.read().strip()
+
+    if text.startswith(("[", "{")):
+        data = json.loads(text)
+        entries = data["keys"] if isinstance(data, dict) else data
+    else:
+        entries = text.splitlines()
+
+    prefix = f"s3://{bucket}/"
+    return [entry.strip()[len(prefix):] if entry.strip().startswith(prefix) else entry.strip()
+            for entry in entries if entry.strip()]
+
+
+def add_work_arguments(parser):
+    """
+    Adds --shard_index/--num_shards/--manifest to a stage's argument parser.
+    """
+    parser.add_argument("--shard_index", "--shard-index", type=int, default=0,
+                        help="Which shard of the input keys this worker processes")
+    parser.add_argument("--num_shards", "--num-shards", type=int, default=1,
+                        help="Total number of workers the input keys are split across")
+    parser.add_argument("--manifest", help="Local or s3:// list of input keys, instead of listing the prefix")
+
+
+def resolve_keys(args, s3, bucket, prefix, tag):
+    """
+    The input keys this worker should process, from the manifest or the
+    paginated listing, restricted to its shard.
+    """
+    keys = load_manifest(args.manifest, bucket) if args.manifest else list_keys(s3, bucket, prefix, tag)
+    return select_shard(keys, args.shard_index, args.num_shards)
@@ -3,16 +3,44 @@ Module: deduplicate.py
 
 Removes near-duplicate lines from filtered text files using MinHash and
 Locality Sensitive Hashing (LSH). This helps reduce redundancy before
-training language models.
+training language models. Byte-identical lines are caught first by an
+exact-match index of 64-bit line hashes, before any MinHash is built;
+signatures for the remaining lines are computed in batches with NumPy.
+With --index_path both tiers live in a persistent on-disk index, so lines
+are also deduplicated against every earlier run that used it.
+
+With --workers N, files are signed in a pool of N forked workers (low-value
+filtering, exact repeats within the file, MinHash signatures and LSH band
+keys) that stream their results to local spill files, and the parent
+merges them in sorted key order against the shared exact index and band
+tables, keeping exactly the lines the serial pass keeps over the same
+file order.
 """
 
+import argparse
 import hashlib
+import multiprocessing
+import os
 import string
+import tempfile
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
 from datasketch import MinHash, MinHashLSH
 from hydra import initialize, compose
 import boto3
-from smart_open import open as s3_open
+from common.keyword_matcher import KeywordMatcher
+from common.shards import open_shard
+from common.work import add_work_arguments, resolve_keys
+from common.metrics import StageMetrics, utf8_len
+from common.batching import predict_in_order
+from common.minhash import MinHashEngine
+from common.exact_index import (
+    BLOOM_CAPACITY, BLOOM_FP_RATE, INDEX_KINDS, index_stats, line_hash, make_exact_index,
+)
+from common.lsh_index import PersistentLSHIndex, band_keys, lsh_params
+from common.parallel import bounded_map
 
 # Load config
 with initialize(config_path="../configs", version_base=None):
@@ -33,6 +61,16 @@ PUNCTUATION_THRESHOLD = cfg.filters.punctuation_ratio_threshold
 BOILERPLATE_PHRASES = [phrase.lower() for phrase in cfg.filters.boilerplate_phrases]
 SIMILARITY_THRESHOLD = cfg.deduplication.similarity_threshold
 NUM_PERM = cfg.deduplication.num_perm
+NGRAM = cfg.deduplication.get("ngram", 1)
+BOILERPLATE_MATCHER = KeywordMatcher(BOILERPLATE_PHRASES)
+
+# Candidate lines per batched signature computation
+MINHASH_BATCH_LINES = 1024
+MINHASH_ENGINE = MinHashEngine(NUM_PERM, ngram=NGRAM)
+
+# Engine inherited by forked pool workers (keeps its token hash cache
+# per worker instead of pickling it with every task)
+_worker_engine = None
 
 
 def get_minhash(text: str) -> MinHash:
@@ -45,10 +83,7 @@ def get_minhash(text: str) -> MinHash:
     Returns:
         MinHash: The MinHash signature object.
     """
-    m = MinHash(num_perm=NUM_PERM)
-    for word in text.split():
-        m.update(word.encode('utf-8'))
-    return m
+    return MINHASH_ENGINE.minhashes([text])[0]
 
 
 def is_low_value_line(line):
@@ -61,7 +96,7 @@ def is_low_value_line(line):
     if is_high_punctuation_ratio(line):
         return True
 
-    if any(phrase in line.lower() for phrase in BOILERPLATE_PHRASES):
+    if BOILERPLATE_MATCHER.any_match(line):
         return True
 
     return False
@@ -82,70 +117,356 @@ def is_special_line(line):
     return line == "[DOC_START]" or line.startswith("URL: ")
 
 
-def deduplicate_file(s3_key: str, lsh: MinHashLSH):
+def deduplicate_lines(fin, metrics, lsh, exact_index=None, engine=None):
     """
-    Deduplicates a single file based on MinHash similarity.
+    Deduplicates the lines of one file based on MinHash similarity.
 
     Args:
-        file_path (Path): Path to the input filtered file.
-        lsh (MinHashLSH): Global LSH index for duplicate detection.
+        fin: Iterable of input lines.
+        metrics (StageMetrics): Filled in with the file's counts once the
+            generator is exhausted.
+        lsh (MinHashLSH): Global LSH index for duplicate detection (or a
+            PersistentLSHIndex).
+        exact_index: Hashes of every line already seen (HashSet or
+            BloomFilter); repeats are dropped without MinHash or LSH.
+        engine (MinHashEngine): Batched signature engine (word n-gram size
+            and permutations); defaults to MINHASH_ENGINE.
+
+    Yields:
+        str: Kept lines, newline-terminated.
     """
-    input_path = f"s3://{BUCKET}/{s3_key}"
-    output_key = s3_key.replace(DETOXIFIED_PREFIX, DEDUPED_PREFIX).replace("_detoxified", "_deduped")
-    output_path = f"s3://{BUCKET}/{output_key}"
-
+    engine = engine or MINHASH_ENGINE
     kept = 0
     skipped = 0
+    low_value = 0
+    exact_duplicates = 0
+    near_duplicates = 0
+    lines_in = 0
+    bytes_in = 0
+    bytes_out = 0
+
+    def candidates():
+        """
+        Yields (line, text to MinHash or None) in input order, dropping
+        low-value lines and exact repeats on the way.
+        """
+        nonlocal lines_in, bytes_in, low_value, skipped
+        batch = []
+        for line in fin:
+            lines_in += 1
+            bytes_in += utf8_len(line)
+            line = line.strip()
+            if not line:
+                continue
+
+            # Always keep special metadata lines
+            if is_special_line(line):
+                batch.append((line, False))
+            elif is_low_value_line(line):
+                low_value += 1
+                skipped += 1
+                continue
+            else:
+                batch.append((line, True))
+
+            if len(batch) >= MINHASH_BATCH_LINES:
+                yield from drop_exact(batch)
+                batch = []
+        yield from drop_exact(batch)
+
+    def drop_exact(batch):
+        """
+        Yields a batch of (line, is candidate) as (line, text or None),
+        looking the whole batch up in the exact index in one call.
+        """
+        nonlocal exact_duplicates, skipped
+        repeats = iter(())
+        if exact_index is not None:
+            repeats = iter(exact_index.add_many([line_hash(line) for line, candidate in batch if candidate]))
+        for line, candidate in batch:
+            if not candidate:
+                yield line, None
+            # A repeat of any earlier line has the same MinHash, so it would
+            # match in LSH too
+            elif exact_index is not None and next(repeats):
+                exact_duplicates += 1
+                skipped += 1
+            else:
+                yield line, line
+
+    signed = predict_in_order(candidates(), engine.minhashes, MINHASH_BATCH_LINES)
+    for line, minhash in signed:
+        if minhash is None:
+            yield line + "\n"
+            bytes_out += utf8_len(line) + 1
+            continue
+
+        key = hashlib.md5(line.encode('utf-8')).hexdigest()
+
+        # Check for duplicates
+        if not lsh.query(minhash):
+            lsh.insert(key, minhash)
+            yield line + "\n"
+            bytes_out += utf8_len(line) + 1
+            kept += 1
+        else:
+            near_duplicates += 1
+            skipped += 1
+
+    metrics.records = lines_in
+    metrics.bytes_in = bytes_in
+    metrics.bytes_out = bytes_out
+    record_counts(metrics, lsh, exact_index, kept=kept, removed=skipped, low_value=low_value,
+                  exact_duplicates=exact_duplicates, near_duplicates=near_duplicates)
+
+
+def deduplicate_file(s3_key: str, lsh: MinHashLSH, exact_index=None, engine=None):
+    """
+    Deduplicates a single file based on MinHash similarity (see
+    `deduplicate_lines`).
+    """
+    output_key = output_key_for(s3_key)
+    metrics = StageMetrics("deduplicate", s3_key)
+
+    with open_shard(f"s3://{BUCKET}/{s3_key}", 'r') as fin, \
+         open_shard(f"s3://{BUCKET}/{output_key}", 'w') as fout:
+        for line in deduplicate_lines(fin, metrics, lsh, exact_index, engine):
+            fout.write(line)
+
+    report_file(metrics, output_key)
+
+
+def output_key_for(s3_key):
+    return s3_key.replace(DETOXIFIED_PREFIX, DEDUPED_PREFIX).replace("_detoxified", "_deduped")
+
+
+def record_counts(metrics, lsh, exact_index, **counts):
+    metrics.update(**counts)
+    if exact_index is not None:
+        metrics.extra["exact_index"] = index_stats(exact_index)
+    if isinstance(lsh, PersistentLSHIndex):
+        metrics.extra["lsh_index"] = lsh.stats()
+
+
+def report_file(metrics, output_key):
+    """
+    Writes a file's metrics record and prints its summary.
+    """
+    metrics.write()
+    counts = metrics.counts
+    print(f"✅ Done: {output_key} | Kept: {counts['kept']}, Removed: {counts['removed']} "
+          f"(exact: {counts['exact_duplicates']}, near: {counts['near_duplicates']}, "
+          f"low value: {counts['low_value']})")
+
+
+def signed_paths(spill_dir, s3_key):
+    """
+    Spill files of one signed file: kept lines (text), exact hashes and
+    LSH band keys per candidate line (raw uint64).
+    """
+    base = os.path.join(spill_dir, s3_key.replace("/", "__"))
+    return {"lines": base + ".lines", "hashes": base + ".hashes", "keys": base + ".keys"}
 
-    with s3_open(input_path, 'r', encoding='utf-8') as fin, \
-         s3_open(output_path, 'w', encoding='utf-8') as fout:
 
-        for i, line in enumerate(fin):
+def sign_file(s3_key, spill_dir, exact=True):
+    """
+    Pool task: everything about one file that does not depend on other
+    files. Low-value lines and repeats of an earlier line of the same file
+    (with the exact tier on) are dropped here, since the serial pass drops
+    them whatever came before; near-duplicates are left to the merge, as a
+    line's local match may itself be dropped by an earlier file.
+
+    The remaining lines, their exact hashes and band keys are streamed to
+    spill files in `spill_dir` (a batch of MINHASH_BATCH_LINES lines in
+    memory at a time), so the parent receives only the file's counts.
+
+    Returns:
+        dict: The file's input counts.
+    """
+    engine = _worker_engine or MINHASH_ENGINE
+    bands, rows = lsh_params(SIMILARITY_THRESHOLD, engine.num_perm)
+    local = make_exact_index("set") if exact else None
+    counts = {"lines_in": 0, "bytes_in": 0, "low_value": 0, "exact_duplicates": 0}
+    paths = signed_paths(spill_dir, s3_key)
+    texts = []
+
+    with open_shard(f"s3://{BUCKET}/{s3_key}", 'r') as fin, \
+         open(paths["lines"], 'w', encoding='utf-8', newline='\n') as lines_out, \
+         open(paths["hashes"], 'wb') as hashes_out, \
+         open(paths["keys"], 'wb') as keys_out:
+
+        def sign_batch():
+            if texts:
+                band_keys(engine.signatures(texts), bands, rows).tofile(keys_out)
+                np.fromiter(map(line_hash, texts), dtype=np.uint64, count=len(texts)).tofile(hashes_out)
+                texts.clear()
+
+        for line in fin:
+            counts["lines_in"] += 1
+            counts["bytes_in"] += utf8_len(line)
             line = line.strip()
             if not line:
                 continue
 
-            # Always keep special metadata lines
             if is_special_line(line):
-                fout.write(line + "\n")
+                lines_out.write(line + "\n")
                 continue
 
             if is_low_value_line(line):
-                skipped += 1
+                counts["low_value"] += 1
                 continue
 
+            if local is not None and local.add(line_hash(line)):
+                counts["exact_duplicates"] += 1
+                continue
 
-            minhash = get_minhash(line)
-            key = hashlib.md5(line.encode('utf-8')).hexdigest()
+            lines_out.write(line + "\n")
+            texts.append(line)
+            if len(texts) >= MINHASH_BATCH_LINES:
+                sign_batch()
+        sign_batch()
+
+    return counts
 
-            # Check for duplicates
-            if not lsh.query(minhash):
-                lsh.insert(key, minhash)
-                fout.write(line + "\n")
-                kept += 1
-            else:
-                skipped += 1
 
-        # S3 log write
-    log_path = "s3://my-cc-pipeline-s3/logs/deduplicated_log.txt"
-    log_entry = f"{output_key} | Kept: {kept}, Removed: {skipped}\n"
+def claim_buckets(lsh, keys):
+    """
+    Serial LSH decision on precomputed band keys: False if the line shares
+    a bucket with a kept line, else claims its buckets and returns True.
+    `lsh` is a set of claimed keys or a PersistentLSHIndex.
+    """
+    if isinstance(lsh, PersistentLSHIndex):
+        if lsh.query_keys(keys)[0]:
+            return False
+        lsh.insert_keys(keys)
+        return True
+    keys = keys.tolist()
+    if any(key in lsh for key in keys):
+        return False
+    lsh.update(keys)
+    return True
+
+
+def merge_file(s3_key, signed, spill_dir, lsh, exact_index, bands):
+    """
+    Decides and writes one signed file against the shared exact index and
+    band tables, in line order, streaming its spill files (deleted once
+    merged).
+    """
+    output_key = output_key_for(s3_key)
+    metrics = StageMetrics("deduplicate", s3_key)
+    exact_duplicates = signed["exact_duplicates"]
+    near_duplicates = 0
+    kept = 0
+    bytes_out = 0
+    paths = signed_paths(spill_dir, s3_key)
+    hashes = np.fromfile(paths["hashes"], dtype=np.uint64) if os.path.getsize(paths["hashes"]) else \
+        np.empty(0, dtype=np.uint64)
+    keys = np.memmap(paths["keys"], dtype=np.uint64, mode='r').reshape(-1, bands) if len(hashes) else \
+        np.empty((0, bands), dtype=np.uint64)
+    repeats = None
+    c = 0
+
+    with open(paths["lines"], encoding='utf-8', newline='\n') as fin, \
+         open_shard(f"s3://{BUCKET}/{output_key}", 'w') as fout:
+        for line in fin:
+            line = line[:-1]
+            if not is_special_line(line):
+                if exact_index is not None and c % MINHASH_BATCH_LINES == 0:
+                    repeats = exact_index.add_many(hashes[c:c + MINHASH_BATCH_LINES])
+                repeat = repeats is not None and repeats[c % MINHASH_BATCH_LINES]
+                row = np.asarray(keys[c])
+                c += 1
+                if repeat:
+                    exact_duplicates += 1
+                    continue
+                if not claim_buckets(lsh, row):
+                    near_duplicates += 1
+                    continue
+                kept += 1
+            fout.write(line + "\n")
+            bytes_out += utf8_len(line) + 1
 
-    with s3_open(log_path, 'w', encoding='utf-8') as log_file:
-        log_file.write(log_entry)
+    del keys
+    for path in paths.values():
+        os.remove(path)
 
+    metrics.records = signed["lines_in"]
+    metrics.bytes_in = signed["bytes_in"]
+    metrics.bytes_out = bytes_out
+    removed = signed["low_value"] + exact_duplicates + near_duplicates
+    record_counts(metrics, lsh, exact_index, kept=kept, removed=removed, low_value=signed["low_value"],
+                  exact_duplicates=exact_duplicates, near_duplicates=near_duplicates)
+    report_file(metrics, output_key)
 
-    print(f"✅ Done: {output_key} | Kept: {kept}, Removed: {skipped}")
 
+def deduplicate_parallel(keys, workers, lsh=None, exact_index=None, engine=None):
+    """
+    Signs files in a pool of `workers` forked processes and merges them in
+    sorted key order. `lsh` is a PersistentLSHIndex or None (in-memory
+    band tables).
 
-def main():
-    lsh = MinHashLSH(threshold=SIMILARITY_THRESHOLD, num_perm=NUM_PERM)
-    response = s3.list_objects_v2(Bucket=BUCKET, Prefix=DETOXIFIED_PREFIX)
+    Signed files wait in a temporary directory (under TMPDIR) until they
+    are merged, at most 2 * `workers` of them at a time, so the parent's
+    memory does not grow with file size or worker count.
+    """
+    global _worker_engine
+    _worker_engine = engine or MINHASH_ENGINE
+    bands, _ = lsh_params(SIMILARITY_THRESHOLD, _worker_engine.num_perm)
+    claimed = lsh if lsh is not None else set()
+    with tempfile.TemporaryDirectory(prefix="dedup-signed-") as spill_dir, \
+         ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as pool:
+        sign = partial(sign_file, spill_dir=spill_dir, exact=exact_index is not None)
+        keys = sorted(keys)
+        for s3_key, signed in zip(keys, bounded_map(pool, sign, keys, 2 * workers)):
+            merge_file(s3_key, signed, spill_dir, claimed, exact_index, bands)
 
-    for obj in response.get('Contents', []):
-        s3_key = obj['Key']
-        if s3_key.endswith("_detoxified.txt"):
-            deduplicate_file(s3_key, lsh)
 
+def main():
+    parser = argparse.ArgumentParser(
+        epilog="With --num_shards > 1, lines are only deduplicated against files in the same shard; "
+               "global deduplication still runs across all shards."
+    )
+    parser.add_argument("--exact_index", choices=INDEX_KINDS + ("none",), default="set",
+                        help="Exact-duplicate tier: array-backed hash set, Bloom filter, or none")
+    parser.add_argument("--bloom_fp_rate", type=float, default=BLOOM_FP_RATE,
+                        help="False-positive rate of the Bloom filter (lines wrongly dropped as exact repeats)")
+    parser.add_argument("--bloom_capacity", type=int, default=BLOOM_CAPACITY,
+                        help="Lines the first Bloom filter is sized for (it grows beyond this)")
+    parser.add_argument("--ngram", type=int, default=NGRAM,
+                        help="Word n-gram size of MinHash shingles (1 = single words)")
+    parser.add_argument("--index_path", default=None,
+                        help="Local directory of a persistent LSH index: lines are also deduplicated against "
+                             "earlier runs, and kept lines are appended to it (the exact tier is its hash set)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Processes signing files in parallel (1 = serial); output matches the serial "
+                             "pass over the input keys in sorted order. Up to 2 x workers signed files "
+                             "(kept lines plus 8 bytes per band per line) wait on local disk under TMPDIR")
+    add_work_arguments(parser)
+    args = parser.parse_args()
+
+    engine = MINHASH_ENGINE if args.ngram == NGRAM else MinHashEngine(NUM_PERM, ngram=args.ngram)
+
+    exact_index = None
+    if args.index_path:
+        lsh = PersistentLSHIndex(args.index_path, SIMILARITY_THRESHOLD, engine)
+        if args.exact_index != "none":
+            exact_index = lsh.exact
+        print(f"🔗 LSH index {args.index_path}: {len(lsh.segments)} segments, {lsh.exact_count()} exact hashes")
+    else:
+        lsh = MinHashLSH(threshold=SIMILARITY_THRESHOLD, num_perm=NUM_PERM)
+        if args.exact_index != "none":
+            exact_index = make_exact_index(args.exact_index, args.bloom_fp_rate, args.bloom_capacity)
+
+    keys = resolve_keys(args, s3, BUCKET, DETOXIFIED_PREFIX, "_detoxified")
+    if args.workers > 1:
+        deduplicate_parallel(keys, args.workers, lsh if args.index_path else None, exact_index, engine)
+    else:
+        for s3_key in keys:
+            deduplicate_file(s3_key, lsh, exact_index, engine)
+
+    if args.index_path:
+        lsh.flush()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,418 @@
+"""
+Module: distributed_lsh.py
+
+Distributed global deduplication as map / reduce / resolve / write phases
+that exchange spill files under a work directory (an s3:// prefix, or a
+local directory standing in for S3):
+
+1. map (one task per input shard): MinHash signatures per document, then
+   one 64-bit key per LSH band; (band key, doc id) records are partitioned
+   by band key and spilled to disk whenever the buffer is full.
+2. reduce (one task per partition): sorts its records and keeps only
+   buckets with more than one document (candidate clusters), written as
+   (doc id, bucket number) memberships sorted by doc id.
+3. resolve (one task): walks colliding documents in doc-id order and
+   drops a document if one of its buckets already holds a kept document.
+   It merges the memory-mapped partition files a window of doc ids at a
+   time and tracks claimed buckets in one boolean array per partition,
+   so its memory is bounded by the window and the bucket counts, not by
+   the number of memberships. Writes the dropped ids as a sorted array.
+4. write (one task): copies the surviving documents to the output.
+5. index (one task, with --index_path): appends the band keys of the
+   surviving documents to the persistent LSH index, one segment per
+   partition, so it holds one partition's keys at a time.
+
+With --index_path, map tasks also look every document up in the index
+(read-only, memory-mapped); documents that hit it are dropped in step 3
+as if they came after an earlier run's kept documents.
+
+Doc ids are (file index << 32 | document index) over the sorted input
+files, so step 3 makes exactly the keep/drop decisions of the serial
+MinHashLSH pass in global_deduplicate.py, independent of task scheduling.
+
+Each phase can run as its own job (`--phase map --shard_index i ...`) or
+all phases with local processes (`--phase all`).
+"""
+
+import argparse
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import numpy as np
+from smart_open import open as s3_open
+from common.shards import open_shard
+from common.work import list_inputs
+from common.metrics import StageMetrics
+from common.minhash import MinHashEngine
+from common.lsh_index import MAX_SEGMENTS, PersistentLSHIndex, band_keys, lsh_params
+from common.parallel import available_cpus
+from deduplication.global_deduplicate import (
+    FINAL_OUTPUT_KEY, FINAL_OUTPUT_PATH, INPUT_ROOT, NUM_PERM, SIMILARITY_THRESHOLD, WORK_DIR,
+    iter_documents, s3, write_document,
+)
+
+# Documents per signature batch in the map phase
+MAP_BATCH_DOCS = 256
+# Records buffered by a map task before spilling (16 bytes each)
+SPILL_RECORDS = 4_000_000
+# Memberships read per partition for each resolve window
+RESOLVE_RECORDS = 1_000_000
+
+DOC_INDEX_BITS = 32
+
+
+def _open_write(path, mode='wb'):
+    if "://" not in path:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    return s3_open(path, mode)
+
+
+def _save(path, array):
+    with _open_write(path) as f:
+        np.save(f, array)
+
+
+def _load(path):
+    with s3_open(path, 'rb') as f:
+        return np.load(f)
+
+
+def _load_mapped(path):
+    """
+    Memory-mapped array: local files are mapped in place, S3 objects are
+    downloaded to a temporary file first (unlinked once mapped).
+    """
+    if "://" not in path:
+        return np.load(path, mmap_mode='r')
+    with s3_open(path, 'rb') as src, tempfile.NamedTemporaryFile(suffix=".npy", delete=False) as dst:
+        while chunk := src.read(16 * 1024 * 1024):
+            dst.write(chunk)
+    try:
+        return np.load(dst.name, mmap_mode='r')
+    finally:
+        os.unlink(dst.name)
+
+
+def _sorted_contains(array, values):
+    if len(array) == 0:
+        return np.zeros(len(values), dtype=bool)
+    positions = np.searchsorted(array, values)
+    positions[positions == len(array)] = 0
+    return array[positions] == values
+
+
+def manifest_path(work_dir, shard_index):
+    return f"{work_dir}/map/manifest-{shard_index:05d}.json"
+
+
+def reduce_path(work_dir, partition, column):
+    """
+    Reduce output of `partition`: "docs" (sorted doc ids) or "buckets" (the
+    bucket number within the partition of each membership).
+    """
+    return f"{work_dir}/reduce/part-{partition:05d}-{column}.npy"
+
+
+def dropped_path(work_dir):
+    return f"{work_dir}/resolve/dropped.npy"
+
+
+def prior_path(work_dir, shard_index):
+    return f"{work_dir}/map/prior-{shard_index:05d}.npy"
+
+
+def _manifests(work_dir, num_shards):
+    for shard_index in range(num_shards):
+        with s3_open(manifest_path(work_dir, shard_index), 'r') as f:
+            yield json.load(f)
+
+
+def open_index(index_path):
+    return PersistentLSHIndex(index_path, SIMILARITY_THRESHOLD, MinHashEngine(NUM_PERM))
+
+
+def map_shard(inputs, shard_index, num_shards, work_dir, num_partitions, spill_records=SPILL_RECORDS,
+              index_path=None):
+    """
+    Map task: band-key records for the input files with
+    `file index % num_shards == shard_index`, spilled per partition.
+    Writes a manifest listing its spill files and, with `index_path`, the
+    ids of documents already present in the persistent index.
+    """
+    engine = MinHashEngine(NUM_PERM)
+    bands, rows = lsh_params(SIMILARITY_THRESHOLD, NUM_PERM)
+    index = open_index(index_path) if index_path else None
+    prior = []
+    buffers = [[] for _ in range(num_partitions)]
+    buffered = 0
+    spill_count = 0
+    spills = {}
+    docs = 0
+
+    def spill():
+        nonlocal buffered, spill_count
+        for partition, chunks in enumerate(buffers):
+            if not chunks:
+                continue
+            path = f"{work_dir}/map/part-{partition:05d}/s{shard_index:05d}-{spill_count:04d}.npy"
+            _save(path, np.concatenate(chunks))
+            spills.setdefault(str(partition), []).append(path)
+            chunks.clear()
+        buffered = 0
+        spill_count += 1
+
+    for file_index, path in enumerate(inputs):
+        if file_index % num_shards != shard_index:
+            continue
+        with open_shard(path, 'r') as fin:
+            documents = iter_documents(fin)
+            doc_index = 0
+            for batch in iter(lambda: list(islice(documents, MAP_BATCH_DOCS)), []):
+                signatures = engine.signatures([" ".join(doc_lines) for _, doc_lines in batch])
+                ids = (np.uint64(file_index) << np.uint64(DOC_INDEX_BITS)) + \
+                    np.arange(doc_index, doc_index + len(batch), dtype=np.uint64)
+                doc_index += len(batch)
+
+                keys = band_keys(signatures, bands, rows)
+                if index is not None:
+                    prior.append(ids[index.query_keys(keys)])
+                keys = keys.ravel()
+                records = np.stack([keys, np.repeat(ids, bands)], axis=1)
+                partitions = keys % np.uint64(num_partitions)
+                order = np.argsort(partitions, kind='stable')
+                bounds = np.searchsorted(partitions[order], np.arange(num_partitions + 1, dtype=np.uint64))
+                for partition in range(num_partitions):
+                    start, end = bounds[partition], bounds[partition + 1]
+                    if end > start:
+                        buffers[partition].append(records[order[start:end]])
+                buffered += len(records)
+                if buffered >= spill_records:
+                    spill()
+            docs += doc_index
+
+    spill()
+    manifest = {"shard_index": shard_index, "docs": docs, "spills": spills}
+    if index is not None:
+        manifest["prior"] = prior_path(work_dir, shard_index)
+        _save(manifest["prior"], np.concatenate(prior) if prior else np.empty(0, dtype=np.uint64))
+    with _open_write(manifest_path(work_dir, shard_index), 'w') as f:
+        json.dump(manifest, f)
+    return docs
+
+
+def reduce_partition(partition, work_dir, num_shards):
+    """
+    Reduce task: memberships of every bucket in this partition that holds
+    more than one document, as doc ids and bucket numbers (0.. in band key
+    order) sorted by doc id.
+    """
+    chunks = []
+    for manifest in _manifests(work_dir, num_shards):
+        chunks.extend(_load(path) for path in manifest["spills"].get(str(partition), []))
+
+    docs = np.empty(0, dtype=np.uint64)
+    buckets = np.empty(0, dtype=np.uint64)
+    if chunks:
+        records = np.concatenate(chunks)
+        keys = records[:, 0]
+        order = np.lexsort((records[:, 1], keys))
+        keys = keys[order]
+        # Records whose key equals the previous or next record's key
+        same_prev = np.concatenate([[False], keys[1:] == keys[:-1]])
+        same_next = np.concatenate([keys[:-1] == keys[1:], [False]])
+        shared = same_prev | same_next
+        shared_keys = keys[shared]
+        bucket = np.cumsum(np.concatenate([[False], shared_keys[1:] != shared_keys[:-1]]), dtype=np.uint64)
+        doc = records[order[shared], 1]
+        by_doc = np.lexsort((bucket, doc))
+        docs = doc[by_doc]
+        buckets = bucket[by_doc]
+
+    _save(reduce_path(work_dir, partition, "docs"), docs)
+    _save(reduce_path(work_dir, partition, "buckets"), buckets)
+    return len(docs)
+
+
+def resolve(work_dir, num_partitions, num_shards, window_records=RESOLVE_RECORDS):
+    """
+    Greedy pass in doc-id order over documents that share any bucket: a
+    document is dropped if it was found in the persistent index or one of
+    its buckets holds an earlier kept document, otherwise it is kept and
+    claims its buckets. Writes the sorted dropped doc ids.
+    """
+    priors = [_load(manifest["prior"]) for manifest in _manifests(work_dir, num_shards) if "prior" in manifest]
+    prior = np.unique(np.concatenate(priors)) if priors else np.empty(0, dtype=np.uint64)
+
+    docs = [_load_mapped(reduce_path(work_dir, p, "docs")) for p in range(num_partitions)]
+    buckets = [_load_mapped(reduce_path(work_dir, p, "buckets")) for p in range(num_partitions)]
+    claimed = [np.zeros(int(b.max()) + 1 if len(b) else 0, dtype=bool) for b in buckets]
+    cursors = [0] * num_partitions
+    dropped = [prior]
+
+    while True:
+        live = [p for p in range(num_partitions) if cursors[p] < len(docs[p])]
+        if not live:
+            break
+        # Every membership of the docs up to `last` (at most window_records per partition)
+        last = min(docs[p][min(cursors[p] + window_records, len(docs[p])) - 1] for p in live)
+        window_docs, window_parts, window_buckets = [], [], []
+        for p in live:
+            stop = cursors[p] + int(np.searchsorted(docs[p][cursors[p]:], last, side='right'))
+            window_docs.append(np.asarray(docs[p][cursors[p]:stop]))
+            window_buckets.append(np.asarray(buckets[p][cursors[p]:stop]))
+            window_parts.append(np.full(stop - cursors[p], p, dtype=np.int64))
+            cursors[p] = stop
+
+        window_docs = np.concatenate(window_docs)
+        order = np.argsort(window_docs, kind='stable')
+        window_docs = window_docs[order]
+        in_prior = _sorted_contains(prior, window_docs).tolist()
+        doc_ids = window_docs.tolist()
+        parts = np.concatenate(window_parts)[order].tolist()
+        keys = np.concatenate(window_buckets)[order].tolist()
+
+        window_dropped = []
+        i = 0
+        while i < len(doc_ids):
+            doc_id = doc_ids[i]
+            j = i
+            while j < len(doc_ids) and doc_ids[j] == doc_id:
+                j += 1
+            if in_prior[i]:
+                pass  # already in `prior`
+            elif any(claimed[parts[k]][keys[k]] for k in range(i, j)):
+                window_dropped.append(doc_id)
+            else:
+                for k in range(i, j):
+                    claimed[parts[k]][keys[k]] = True
+            i = j
+        dropped.append(np.array(window_dropped, dtype=np.uint64))
+
+    dropped = np.unique(np.concatenate(dropped))
+    _save(dropped_path(work_dir), dropped)
+    return len(dropped)
+
+
+def index_survivors(work_dir, index_path, num_shards, num_partitions):
+    """
+    Appends the band keys of every document kept by `resolve` to the
+    persistent index, one segment per partition (partitions hold disjoint
+    keys), compacting once at the end. Returns the number of keys added.
+    """
+    dropped = _load_mapped(dropped_path(work_dir))
+    manifests = list(_manifests(work_dir, num_shards))
+    index = open_index(index_path)
+    added = 0
+    for partition in range(num_partitions):
+        keys = []
+        for manifest in manifests:
+            for path in manifest["spills"].get(str(partition), []):
+                records = _load(path)
+                keys.append(records[~_sorted_contains(dropped, records[:, 1]), 0])
+        if keys:
+            keys = np.concatenate(keys)
+            index.add_segment(bands=keys, compact=False)
+            added += len(keys)
+
+    if len(index.segments) > MAX_SEGMENTS:
+        index.compact()
+    return added
+
+
+def write_survivors(inputs, work_dir, output_path, metrics):
+    """
+    Copies every document not dropped by `resolve` to the output, in input
+    order. Returns (kept, skipped).
+    """
+    dropped = _load_mapped(dropped_path(work_dir))
+    kept = 0
+    skipped = 0
+    stats = {"bytes_in": 0}
+
+    with s3_open(output_path, 'w', encoding='utf-8') as fout:
+        for file_index, path in enumerate(inputs):
+            # Dropped doc indexes of this file only
+            start, end = np.searchsorted(dropped, np.array([file_index, file_index + 1], dtype=np.uint64)
+                                         << np.uint64(DOC_INDEX_BITS))
+            file_dropped = set((dropped[start:end] & np.uint64((1 << DOC_INDEX_BITS) - 1)).tolist())
+            with open_shard(path, 'r') as fin:
+                for doc_index, (metadata_lines, doc_lines) in enumerate(iter_documents(fin, stats)):
+                    if doc_index in file_dropped:
+                        skipped += 1
+                        continue
+                    metrics.bytes_out += write_document(fout, metadata_lines, doc_lines)
+                    kept += 1
+
+    metrics.bytes_in = stats["bytes_in"]
+    return kept, skipped
+
+
+def run_local(inputs, output_path, work_dir, workers, num_partitions, metrics, index_path=None):
+    """
+    All phases with a local process pool; returns (kept, skipped).
+    """
+    workers = max(1, workers)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        docs = sum(pool.map(map_shard, [inputs] * workers, range(workers), [workers] * workers,
+                            [work_dir] * workers, [num_partitions] * workers,
+                            [SPILL_RECORDS] * workers, [index_path] * workers))
+        collisions = sum(pool.map(reduce_partition, range(num_partitions),
+                                  [work_dir] * num_partitions, [workers] * num_partitions))
+    dropped = resolve(work_dir, num_partitions, workers)
+    print(f"🔗 {docs} docs, {collisions} bucket memberships in candidate clusters, {dropped} duplicates")
+    metrics.update(colliding_memberships=collisions)
+    metrics.extra.update(num_shards=workers, num_partitions=num_partitions)
+    result = write_survivors(inputs, work_dir, output_path, metrics)
+    if index_path:
+        index_survivors(work_dir, index_path, workers, num_partitions)
+        metrics.extra["lsh_index"] = open_index(index_path).stats()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--phase", choices=["map", "reduce", "resolve", "write", "index", "all"], default="all")
+    parser.add_argument("--input", default=INPUT_ROOT, help="s3:// prefix or local directory of _deduped files")
+    parser.add_argument("--output", default=FINAL_OUTPUT_PATH, help="s3:// or local output file")
+    parser.add_argument("--work_dir", default=WORK_DIR, help="s3:// prefix or local directory for spill files")
+    parser.add_argument("--shard_index", type=int, default=0, help="map: which input shard")
+    parser.add_argument("--num_shards", type=int, default=1, help="map/reduce: number of map shards")
+    parser.add_argument("--partition_index", type=int, default=0, help="reduce: which partition")
+    parser.add_argument("--num_partitions", type=int, default=16, help="band-key partitions")
+    parser.add_argument("--workers", type=int, default=available_cpus(), help="all: local processes")
+    parser.add_argument("--index_path", default=None,
+                        help="map/index/all: local (or shared filesystem) directory of a persistent LSH index")
+    args = parser.parse_args()
+
+    inputs = list_inputs(args.input, "_deduped", s3) if args.phase in ("map", "write", "all") else []
+
+    if args.phase == "map":
+        docs = map_shard(inputs, args.shard_index, args.num_shards, args.work_dir, args.num_partitions,
+                         index_path=args.index_path)
+        print(f"✅ Map shard {args.shard_index}: {docs} docs")
+    elif args.phase == "reduce":
+        collisions = reduce_partition(args.partition_index, args.work_dir, args.num_shards)
+        print(f"✅ Reduce partition {args.partition_index}: {collisions} colliding memberships")
+    elif args.phase == "resolve":
+        print(f"✅ Resolve: {resolve(args.work_dir, args.num_partitions, args.num_shards)} duplicates")
+    elif args.phase == "index":
+        added = index_survivors(args.work_dir, args.index_path, args.num_shards, args.num_partitions)
+        print(f"✅ Index: {added} band keys appended to {args.index_path}")
+    else:
+        metrics = StageMetrics("global_deduplicate", FINAL_OUTPUT_KEY)
+        if args.phase == "all":
+            kept, skipped = run_local(inputs, args.output, args.work_dir, args.workers,
+                                      args.num_partitions, metrics, args.index_path)
+        else:
+            kept, skipped = write_survivors(inputs, args.work_dir, args.output, metrics)
+        metrics.records = kept + skipped
+        metrics.update(unique_docs=kept, duplicates_removed=skipped)
+        metrics.extra["mode"] = "distributed"
+        metrics.write()
+        print(f"✅ Global deduplication complete: {args.output} | Unique docs: {kept}, Duplicates: {skipped}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,112 +3,188 @@ Module: global_deduplicate.py
 
 Globally deduplicates across all deduped files by combining them
 and applying MinHash/LSH deduplication.
+
+Documents are visited in sorted file order; a document is dropped if it
+shares an LSH bucket with an earlier kept document. `--mode serial` keeps
+one in-memory MinHashLSH; `--mode distributed` runs the same decision as
+map/reduce phases with spill files (see distributed_lsh.py), so the corpus
+is not bounded by one process's memory or one core. With --index_path,
+documents of earlier runs recorded in a persistent LSH index count as
+earlier kept documents, and this run's kept documents are appended to it.
 """
 
+import argparse
 import hashlib
-from datasketch import MinHash, MinHashLSH
+from datasketch import MinHashLSH
 import boto3
 from smart_open import open as s3_open
+from common.shards import open_shard
+from common.work import list_inputs
+from common.metrics import StageMetrics, utf8_len
+from common.minhash import MinHashEngine
+from common.lsh_index import PersistentLSHIndex
+from common.parallel import available_cpus
 
 # S3 config
 BUCKET = "my-cc-pipeline-s3"
 DEDUPED_PREFIX = "deduplicated/"
 FINAL_OUTPUT_KEY = "final/global_deduplicated.txt"
 FINAL_OUTPUT_PATH = f"s3://{BUCKET}/{FINAL_OUTPUT_KEY}"
+INPUT_ROOT = f"s3://{BUCKET}/{DEDUPED_PREFIX}"
+WORK_DIR = f"s3://{BUCKET}/tmp/global_dedup"
 
 s3 = boto3.client('s3')
 
 # Parameters
 NUM_PERM = 128
 SIMILARITY_THRESHOLD = 0.8
+MINHASH_ENGINE = MinHashEngine(NUM_PERM)
 
 # Utility
 def get_minhash(text):
-    m = MinHash(num_perm=NUM_PERM)
-    for word in text.split():
-        m.update(word.encode('utf-8'))
-    return m
+    return MINHASH_ENGINE.minhashes([text])[0]
 
 def is_special_line(line):
     return line.startswith("[DOC_START]") or line.startswith("URL:")
 
-# Initialize LSH
-lsh = MinHashLSH(threshold=SIMILARITY_THRESHOLD, num_perm=NUM_PERM)
 
-kept = 0
-skipped = 0
+def iter_documents(fin, stats=None):
+    """
+    Splits a deduped file into documents.
 
-with s3_open(FINAL_OUTPUT_PATH, 'w', encoding='utf-8') as fout:
-    response = s3.list_objects_v2(Bucket=BUCKET, Prefix=DEDUPED_PREFIX)
+    Yields:
+        tuple: (metadata lines, content lines) for every document with
+        content, in file order. Metadata is the [DOC_START] line and its
+        URL: lines.
+    """
+    doc_lines = []
+    metadata_lines = []
 
-    for obj in response.get('Contents', []):
-        s3_key = obj['Key']
-        if not s3_key.endswith("_deduped.txt"):
+    for line in fin:
+        if stats is not None:
+            stats["bytes_in"] += utf8_len(line)
+        line = line.strip()
+        if not line:
             continue
 
-        input_path = f"s3://{BUCKET}/{s3_key}"
+        if line == "[DOC_START]":
+            if doc_lines:
+                yield metadata_lines, doc_lines
+            metadata_lines = [line]
+            doc_lines = []
 
-        with s3_open(input_path, 'r', encoding='utf-8') as fin:
+        elif line.startswith("URL:"):
+            metadata_lines.append(line)
 
-            doc_lines = []
-            metadata_lines = []
+        else:
+            doc_lines.append(line)
 
-            for line in fin:
-                line = line.strip()
-                if not line:
-                    continue
+    # Handle last doc in file
+    if doc_lines:
+        yield metadata_lines, doc_lines
 
-                if line == "[DOC_START]":
 
-                    if doc_lines:
-                        text = " ".join(doc_lines)
-                        minhash = get_minhash(text)
-                        key = hashlib.md5(text.encode('utf-8')).hexdigest()
+def document_lines(metadata_lines, doc_lines):
+    """
+    Output lines of one document: metadata, content, then a blank line.
+    """
+    for line in metadata_lines + doc_lines:
+        yield line + "\n"
+    yield "\n"
 
-                        if not lsh.query(minhash):
-                            lsh.insert(key, minhash)
-                            for meta in metadata_lines:
-                                fout.write(meta + "\n")
-                            for content_line in doc_lines:
-                                fout.write(content_line + "\n")
-                            fout.write("\n")
-                            kept += 1
-                        else:
-                            skipped += 1
 
-                    metadata_lines = [line]
-                    doc_lines = []
+def write_document(fout, metadata_lines, doc_lines):
+    written = 0
+    for line in document_lines(metadata_lines, doc_lines):
+        fout.write(line)
+        written += utf8_len(line)
+    return written
 
-                elif line.startswith("URL:"):
-                    metadata_lines.append(line)
 
-                else:
-                    doc_lines.append(line)
+def deduplicate_documents(inputs, metrics, index=None):
+    """
+    One MinHashLSH over every document of `inputs`, in order, or the
+    persistent `index` when given. Yields the output lines of the kept
+    documents; `metrics` is filled in once the generator is exhausted.
+    """
+    lsh = index if index is not None else MinHashLSH(threshold=SIMILARITY_THRESHOLD, num_perm=NUM_PERM)
+    kept = 0
+    skipped = 0
+    stats = {"bytes_in": 0}
 
-            # Handle last doc in file
-            if doc_lines:
+    for input_path in inputs:
+        with open_shard(input_path, 'r') as fin:
+            for metadata_lines, doc_lines in iter_documents(fin, stats):
                 text = " ".join(doc_lines)
                 minhash = get_minhash(text)
                 key = hashlib.md5(text.encode('utf-8')).hexdigest()
 
                 if not lsh.query(minhash):
                     lsh.insert(key, minhash)
-                    for meta in metadata_lines:
-                        fout.write(meta + "\n")
-                    for content_line in doc_lines:
-                        fout.write(content_line + "\n")
-                    fout.write("\n")
+                    for line in document_lines(metadata_lines, doc_lines):
+                        metrics.bytes_out += utf8_len(line)
+                        yield line
                     kept += 1
                 else:
                     skipped += 1
 
-print(f"✅ Global deduplication complete: s3://{BUCKET}/{FINAL_OUTPUT_KEY}")
-
-# Write log to S3
-log_path = "s3://my-cc-pipeline-s3/logs/global_deduplicated_log.txt"
-log_entry = f"{FINAL_OUTPUT_KEY} | Unique docs: {kept}, Duplicates removed: {skipped}\n"
-
-with s3_open(log_path, 'w', encoding='utf-8') as log_file:
-    log_file.write(log_entry)
-
-
+    metrics.bytes_in = stats["bytes_in"]
+    metrics.records = kept + skipped
+    metrics.update(unique_docs=kept, duplicates_removed=skipped)
+
+
+def deduplicate_serial(inputs, output_path, metrics, index=None):
+    """
+    Writes the documents kept by `deduplicate_documents`; returns (kept,
+    skipped).
+    """
+    with s3_open(output_path, 'w', encoding='utf-8') as fout:
+        for line in deduplicate_documents(inputs, metrics, index):
+            fout.write(line)
+    return metrics.counts["unique_docs"], metrics.counts["duplicates_removed"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["serial", "distributed"], default="serial")
+    parser.add_argument("--input", default=INPUT_ROOT,
+                        help="s3:// prefix or local directory of _deduped files")
+    parser.add_argument("--output", default=FINAL_OUTPUT_PATH, help="s3:// or local output file")
+    parser.add_argument("--work_dir", default=WORK_DIR,
+                        help="Distributed mode: s3:// prefix or local directory for spill files")
+    parser.add_argument("--workers", type=int, default=available_cpus(),
+                        help="Distributed mode: local map/reduce processes")
+    parser.add_argument("--num_partitions", type=int, default=None,
+                        help="Distributed mode: band-key partitions (default: 4 per worker)")
+    parser.add_argument("--index_path", default=None,
+                        help="Local directory of a persistent LSH index of earlier runs (shared "
+                             "filesystem for distributed jobs); kept documents are appended to it")
+    args = parser.parse_args()
+
+    inputs = list_inputs(args.input, "_deduped", s3)
+    metrics = StageMetrics("global_deduplicate", FINAL_OUTPUT_KEY)
+
+    if args.mode == "distributed":
+        from deduplication.distributed_lsh import run_local
+        kept, skipped = run_local(inputs, args.output, args.work_dir, args.workers,
+                                  args.num_partitions or 4 * args.workers, metrics, args.index_path)
+        metrics.records = kept + skipped
+        metrics.update(unique_docs=kept, duplicates_removed=skipped)
+    else:
+        index = None
+        if args.index_path:
+            index = PersistentLSHIndex(args.index_path, SIMILARITY_THRESHOLD, MINHASH_ENGINE)
+        kept, skipped = deduplicate_serial(inputs, args.output, metrics, index)
+        if index is not None:
+            index.flush()
+            metrics.extra["lsh_index"] = index.stats()
+
+    print(f"✅ Global deduplication complete: {args.output} | Unique docs: {kept}, Duplicates: {skipped}")
+
+    # Write metrics record to S3
+    metrics.extra["mode"] = args.mode
+    metrics.write()
+
+
+if __name__ == "__main__":
+    main()
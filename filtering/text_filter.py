@@ -8,13 +8,25 @@ directory for downstream preprocessing steps. Incorporate jusText to
 retain main body content only.
 """
 
-import unicodedata
-import re
+import argparse
+import html
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache, partial
+from itertools import islice
 import fasttext
 import justext
 from hydra import initialize, compose
-from smart_open import open as s3_open
 import boto3
+from common.keyword_matcher import KeywordMatcher
+from common.shards import open_shard
+from common.work import add_work_arguments, resolve_keys
+from common.metrics import StageMetrics, utf8_len
+from common.batching import predict_in_order
+from common.parallel import available_cpus, bounded_map
+from common.decision_cache import DecisionCache
+from common import text_clean
 
 s3 = boto3.client('s3')
 BUCKET = "my-cc-pipeline-s3"
@@ -32,17 +44,30 @@ model = fasttext.load_model("models/lid.176.bin")
 S3_EXTRACTED_PREFIX = "s3://my-cc-pipeline-s3/extracted/"
 S3_FILTERED_PREFIX = "s3://my-cc-pipeline-s3/filtered/"
 
-# Parameters
-TARGET_LANG = "en"
-CONFIDENCE_THRESHOLD = 0.5
+# Parameters (language settings can be overridden under `language:` in the config)
+language_cfg = cfg.get("language", {})
+TARGET_LANG = language_cfg.get("target_lang", "en")
+CONFIDENCE_THRESHOLD = language_cfg.get("line_threshold", 0.5)
+DOC_CONFIDENCE_THRESHOLD = language_cfg.get("doc_threshold", 0.8)
+DOC_SAMPLE_CHARS = language_cfg.get("doc_sample_chars", 2000)
+LANG_MODE = language_cfg.get("mode", "line")
+LANG_BATCH_SIZE = language_cfg.get("batch_size", 512)
 MIN_LENGTH = 5
 
-# Cleaning patterns
-url_pattern = re.compile(r'(https?://\S+|www\.\S+)', re.IGNORECASE)
-code_pattern = re.compile(r'`[^`]+`|```[\s\S]+?```', re.IGNORECASE)
-html_tag_pattern = re.compile(r'<[^>]+>')
-non_printable_pattern = re.compile(r'[^\x20-\x7E]+')
+# Main-content (jusText) extraction
+STOPLIST_LANGUAGE = "English"
+CONTENT_DOCS_PER_TASK = 16
+
+# Memory budget for the repeated-line caches (cleaning outcomes and language
+# predictions), shared by every file a worker processes
+DECISION_CACHE_MB = 256
+
+# Outcomes of cleaning one raw line
+LINE_EMPTY, LINE_SPECIAL, LINE_CUTOFF, LINE_SHORT, LINE_TEXT = range(5)
+
+# Cleaning patterns (see common/text_clean.py)
 boilerplate_phrases = cfg.filters.boilerplate_phrases
+boilerplate_matcher = KeywordMatcher(boilerplate_phrases)
 section_cutoff_phrases = [phrase.lower() for phrase in cfg.filters.section_cutoff_phrases]
 
 
@@ -78,17 +103,14 @@ def clean_unicode(text):
     Returns:
         str: Cleaned text.
     """
-    text = text.replace('\u2028', ' ').replace('\u2029', ' ')
-    text = text.replace('“', '"').replace('”', '"').replace("‘", "'").replace("’", "'")
-    text = text.replace("–", "-").replace("—", "-")
-    return unicodedata.normalize('NFKC', text)
+    return text_clean.clean_unicode(text)
 
 
 def contains_boilerplate(text):
     """
     Checks if a line contains any boilerplate phrase.
     """
-    return any(phrase.lower() in text.lower() for phrase in boilerplate_phrases)
+    return boilerplate_matcher.any_match(text)
 
 
 def clean_line(text):
@@ -101,11 +123,11 @@ def clean_line(text):
     Returns:
         str: Cleaned text with unwanted elements removed.
     """
-    text = url_pattern.sub('', text)
-    text = code_pattern.sub('', text)
-    text = html_tag_pattern.sub('', text)
-    text = non_printable_pattern.sub('', text)
-    text = ' '.join(text.split())
+    text = text_clean.remove_urls(text)
+    text = text_clean.remove_code(text)
+    text = text_clean.remove_html_tags(text)
+    text = text_clean.remove_non_printable(text)
+    text = text_clean.collapse_whitespace(text)
 
     if contains_boilerplate(text):
         return ''
@@ -115,97 +137,497 @@ def clean_line(text):
 
 def normalize_text(text):
     text = clean_unicode(text)
-    text = url_pattern.sub('', text)
-    text = html_tag_pattern.sub('', text)
-    text = non_printable_pattern.sub('', text)
-    text = ' '.join(text.split())
-    text = text.lower().strip()
-    return text
+    text = text_clean.remove_urls(text)
+    text = text_clean.remove_html_tags(text)
+    text = text_clean.remove_non_printable(text)
+    text = text_clean.collapse_whitespace(text)
+    return text.lower()
+
+
+@lru_cache(maxsize=None)
+def get_stoplist(language=STOPLIST_LANGUAGE):
+    """
+    jusText stoplist, loaded once per process.
+    """
+    return frozenset(justext.get_stoplist(language))
 
 
 def extract_main_content(text):
     """
     Use jusText to extract the main body content from HTML/text.
+
+    WET text is always plain text, so every line is escaped (a literal
+    "<", as in "< 5 mm", is text, not markup) and wrapped as its own
+    paragraph, letting jusText classify each line instead of the whole
+    page at once.
     """
-    paragraphs = justext.justext(text, justext.get_stoplist("English"))
+    text = "".join(f"<p>{html.escape(line)}</p>" for line in text.splitlines() if line.strip())
+    if not text:
+        return ""
+    paragraphs = justext.justext(text, get_stoplist())
     cleaned = "\n".join(p.text for p in paragraphs if not p.is_boilerplate)
     return cleaned.strip()
 
 
+def split_raw_documents(fin):
+    """
+    Groups raw input lines into [DOC_START] documents.
+    """
+    doc = []
+    for line in fin:
+        if line.strip() == "[DOC_START]" and doc:
+            yield doc
+            doc = []
+        doc.append(line)
+    if doc:
+        yield doc
+
+
+def main_content_lines(doc):
+    """
+    Keeps a document's [DOC_START]/URL header lines and replaces its body
+    with the jusText main content. Returns (lines, body lines removed).
+    """
+    header = []
+    body = []
+    for line in doc:
+        stripped = line.strip()
+        if not body and (stripped == "[DOC_START]" or stripped.startswith("URL: ")):
+            header.append(line)
+        else:
+            body.append(line)
+
+    if not body:
+        return header, 0
+
+    content = extract_main_content("".join(body)).splitlines()
+    removed = sum(1 for line in body if line.strip()) - len(content)
+    return header + [line + "\n" for line in content], max(removed, 0)
+
+
+def main_content_batch(docs):
+    """
+    Pool task: main-content extraction for a batch of documents.
+    """
+    return [main_content_lines(doc) for doc in docs]
+
+
+def iter_main_content(fin, pool, workers, stats):
+    """
+    Streams a file's lines through per-document main-content extraction in
+    `pool`, keeping at most two batches per worker in flight and yielding
+    lines in input order.
+    """
+    docs = split_raw_documents(fin)
+    batches = iter(lambda: list(islice(docs, CONTENT_DOCS_PER_TASK)), [])
+
+    for results in bounded_map(pool, main_content_batch, batches, 2 * workers):
+        for lines, removed in results:
+            stats["docs_main_content"] += 1
+            stats["main_content_lines_removed"] += removed
+            yield from lines
+
+
 def is_special_line(line):
     return line == "[DOC_START]" or line.startswith("URL: ")
 
 
-def filter_file(s3_key):
+def detect_languages(texts):
     """
-    Filters and cleans lines in a file and saves the cleaned English lines.
+    Batched language ID: one fastText call for a list of texts.
 
     Args:
-        file_path (Path): Path to the raw input text file.
+        texts (list[str]): Single-line input texts.
+
+    Returns:
+        list[tuple]: (language code, confidence) per text, in order.
     """
-    input_path = f"s3://{BUCKET}/{s3_key}"
-    output_key = s3_key.replace("extracted/", "filtered/").replace("_extracted", "_filtered")
-    output_path = f"s3://{BUCKET}/{output_key}"
+    labels, probs = model.predict(texts)
+    return [(label[0].replace("__label__", ""), prob[0]) for label, prob in zip(labels, probs)]
 
-    kept = 0
-    skipped = 0
+
+def classify_line(raw):
+    """
+    Unicode and line cleaning for one raw line, independent of its position
+    in the file.
+
+    Returns:
+        tuple: (outcome, text); text is the cleaned line for LINE_TEXT and
+        the metadata line for LINE_SPECIAL, otherwise None.
+    """
+    line = clean_unicode(raw.strip())
+    if not line:
+        return LINE_EMPTY, None
+
+    # Preserve metadata lines as-is
+    if is_special_line(line):
+        return LINE_SPECIAL, line
+
+    # Check for section cutoff phrase
+    if check_section_cutoff(line):
+        return LINE_CUTOFF, None
+
+    cleaned_line = clean_line(line)
+    if not cleaned_line or len(cleaned_line) < MIN_LENGTH:
+        return LINE_SHORT, None
+
+    return LINE_TEXT, cleaned_line
+
+
+def clean_lines(fin, stats, cache=None):
+    """
+    Applies unicode and line cleaning, the section cutoff and the minimum
+    length check to the lines of a file.
+
+    Args:
+        fin: Iterable of raw input lines.
+        stats (dict): Counters updated in place (lines_in, bytes_in, skipped).
+        cache (DecisionCache): Optional cache of `classify_line` outcomes
+            keyed on the raw line itself, so repeated boilerplate is
+            cleaned only once.
+
+    Yields:
+        tuple: (line, is_special) for every line that survives, in order.
+    """
     in_cutoff_section = False
 
-    with s3_open(input_path, 'r', encoding='utf-8') as fin, \
-         s3_open(output_path, 'w', encoding='utf-8') as fout:
-        for i, line in enumerate(fin):
-            line = clean_unicode(line.strip())
-            if not line:
-                continue
-
-            if in_cutoff_section:
-                skipped += 1
-                continue
-
-            # Preserve metadata lines as-is
-            if is_special_line(line):
-                fout.write(line + '\n')
-                continue
-
-            # Check for section cutoff phrase
-            if check_section_cutoff(line):
-                in_cutoff_section = True
-                skipped += 1
-                continue
-
-            cleaned_line = clean_line(line)
-
-            if not cleaned_line or len(cleaned_line) < MIN_LENGTH:
-                skipped += 1
-                continue
-
-            lang, prob = detect_language(cleaned_line)
-            if lang == TARGET_LANG and prob >= CONFIDENCE_THRESHOLD:
-                fout.write(cleaned_line + '\n')
-                kept += 1
+    for line in fin:
+        stats["lines_in"] += 1
+        stats["bytes_in"] += utf8_len(line)
+
+        if in_cutoff_section:
+            if line.strip():
+                stats["skipped"] += 1
+            continue
+
+        if cache is None:
+            outcome, text = classify_line(line)
+        else:
+            entry = cache.get(line)
+            if entry is None:
+                entry = classify_line(line)
+                cache.put(line, entry)
+            outcome, text = entry
+
+        if outcome == LINE_TEXT:
+            yield text, False
+        elif outcome == LINE_SPECIAL:
+            yield text, True
+        elif outcome == LINE_CUTOFF:
+            in_cutoff_section = True
+            stats["skipped"] += 1
+        elif outcome == LINE_SHORT:
+            stats["skipped"] += 1
+
+
+@dataclass
+class LanguageSettings:
+    """
+    Language ID settings for one run of the filter stage.
+
+    mode "line" checks every line; mode "document" checks a prefix of each
+    [DOC_START] document once and keeps or drops it whole, falling back to
+    line checks only when the document-level confidence is below
+    `doc_threshold` (mixed or uncertain language).
+    """
+    mode: str = LANG_MODE
+    target_lang: str = TARGET_LANG
+    line_threshold: float = CONFIDENCE_THRESHOLD
+    doc_threshold: float = DOC_CONFIDENCE_THRESHOLD
+    doc_sample_chars: int = DOC_SAMPLE_CHARS
+    batch_size: int = LANG_BATCH_SIZE
+
+
+def group_documents(lines):
+    """
+    Groups cleaned (line, is_special) pairs into [DOC_START] documents,
+    keeping each document's lines in their original order.
+    """
+    doc = []
+    for line, is_special in lines:
+        if line == "[DOC_START]" and doc:
+            yield doc
+            doc = []
+        doc.append((line, is_special))
+    if doc:
+        yield doc
+
+
+def document_sample(doc, max_chars):
+    """
+    The first `max_chars` characters of a document's content lines, or None
+    if it has no content.
+    """
+    parts = []
+    size = 0
+    for line, is_special in doc:
+        if is_special:
+            continue
+        parts.append(line)
+        size += len(line) + 1
+        if size >= max_chars:
+            break
+    return " ".join(parts)[:max_chars] or None
+
+
+def line_language_filter(lines, predict, settings, stats):
+    """
+    Per-line language ID. Yields (line, is_content) for lines to write.
+    """
+    items = ((line, None if is_special else line) for line, is_special in lines)
+    for line, prediction in predict_in_order(items, predict, settings.batch_size):
+        if prediction is None:
+            yield line, False
+            continue
+
+        lang, prob = prediction
+        if lang == settings.target_lang and prob >= settings.line_threshold:
+            yield line, True
+        else:
+            stats["skipped"] += 1
+
+
+def document_language_filter(lines, predict, settings, stats, predict_docs=None):
+    """
+    Document-level language ID with line-level fallback for mixed documents.
+    Document samples go through `predict_docs` (default: `predict`). Yields
+    (line, is_content) for lines to write.
+    """
+    docs = ((doc, document_sample(doc, settings.doc_sample_chars)) for doc in group_documents(lines))
+
+    def expand():
+        for doc, prediction in predict_in_order(docs, predict_docs or predict, settings.batch_size):
+            if prediction is None:
+                verdict = "empty"
             else:
-                skipped += 1
+                lang, prob = prediction
+                if prob < settings.doc_threshold:
+                    verdict = "mixed"
+                elif lang == settings.target_lang:
+                    verdict = "keep"
+                else:
+                    verdict = "drop"
+            stats[f"docs_{verdict}"] += 1
+
+            for line, is_special in doc:
+                if is_special:
+                    yield (line, False), None
+                elif verdict == "keep":
+                    yield (line, True), None
+                elif verdict == "drop":
+                    stats["skipped"] += 1
+                else:
+                    yield (line, True), line
+
+    for (line, is_content), prediction in predict_in_order(expand(), predict, settings.batch_size):
+        if prediction is None:
+            yield line, is_content
+            continue
+
+        lang, prob = prediction
+        if lang == settings.target_lang and prob >= settings.line_threshold:
+            yield line, True
+        else:
+            stats["skipped"] += 1
+
+
+def cached_predict(texts, cache):
+    """
+    Language predictions for `texts`, running fastText only on texts not
+    in `cache`. Returns (predictions, number of texts predicted).
+    """
+    predictions = [cache.get(text) for text in texts]
+    missing = [i for i, prediction in enumerate(predictions) if prediction is None]
+    if missing:
+        for i, prediction in zip(missing, detect_languages([texts[i] for i in missing])):
+            predictions[i] = prediction
+            cache.put(texts[i], prediction)
+    return predictions, len(missing)
+
+
+def make_caches(budget_mb, mode=LANG_MODE):
+    """
+    Line-cleaning, line-language and document-language caches sharing
+    `budget_mb`: half for cleaning outcomes, the other half for language
+    predictions, split evenly between line texts and document samples in
+    document mode (no document cache in line mode). Document samples get
+    their own cache so a few long samples cannot evict many line entries.
+    Returns (None, None, None) when caching is disabled.
+    """
+    if budget_mb <= 0:
+        return None, None, None
+    half = budget_mb * 1024 * 1024 // 2
+    if mode != "document":
+        return DecisionCache(half), DecisionCache(half), None
+    return DecisionCache(half), DecisionCache(half // 2), DecisionCache(half // 2)
+
 
+def cache_counts(cache):
+    return (cache.hits, cache.misses) if cache is not None else (0, 0)
 
-    # ✅ Log to S3 after processing the entire file
-    log_path = "s3://my-cc-pipeline-s3/logs/filtered_log.txt"
-    log_entry = f"{s3_key} | Kept: {kept}, Skipped: {skipped}\n"
 
-    with s3_open(log_path, 'w', encoding='utf-8') as log_file:
-        log_file.write(log_entry)
+def filter_lines(fin, metrics, settings=None, content_pool=None, content_workers=1,
+                 line_cache=None, lang_cache=None, doc_cache=None):
+    """
+    Filters and cleans the lines of one file. Language ID runs on batches of
+    texts; output order is the same as in the input.
+
+    Args:
+        fin: Iterable of raw input lines.
+        metrics (StageMetrics): Filled in with the file's counts once the
+            generator is exhausted.
+        settings (LanguageSettings): Language ID mode, thresholds and batch size.
+        content_pool (ProcessPoolExecutor): If given, run jusText main-content
+            extraction per document in this pool before line filtering.
+        content_workers (int): Number of processes in `content_pool`.
+        line_cache (DecisionCache): Cleaning outcomes of repeated raw lines.
+        lang_cache (DecisionCache): Language predictions of repeated lines.
+        doc_cache (DecisionCache): Language predictions of repeated
+            document samples (document mode).
+
+    Yields:
+        str: Output lines, newline-terminated.
+    """
+    settings = settings or LanguageSettings()
+    kept = 0
+    bytes_out = 0
+    stats = defaultdict(int)
+
+    caches = (("line_cache", line_cache), ("lang_cache", lang_cache), ("doc_cache", doc_cache))
+    before = {name: cache_counts(cache) for name, cache in caches}
+
+    def predictor(cache):
+        def predict(texts):
+            if cache is None:
+                stats["lang_calls"] += 1
+                stats["lang_predictions"] += len(texts)
+                return detect_languages(texts)
+            predictions, predicted = cached_predict(texts, cache)
+            if predicted:
+                stats["lang_calls"] += 1
+                stats["lang_predictions"] += predicted
+            return predictions
+        return predict
+
+    if settings.mode == "document":
+        language_filter = partial(document_language_filter, predict_docs=predictor(doc_cache))
+    else:
+        language_filter = line_language_filter
+
+    lines = iter_main_content(fin, content_pool, content_workers, stats) if content_pool else fin
+    cleaned = clean_lines(lines, stats, line_cache)
+    for line, is_content in language_filter(cleaned, predictor(lang_cache), settings, stats):
+        yield line + '\n'
+        if is_content:
+            bytes_out += len(line) + 1
+            kept += 1
+        else:
+            bytes_out += utf8_len(line) + 1
+
+    skipped = stats.pop("skipped", 0)
+    metrics.records = stats.pop("lines_in", 0)
+    metrics.bytes_in = stats.pop("bytes_in", 0)
+    metrics.bytes_out = bytes_out
+    metrics.update(kept=kept, skipped=skipped, **stats)
+    metrics.extra["language"] = vars(settings)
+    for name, cache in caches:
+        if cache is None:
+            continue
+        hits = cache.hits - before[name][0]
+        lookups = hits + cache.misses - before[name][1]
+        metrics.update(**{f"{name}_hits": hits, f"{name}_lookups": lookups})
+        metrics.extra[name] = dict(cache.stats(), hit_rate=round(hits / lookups, 4) if lookups else None)
+
+
+def output_key_for(s3_key):
+    return s3_key.replace("extracted/", "filtered/").replace("_extracted", "_filtered")
+
+
+def report_file(metrics, output_path):
+    """
+    Writes a file's metrics record and prints its summary.
+    """
+    record = metrics.write()
+    counts = metrics.counts
+    cache_note = ""
+    if "line_cache" in metrics.extra:
+        cache_note = f", line cache hit rate {metrics.extra['line_cache']['hit_rate']}"
+    print(f"✅ Done: {output_path} | Kept: {counts['kept']}, Skipped: {counts['skipped']}, "
+          f"{counts['lang_predictions']} language predictions{cache_note}, {record['records_per_sec']} lines/sec\n")
+
+
+def filter_file(s3_key, settings=None, content_pool=None, content_workers=1,
+                line_cache=None, lang_cache=None, doc_cache=None):
+    """
+    Filters and cleans lines in a file and saves the cleaned lines in the
+    target language (see `filter_lines`).
+
+    Args:
+        s3_key (str): Key of the extracted input file.
+    """
+    input_path = f"s3://{BUCKET}/{s3_key}"
+    output_path = f"s3://{BUCKET}/{output_key_for(s3_key)}"
+    metrics = StageMetrics("text_filter", s3_key)
+
+    with open_shard(input_path, 'r') as fin, \
+         open_shard(output_path, 'w') as fout:
+        for line in filter_lines(fin, metrics, settings, content_pool, content_workers,
+                                 line_cache, lang_cache, doc_cache):
+            fout.write(line)
 
-    print(f"✅ Done: {output_path} | Kept: {kept}, Skipped: {skipped}\n")
+    # ✅ Log this file's metrics record after processing the entire file
+    report_file(metrics, output_path)
 
 
 def main():
     """
     Main function to iterate over extracted raw text files and filter them.
     """
-    response = s3.list_objects_v2(Bucket=BUCKET, Prefix=EXTRACTED_PREFIX)
-    for obj in response.get('Contents', []):
-        s3_key = obj['Key']
-        if s3_key.endswith('_extracted.txt'):
-            filter_file(s3_key)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lang_mode", choices=["line", "document"], default=LANG_MODE,
+                        help="Language ID per line, or once per document with line fallback")
+    parser.add_argument("--target_lang", default=TARGET_LANG)
+    parser.add_argument("--lang_threshold", type=float, default=CONFIDENCE_THRESHOLD,
+                        help="Minimum line-level confidence for the target language")
+    parser.add_argument("--doc_lang_threshold", type=float, default=DOC_CONFIDENCE_THRESHOLD,
+                        help="Document-level confidence needed to keep/drop a document whole")
+    parser.add_argument("--doc_sample_chars", type=int, default=DOC_SAMPLE_CHARS,
+                        help="Characters of each document used for document-level language ID")
+    parser.add_argument("--lang_batch_size", type=int, default=LANG_BATCH_SIZE,
+                        help="Texts per fastText call (1 = per-line mode)")
+    parser.add_argument("--main_content", action="store_true",
+                        help="Keep only jusText main content of each document before line filtering")
+    parser.add_argument("--content_workers", type=int, default=available_cpus(),
+                        help="Processes for main-content extraction")
+    parser.add_argument("--cache_mb", type=int, default=DECISION_CACHE_MB,
+                        help="Memory budget for the repeated-line caches (0 disables them): half for "
+                             "cleaning outcomes, half for language predictions, which --lang_mode "
+                             "document splits evenly between lines and document samples")
+    add_work_arguments(parser)
+    args = parser.parse_args()
+
+    settings = LanguageSettings(
+        mode=args.lang_mode,
+        target_lang=args.target_lang,
+        line_threshold=args.lang_threshold,
+        doc_threshold=args.doc_lang_threshold,
+        doc_sample_chars=args.doc_sample_chars,
+        batch_size=args.lang_batch_size,
+    )
+
+    line_cache, lang_cache, doc_cache = make_caches(args.cache_mb, settings.mode)
+
+    content_pool = None
+    if args.main_content:
+        get_stoplist()  # load before forking so workers inherit it
+        content_pool = ProcessPoolExecutor(max_workers=args.content_workers)
+
+    try:
+        for s3_key in resolve_keys(args, s3, BUCKET, EXTRACTED_PREFIX, "_extracted"):
+            filter_file(s3_key, settings, content_pool, args.content_workers, line_cache, lang_cache, doc_cache)
+    finally:
+        if content_pool:
+            content_pool.shutdown()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,170 @@
+"""
+Module: toxicity_backends.py
+
+CPU inference backends for the Detoxify toxicity model used by
+toxicity_filter.py:
+
+- torch: the fp32 PyTorch model as shipped by Detoxify
+- quantized: the same model with its Linear layers dynamically quantized
+  to int8
+- onnx: the model exported to an ONNX graph and run with ONNX Runtime
+
+Every backend exposes `score(texts) -> list[float]` with the toxicity
+probability per text, and `set_threads(threads)` to change its intra-op
+thread count in the current process (e.g. in a forked worker). Compare them on a sample with
+benchmarks/bench_toxicity_backends.py before switching a run.
+"""
+
+import json
+import os
+import numpy as np
+import torch
+from detoxify import Detoxify
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+BACKENDS = ("torch", "quantized", "onnx")
+DETOXIFY_MODEL = "original"
+
+# Exported graph plus the tokenizer and class names it needs, so the ONNX
+# backend never loads the PyTorch weights once exported
+ONNX_DIR = "models/detoxify-original-onnx"
+ONNX_FILE = "model.onnx"
+ONNX_META_FILE = "detoxify.json"
+ONNX_OPSET = 14
+ONNX_INPUTS = ("input_ids", "attention_mask", "token_type_ids")
+
+
+class TorchBackend:
+    """
+    Detoxify's fp32 PyTorch model.
+    """
+    name = "torch"
+
+    def __init__(self, detox=None):
+        self.detox = detox or Detoxify(DETOXIFY_MODEL)
+        self.detox.model.eval()
+
+    def set_threads(self, threads):
+        torch.set_num_threads(threads)
+
+    def score(self, texts):
+        with torch.inference_mode():
+            return [float(score) for score in self.detox.predict(list(texts))["toxicity"]]
+
+
+class QuantizedBackend(TorchBackend):
+    """
+    Detoxify with dynamic int8 quantization of its Linear layers: weights
+    are stored as int8, activations are quantized on the fly per batch.
+    """
+    name = "quantized"
+
+    def __init__(self, detox=None):
+        super().__init__(detox)
+        self.detox.model = torch.ao.quantization.quantize_dynamic(
+            self.detox.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+
+
+class _Logits(torch.nn.Module):
+    """
+    Export wrapper returning the raw logits tensor with fixed input names.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, token_type_ids):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask,
+                          token_type_ids=token_type_ids)[0]
+
+
+def export_onnx(onnx_dir=ONNX_DIR, detox=None):
+    """
+    Exports Detoxify's model to `onnx_dir` with dynamic batch and sequence
+    axes, next to its tokenizer and class names.
+    """
+    detox = detox or Detoxify(DETOXIFY_MODEL)
+    os.makedirs(onnx_dir, exist_ok=True)
+
+    sample = detox.tokenizer(["an example sentence for export", "another"],
+                             return_tensors="pt", truncation=True, padding=True)
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in ONNX_INPUTS}
+    dynamic_axes["logits"] = {0: "batch"}
+
+    with torch.inference_mode():
+        torch.onnx.export(
+            _Logits(detox.model.eval()),
+            tuple(sample[name] for name in ONNX_INPUTS),
+            os.path.join(onnx_dir, ONNX_FILE),
+            input_names=list(ONNX_INPUTS),
+            output_names=["logits"],
+            dynamic_axes=dynamic_axes,
+            opset_version=ONNX_OPSET,
+        )
+
+    detox.tokenizer.save_pretrained(onnx_dir)
+    with open(os.path.join(onnx_dir, ONNX_META_FILE), 'w', encoding='utf-8') as f:
+        json.dump({"model": DETOXIFY_MODEL, "class_names": list(detox.class_names)}, f)
+    print(f"✅ Exported Detoxify '{DETOXIFY_MODEL}' to {onnx_dir}")
+
+
+class OnnxBackend:
+    """
+    The exported graph under ONNX Runtime's CPU provider. Exports it first
+    if `onnx_dir` does not contain it yet.
+    """
+    name = "onnx"
+
+    def __init__(self, onnx_dir=ONNX_DIR, threads=None):
+        if onnxruntime is None:
+            raise ImportError("the onnx toxicity backend requires the `onnxruntime` package")
+        from transformers import AutoTokenizer
+
+        model_path = os.path.join(onnx_dir, ONNX_FILE)
+        if not os.path.exists(model_path):
+            export_onnx(onnx_dir)
+
+        with open(os.path.join(onnx_dir, ONNX_META_FILE), encoding='utf-8') as f:
+            self.index = json.load(f)["class_names"].index("toxicity")
+        self.tokenizer = AutoTokenizer.from_pretrained(onnx_dir)
+        self.model_path = model_path
+        self.set_threads(threads)
+
+    def set_threads(self, threads):
+        """
+        (Re)creates the session: its thread pool is fixed when it is built,
+        and a pool created before a fork does not exist in the child.
+        """
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(self.model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def score(self, texts):
+        inputs = self.tokenizer(list(texts), return_tensors="np", truncation=True, padding=True)
+        feeds = {name: inputs[name].astype(np.int64) for name in self.input_names}
+        logits = self.session.run(None, feeds)[0][:, self.index]
+        return (1.0 / (1.0 + np.exp(-logits))).tolist()
+
+
+def load_backend(name, threads=None, onnx_dir=ONNX_DIR):
+    """
+    Loads a toxicity backend by name. `threads` sets the intra-op thread
+    count (torch's global setting, or the ONNX Runtime session's).
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"unknown toxicity backend {name!r}, expected one of {BACKENDS}")
+    if threads:
+        torch.set_num_threads(threads)
+    if name == "onnx":
+        return OnnxBackend(onnx_dir, threads)
+    if name == "quantized":
+        return QuantizedBackend()
+    return TorchBackend()
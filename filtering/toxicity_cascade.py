@@ -0,0 +1,151 @@
+"""
+Module: toxicity_cascade.py
+
+Two-tier toxicity scoring for toxicity_filter.py. A lexicon-weighted linear
+model scores every line first; lines it places confidently below or above
+the cut-offs are decided without the transformer, and only the uncertain
+band is sent to the Detoxify backend. A random audit sample of the
+confident lines is also scored by the transformer to measure how often the
+two tiers agree.
+
+With the default weights and cut-offs the lexicon only decides lines it
+rates clearly toxic (three or more lexicon words); every other line,
+including the usual majority with no lexicon words at all, still goes to
+the transformer, so expect close to 100% of lines to pass through. Raising
+`safe_below` above the no-hit score (e.g. 0.05) is the aggressive opt-in:
+lines without lexicon words are then kept without a model score and only
+lines with lexicon hits (typically a few percent) reach the transformer.
+"""
+
+import math
+import random
+import re
+from collections import defaultdict
+from smart_open import open as s3_open
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9']+")
+BIAS_TOKEN = "__bias__"
+
+# Used when the lexicon file gives no weights/bias: a line with no lexicon
+# words scores ~0.018, one word ~0.27, two words ~0.88, three ~0.993
+DEFAULT_WEIGHT = 3.0
+DEFAULT_BIAS = -4.0
+
+# Below the no-hit score, so lines without lexicon words are not decided
+# safe unless the caller opts in with a higher cut-off
+SAFE_BELOW = 0.01
+TOXIC_ABOVE = 0.95
+AUDIT_RATE = 0.01
+
+
+class LexiconScorer:
+    """
+    Logistic model over word presence: sigmoid(bias + sum of the weights of
+    the distinct lexicon words in a line).
+    """
+
+    def __init__(self, weights, bias=DEFAULT_BIAS):
+        self.weights = weights
+        self.bias = bias
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a local or S3 lexicon: one `word` or `word<TAB>weight` per
+        line, `__bias__<TAB>value` for the intercept, `#` for comments.
+        """
+        weights = {}
+        bias = DEFAULT_BIAS
+        with s3_open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                word, _, weight = line.partition("\t")
+                weight = float(weight) if weight else DEFAULT_WEIGHT
+                if word == BIAS_TOKEN:
+                    bias = weight
+                else:
+                    weights[word.lower()] = weight
+        return cls(weights, bias)
+
+    def score(self, text):
+        tokens = set(TOKEN_PATTERN.findall(text.lower()))
+        z = self.bias + sum(self.weights[token] for token in tokens & self.weights.keys())
+        return 1.0 / (1.0 + math.exp(-max(-60.0, min(60.0, z))))
+
+
+class ToxicityCascade:
+    """
+    Routes lines between the lexicon tier and the transformer.
+
+    Lexicon scores below `safe_below` or above `toxic_above` are final; the
+    rest are uncertain and need a transformer score. Counters for the
+    current file are returned (and reset) by `take_counts()`.
+    """
+
+    def __init__(self, lexicon, threshold, safe_below=SAFE_BELOW, toxic_above=TOXIC_ABOVE,
+                 audit_rate=AUDIT_RATE, seed=0):
+        if not safe_below <= threshold <= toxic_above:
+            raise ValueError(f"cascade cut-offs must satisfy safe_below ({safe_below}) <= "
+                             f"threshold ({threshold}) <= toxic_above ({toxic_above})")
+        self.lexicon = lexicon
+        self.threshold = threshold
+        self.safe_below = safe_below
+        self.toxic_above = toxic_above
+        self.audit_rate = audit_rate
+        self.rng = random.Random(seed)
+        self.counts = defaultdict(int)
+
+    def triage(self, text):
+        """
+        Returns (lexicon score, tier, audit): tier is "safe", "toxic" or
+        "uncertain"; `audit` marks a confident line sampled for a
+        transformer cross-check.
+        """
+        score = self.lexicon.score(text)
+        if score < self.safe_below:
+            tier = "safe"
+        elif score > self.toxic_above:
+            tier = "toxic"
+        else:
+            tier = "uncertain"
+        self.counts[f"tier_{tier}"] += 1
+
+        audit = tier != "uncertain" and self.audit_rate > 0 and self.rng.random() < self.audit_rate
+        if tier == "uncertain" or audit:
+            self.counts["transformer_lines"] += 1
+        return score, tier, audit
+
+    def record_audit(self, tier, model_score):
+        """
+        Counts whether the transformer agreed with a confident lexicon tier.
+        """
+        self.counts[f"audit_{tier}"] += 1
+        if model_score is not None and (model_score >= self.threshold) == (tier == "toxic"):
+            self.counts[f"audit_{tier}_agree"] += 1
+
+    def settings(self):
+        return {
+            "lexicon_words": len(self.lexicon.weights),
+            "safe_below": self.safe_below,
+            "toxic_above": self.toxic_above,
+            "audit_rate": self.audit_rate,
+        }
+
+    def take_counts(self):
+        counts = dict(self.counts)
+        self.counts.clear()
+        return counts
+
+
+def agreement_rates(counts):
+    """
+    Share of audited confident lines the transformer decided the same way,
+    per tier (None when a tier had no audited lines).
+    """
+    return {
+        tier: round(counts.get(f"audit_{tier}_agree", 0) / counts[f"audit_{tier}"], 4)
+        if counts.get(f"audit_{tier}") else None
+        for tier in ("safe", "toxic")
+    }
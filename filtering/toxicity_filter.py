@@ -2,15 +2,34 @@
 Module: toxicity_filter.py
 
 Filters out toxic text lines from deduplicated data using Detoxify.
-Uses a single toxicity threshold and saves only safe lines.
+Uses a single toxicity threshold and saves only safe lines. Lines are
+scored in length-bucketed batches and written back in input order; the
+model runs on a selectable CPU backend (see toxicity_backends.py).
+
+With --workers N the model is loaded once in the parent and N forked
+workers score windows of lines, sharing the weights through copy-on-write
+pages instead of each loading its own copy. The parent loads the model
+single-threaded, since forking after OpenMP (or ONNX Runtime) thread
+pools have run can deadlock the children; each worker sets its share of
+--threads after the fork.
 """
 
-from detoxify import Detoxify
+import argparse
+import multiprocessing
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
 import boto3
-from smart_open import open as s3_open
-
-# Load Detoxify model
-model = Detoxify('original')
+from common.shards import open_shard
+from common.work import add_work_arguments, resolve_keys
+from common.metrics import StageMetrics, utf8_len
+from common.batching import predict_in_order
+from common.parallel import available_cpus, bounded_map
+from filtering.toxicity_backends import BACKENDS, ONNX_DIR, load_backend
+from filtering.toxicity_cascade import (
+    AUDIT_RATE, SAFE_BELOW, TOXIC_ABOVE, LexiconScorer, ToxicityCascade, agreement_rates,
+)
 
 # S3 configuration
 s3 = boto3.client('s3')
@@ -21,70 +40,356 @@ DETOXIFIED_PREFIX = "detoxified/"
 
 # Parameters
 TOXICITY_THRESHOLD = 0.5
+BATCH_SIZE = 64
+# Lines buffered per length-bucketing window, in batches
+BUCKET_BATCHES = 8
+
+# Window mode: consecutive content lines of a document are packed into one
+# text of at most WINDOW_TOKENS estimated tokens (Detoxify truncates at 512)
+WINDOW_TOKENS = 448
+TOKENS_PER_WORD = 1.3
+
+# Backend inherited by forked pool workers; set in the parent before the
+# pool starts so workers never load the model themselves
+_worker_backend = None
 
 
 def is_special_line(line):
     return line.strip() == "[DOC_START]" or line.startswith("URL:")
 
 
-def filter_toxicity(s3_key):
+def score_batch(backend, texts):
+    """
+    Toxicity scores for a batch of lines. If the batch fails, lines are
+    scored one at a time and a line that still fails gets None (removed).
     """
-    Filters toxic lines using Detoxify. Only saves safe lines.
+    try:
+        return backend.score(texts)
+    except Exception:
+        scores = []
+        for text in texts:
+            try:
+                scores.append(backend.score([text])[0])
+            except Exception:
+                scores.append(None)
+        return scores
+
 
-    Filters toxic lines from a single deduped file on S3.
+def score_window(texts, batch_size, backend=None):
     """
-    input_path = f"s3://{BUCKET}/{s3_key}"
-    output_key = s3_key.replace(FILTERED_PREFIX, DETOXIFIED_PREFIX).replace("_filtered", "_detoxified")
-    output_path = f"s3://{BUCKET}/{output_key}"
+    Scores one window of texts (None marks an item without text) in
+    length-bucketed batches. In a pool worker, uses the backend inherited
+    from the parent.
+
+    Returns:
+        list: One score (or None) per item, in order.
+    """
+    backend = backend or _worker_backend
+    items = ((None, text) for text in texts)
+    scored = predict_in_order(items, partial(score_batch, backend), batch_size,
+                              window=batch_size * BUCKET_BATCHES, sort_key=len)
+    return [score for _, score in scored]
+
+
+def init_worker(threads):
+    """
+    Pool initializer: sets the inherited backend's intra-op threads in the
+    worker, after the fork.
+    """
+    _worker_backend.set_threads(threads)
+
+
+def make_pool(backend, workers, threads):
+    """
+    Forked scoring pool whose workers share `backend` (loaded single-threaded
+    in this process) and run it with `threads` intra-op threads each.
+    """
+    global _worker_backend
+    _worker_backend = backend
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"),
+                               initializer=init_worker, initargs=(threads,))
+
+
+def score_items(items, backend, batch_size, pool=None, workers=1):
+    """
+    Yields (payload, score) for (payload, text) items in input order, either
+    in this process or spread over `pool` in windows, with at most two
+    windows per worker in flight.
+    """
+    if pool is None:
+        yield from predict_in_order(items, partial(score_batch, backend), batch_size,
+                                    window=batch_size * BUCKET_BATCHES, sort_key=len)
+        return
+
+    payloads = deque()
+
+    def windows():
+        for window in iter(lambda: list(islice(items, batch_size * BUCKET_BATCHES)), []):
+            payloads.append([payload for payload, _ in window])
+            yield [text for _, text in window]
+
+    for scores in bounded_map(pool, partial(score_window, batch_size=batch_size), windows(), 2 * workers):
+        yield from zip(payloads.popleft(), scores)
+
+
+def estimate_tokens(text):
+    """
+    Rough WordPiece token count without running the tokenizer.
+    """
+    return int(len(text.split()) * TOKENS_PER_WORD) + 1
+
+
+def pack_windows(items, max_tokens, breaks):
+    """
+    Packs consecutive (payload, text) items into windows of at most
+    `max_tokens` estimated tokens. Items for which `breaks(payload)` is true
+    ([DOC_START]/URL lines, audited lines) close the current window and get
+    a group of their own, so windows never span documents.
+
+    Yields:
+        (group, window text): group is the list of packed items; window
+        text is None if no item in the group has text.
+    """
+    group = []
+    texts = []
+    tokens = 0
+
+    for payload, text in items:
+        if breaks(payload):
+            if group:
+                yield group, " ".join(texts) or None
+                group, texts, tokens = [], [], 0
+            yield [(payload, text)], text
+            continue
+
+        if text is not None:
+            size = estimate_tokens(text)
+            if texts and tokens + size > max_tokens:
+                yield group, " ".join(texts)
+                group, texts, tokens = [], [], 0
+            texts.append(text)
+            tokens += size
+        group.append((payload, text))
 
+    if group:
+        yield group, " ".join(texts) or None
+
+
+def expand_windows(scored, rescore, stats):
+    """
+    Turns scored windows back into per-line items. Every line of a window
+    gets the window's score; with `rescore`, the lines of a toxic
+    multi-line window are instead passed on with their own text, to be
+    scored one by one.
+
+    Yields:
+        ((payload, window score), text to rescore or None)
+    """
+    for group, score in scored:
+        texts = sum(1 for _, text in group if text is not None)
+        if texts:
+            stats["windows"] += 1
+            stats["window_lines"] += texts
+        toxic = score is None or score >= TOXICITY_THRESHOLD
+        if texts and toxic:
+            stats["toxic_windows"] += 1
+        rescore_group = rescore and toxic and texts > 1
+
+        for payload, text in group:
+            if text is None:
+                yield (payload, None), None
+            elif rescore_group:
+                stats["rescored_lines"] += 1
+                yield (payload, score), text
+            else:
+                yield (payload, score), None
+
+
+def score_windowed(items, backend, batch_size, max_tokens, rescore, stats, pool=None, workers=1):
+    """
+    Window-mode scoring: yields (payload, score) in input order, where score
+    is the score of the line's window, or its own score if rescored.
+    """
+    windows = pack_windows(items, max_tokens, breaks=lambda payload: payload[1] or payload[4])
+    scored = score_items(windows, backend, batch_size, pool, workers)
+    lines = expand_windows(scored, rescore, stats)
+    if not rescore:
+        for (payload, score), _ in lines:
+            yield payload, score
+        return
+
+    for (payload, window_score), line_score in score_items(lines, backend, batch_size, pool, workers):
+        yield payload, window_score if line_score is None else line_score
+
+
+def toxicity_lines(fin, metrics, backend, batch_size=BATCH_SIZE, threads=None, cascade=None,
+                   pool=None, workers=1, window_tokens=0, rescore=False):
+    """
+    Filters toxic lines using Detoxify. Only yields safe lines.
+
+    Content lines are scored `batch_size` at a time, sorted by length
+    within a window so each batch pads to similar lengths; special lines
+    pass through in place. With a `cascade`, lines the lexicon tier decides
+    confidently skip the transformer and only the uncertain (and audited)
+    lines fill its batches. With a `pool`, windows of lines are scored by
+    `workers` forked workers and yielded in order. With `window_tokens`,
+    consecutive content lines are packed into token-budgeted windows scored
+    once each; lines of a toxic window are dropped, or rescored
+    individually with `rescore`. `metrics` is filled in with the file's
+    counts once the generator is exhausted.
+    """
     kept = 0
     removed = 0
+    lines_in = 0
+    bytes_in = 0
+    bytes_out = 0
+    stats = defaultdict(int)
 
-    with s3_open(input_path, 'r', encoding='utf-8') as fin, \
-         s3_open(output_path, 'w', encoding='utf-8') as fout:
-
+    def items():
+        nonlocal lines_in, bytes_in
         for line in fin:
+            lines_in += 1
+            bytes_in += utf8_len(line)
             text = line.strip()
             if not text:
                 continue
-
             if is_special_line(text):
-                fout.write(line)
-                kept += 1
-                continue
+                yield (line, True, None, None, False), None
+            elif cascade is None:
+                yield (line, False, None, "uncertain", False), text
+            else:
+                lexicon_score, tier, audit = cascade.triage(text)
+                send = tier == "uncertain" or audit
+                yield (line, False, lexicon_score, tier, audit), text if send else None
 
+    if window_tokens > 0:
+        scored = score_windowed(items(), backend, batch_size, window_tokens, rescore, stats, pool, workers)
+    else:
+        scored = score_items(items(), backend, batch_size, pool, workers)
+    for (line, special, lexicon_score, tier, audit), score in scored:
+        if audit:
+            cascade.record_audit(tier, score)
+        if tier not in (None, "uncertain"):
+            score = lexicon_score
+        if special or (score is not None and score < TOXICITY_THRESHOLD):
+            yield line
+            bytes_out += utf8_len(line)
+            kept += 1
+        else:
+            removed += 1
 
-            try:
-                score = model.predict(text)["toxicity"]
-            except Exception as e:
-                removed += 1
-                continue
+    metrics.records = lines_in
+    metrics.bytes_in = bytes_in
+    metrics.bytes_out = bytes_out
+    metrics.update(safe=kept, removed=removed, **stats)
+    metrics.extra["backend"] = backend.name
+    metrics.extra["batch_size"] = batch_size
+    metrics.extra["threads"] = threads
+    metrics.extra["workers"] = workers
+    metrics.extra["window_tokens"] = window_tokens
+    if cascade is not None:
+        counts = cascade.take_counts()
+        metrics.update(**counts)
+        metrics.extra["cascade"] = dict(cascade.settings(), agreement=agreement_rates(counts))
 
-            if score < TOXICITY_THRESHOLD:
-                fout.write(line)
-                kept += 1
-            else:
-                removed += 1
+
+def output_key_for(s3_key):
+    return s3_key.replace(FILTERED_PREFIX, DETOXIFIED_PREFIX).replace("_filtered", "_detoxified")
+
+
+def report_file(metrics, output_key):
+    """
+    Writes a file's metrics record and prints its summary.
+    """
+    record = metrics.write()
+    counts = metrics.counts
+    cascade_note = ""
+    if "cascade" in metrics.extra:
+        cascade_note = (f", transformer lines: {counts.get('transformer_lines', 0)}, "
+                        f"agreement: {metrics.extra['cascade']['agreement']}")
+    window_note = ""
+    if metrics.extra["window_tokens"] > 0:
+        window_note = f", windows: {counts['windows']} ({counts['toxic_windows']} toxic)"
+    print(f"✅ Done: {output_key} | Safe lines: {counts['safe']}, Removed: {counts['removed']}"
+          f"{window_note}{cascade_note}, {record['records_per_sec']} lines/sec")
 
 
-    log_path = "s3://my-cc-pipeline-s3/logs/toxicity_log.txt"
-    log_entry = f"{output_key} | Safe: {kept}, Removed: {removed}\n"
+def filter_toxicity(s3_key, backend, batch_size=BATCH_SIZE, threads=None, cascade=None,
+                    pool=None, workers=1, window_tokens=0, rescore=False):
+    """
+    Filters toxic lines from a single filtered file on S3 and saves the
+    safe lines (see `toxicity_lines`).
+    """
+    input_path = f"s3://{BUCKET}/{s3_key}"
+    output_key = output_key_for(s3_key)
+    output_path = f"s3://{BUCKET}/{output_key}"
+    metrics = StageMetrics("toxicity_filter", s3_key)
 
-    with s3_open(log_path, 'w', encoding='utf-8') as log_file:
-        log_file.write(log_entry)
+    with open_shard(input_path, 'r') as fin, \
+         open_shard(output_path, 'w') as fout:
+        for line in toxicity_lines(fin, metrics, backend, batch_size, threads, cascade,
+                                   pool, workers, window_tokens, rescore):
+            fout.write(line)
 
-    print(f"✅ Done: {output_key} | Safe lines: {kept}, Removed: {removed}")
+    report_file(metrics, output_key)
 
 
 def main():
     """
     Iterate over all deduped files in S3 and run toxicity filtering.
     """
-    response = s3.list_objects_v2(Bucket=BUCKET, Prefix=FILTERED_PREFIX)
-    for obj in response.get('Contents', []):
-        s3_key = obj['Key']
-        if s3_key.endswith("_filtered.txt"):
-            filter_toxicity(s3_key)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", choices=BACKENDS, default="torch",
+                        help="fp32 torch, int8 dynamically quantized torch, or ONNX Runtime")
+    parser.add_argument("--onnx_dir", default=ONNX_DIR,
+                        help="Exported ONNX model directory (exported on first use)")
+    parser.add_argument("--batch_size", type=int, default=BATCH_SIZE,
+                        help="Lines per Detoxify call")
+    parser.add_argument("--threads", type=int, default=available_cpus(),
+                        help="Intra-op threads for the inference backend, split across --workers")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Forked scoring processes sharing one copy of the model")
+    parser.add_argument("--window_tokens", type=int, default=0,
+                        help=f"Score packed windows of up to this many estimated tokens instead of "
+                             f"single lines (0 = per line; e.g. {WINDOW_TOKENS})")
+    parser.add_argument("--rescore_toxic_windows", action="store_true",
+                        help="Rescore the lines of toxic windows one by one instead of dropping them all")
+    parser.add_argument("--lexicon",
+                        help="Local or s3:// lexicon file; enables the lexicon tier in front of Detoxify. "
+                             "With the default cut-offs only lines with 3+ lexicon words skip the "
+                             "model (nearly all lines still pass through); --safe_below 0.05 also "
+                             "keeps lines with no lexicon words unscored, so only lines with hits "
+                             "(typically a few percent) reach the transformer")
+    parser.add_argument("--safe_below", type=float, default=SAFE_BELOW,
+                        help="Lexicon score below which a line is safe without the transformer "
+                             "(a line with no lexicon words scores ~0.018 with the default bias)")
+    parser.add_argument("--toxic_above", type=float, default=TOXIC_ABOVE,
+                        help="Lexicon score above which a line is toxic without the transformer")
+    parser.add_argument("--audit_rate", type=float, default=AUDIT_RATE,
+                        help="Share of confidently decided lines also scored by the transformer")
+    add_work_arguments(parser)
+    args = parser.parse_args()
+
+    workers = max(1, args.workers)
+    threads = max(1, args.threads // workers)
+
+    # Load (and quantize/export) once, before forking; workers inherit it.
+    # With workers the parent stays single-threaded until the fork.
+    backend = load_backend(args.backend, threads if workers == 1 else 1, args.onnx_dir)
+    cascade = None
+    if args.lexicon:
+        cascade = ToxicityCascade(LexiconScorer.load(args.lexicon), TOXICITY_THRESHOLD,
+                                  args.safe_below, args.toxic_above, args.audit_rate)
+
+    pool = make_pool(backend, workers, threads) if workers > 1 else None
+
+    try:
+        for s3_key in resolve_keys(args, s3, BUCKET, FILTERED_PREFIX, "_filtered"):
+            filter_toxicity(s3_key, backend, args.batch_size, threads, cascade, pool, workers,
+                            args.window_tokens, args.rescore_toxic_windows)
+    finally:
+        if pool:
+            pool.shutdown()
 
 
 if __name__ == "__main__":
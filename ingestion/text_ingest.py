@@ -7,12 +7,26 @@ for medical imaging relevance.
 """
 
 import argparse
+import io
+import json
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from io import StringIO
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
 from warcio.archiveiterator import ArchiveIterator
 from hydra import initialize, compose
 from smart_open import open as s3_open
+from common.keyword_matcher import KeywordMatcher
+from common.shards import ShardedWriter, COMPRESSION_SUFFIXES
+from common.parallel import available_cpus, bounded_map
+from common.metrics import StageMetrics
 
 
 # Load Hydra config
@@ -28,44 +42,318 @@ domain_whitelist = cfg.filters.domain_whitelist
 url_includes = cfg.filters.url_includes
 required_page_keywords = cfg.filters.required_page_keywords
 
+# Keyword matchers, compiled once from the config
+url_include_matcher = KeywordMatcher(cfg.filters.url_includes)
+url_exclude_matcher = KeywordMatcher(cfg.filters.url_excludes)
+required_page_matcher = KeywordMatcher(cfg.filters.required_page_keywords)
+exclude_page_matcher = KeywordMatcher(cfg.filters.exclude_page_keywords)
+
+# Streaming parameters
+STREAM_CHUNK_SIZE = 1 << 20
+PREFETCH_CHUNKS = 16
+MAX_RETRIES = 5
+RETRY_BACKOFF = 2.0
+REQUEST_TIMEOUT = 60
+
+# Connections kept alive per worker process
+POOL_SIZE = 8
+
+# Output parameters
+OUTPUT_COMPRESSION = "none"
+SHARD_SIZE_MB = 0
+
+
+_session = None
+
+
+def get_session():
+    """
+    Pooled HTTP session for this process, created lazily so every pool
+    worker gets its own after fork and reuses its connections across files.
+    """
+    global _session
+    if _session is None:
+        retry = Retry(total=3, backoff_factor=RETRY_BACKOFF,
+                      status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET"])
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+        _session = requests.Session()
+        _session.mount("https://", adapter)
+        _session.mount("http://", adapter)
+    return _session
+
 
 def contains_required_keywords(text):
     """
     Checks if the page content contains at least one required keyword.
     """
-    return any(keyword.lower() in text.lower() for keyword in required_page_keywords)
+    return required_page_matcher.any_match(text)
 
 
-def download_and_process_wet(url, save_dir):
+class ResumableHTTPStream(io.RawIOBase):
     """
-    Downloads the WET file and extracts relevant web pages.
+    Read-only file object over an HTTP download that resumes with a
+    Range request when the connection drops mid-transfer.
+
+    The body is returned exactly as served (no Content-Encoding decoding),
+    so a `.warc.wet.gz` stays gzip-compressed and ArchiveIterator does the
+    decompression itself.
+    """
+
+    def __init__(self, url, session=None, max_retries=MAX_RETRIES,
+                 backoff=RETRY_BACKOFF, timeout=REQUEST_TIMEOUT):
+        self.url = url
+        self.session = session or requests.Session()
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.position = 0
+        self.retries = 0
+        self.length = None
+        self._response = None
+        self._eof = False
+        self._connect()
+
+    def _connect(self, ranged=False):
+        """
+        Opens the body from `position` (a Range request once past byte 0,
+        or when `ranged`). Returns False if the server answers 416, i.e.
+        there is nothing past `position`.
+        """
+        ranged = ranged or self.position > 0
+        headers = {"Range": f"bytes={self.position}-"} if ranged else {}
+        response = self.session.get(self.url, stream=True, headers=headers, timeout=self.timeout)
+        if ranged and response.status_code == 416:
+            response.close()
+            return False
+        response.raise_for_status()
+        if ranged and response.status_code != 206:
+            response.close()
+            raise IOError(f"Server ignored Range request for {self.url}; cannot resume")
+        if self.length is None:
+            self.length = self._total_length(response)
+        self._response = response
+        return True
+
+    @staticmethod
+    def _total_length(response):
+        """
+        Full body size: from Content-Range on a 206 (its Content-Length is
+        only the remainder), else Content-Length; None if not given.
+        """
+        if response.status_code == 206:
+            total = response.headers.get("Content-Range", "").rpartition("/")[2]
+            return int(total) if total.isdigit() else None
+        length = response.headers.get("Content-Length")
+        return int(length) if length else None
+
+    def _disconnect(self):
+        if self._response is not None:
+            self._response.close()
+            self._response = None
+
+    def readable(self):
+        return True
+
+    def _read(self, size):
+        """
+        Next bytes of the body, or b"" only at its verified end. An EOF
+        before the known length is an error; without a known length the
+        server is asked for the bytes past `position` (416 confirms the
+        end, a 206 continues the stream).
+        """
+        if self._response is None and not self._connect():
+            if self.length is not None and self.position < self.length:
+                raise IOError(f"server has no data after byte {self.position} of {self.length}")
+            return b""
+        data = self._response.raw.read(size, decode_content=False)
+        if data:
+            return data
+        if self.length is not None:
+            if self.position >= self.length:
+                return b""
+            raise IOError(f"connection closed after {self.position} of {self.length} bytes")
+
+        self._disconnect()
+        if not self._connect(ranged=True):
+            return b""
+        data = self._response.raw.read(size, decode_content=False)
+        if not data:
+            raise IOError(f"connection closed at byte {self.position} with more data available")
+        return data
+
+    def readinto(self, buffer):
+        if self._eof:
+            return 0
+        attempt = 0
+        while True:
+            try:
+                data = self._read(len(buffer))
+                break
+            except (requests.exceptions.RequestException, Urllib3HTTPError, OSError) as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                self.retries += 1
+                print(f"⚠️ Connection dropped at byte {self.position} ({e}); "
+                      f"resuming (attempt {attempt}/{self.max_retries})")
+                self._disconnect()
+                time.sleep(self.backoff * attempt)
+
+        n = len(data)
+        if n == 0:
+            self._eof = True
+        buffer[:n] = data
+        self.position += n
+        return n
+
+    def close(self):
+        self._disconnect()
+        super().close()
+
+
+class PrefetchingReader(io.RawIOBase):
+    """
+    Reads a raw stream on a background thread into a bounded queue so the
+    network transfer overlaps with record parsing in the caller's thread.
+    Memory is capped at `max_chunks * chunk_size` bytes.
     """
 
-    response = requests.get(url, stream=True)
+    def __init__(self, raw, chunk_size=STREAM_CHUNK_SIZE, max_chunks=PREFETCH_CHUNKS):
+        self.raw = raw
+        self.chunk_size = chunk_size
+        self._chunks = queue.Queue(maxsize=max_chunks)
+        self._pending = memoryview(b"")
+        self.position = 0
+        self._error = None
+        self._eof = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+    def _fill(self):
+        try:
+            while not self._stop.is_set():
+                chunk = self.raw.read(self.chunk_size)
+                if not chunk:
+                    break
+                self._chunks.put(chunk)
+        except Exception as e:
+            self._error = e
+        finally:
+            self._chunks.put(None)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self._pending:
+            if self._eof:
+                return 0
+            chunk = self._chunks.get()
+            if chunk is None:
+                self._eof = True
+                if self._error is not None:
+                    raise self._error
+                return 0
+            self._pending = memoryview(chunk)
+
+        n = min(len(buffer), len(self._pending))
+        buffer[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        self.position += n
+        return n
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self._stop.set()
+        # Drain so a producer blocked on a full queue can exit
+        while self._thread.is_alive():
+            try:
+                self._chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.raw.close()
+        super().close()
+
+
+def output_path(url):
+    """
+    S3 output base path for a WET file URL (shard suffix and extension are
+    added by the writer).
+    """
+    stem = Path(Path(url).name).stem
+    return f"s3://my-cc-pipeline-s3/extracted/{stem}_extracted"
+
+
+def download_wet(url, save_dir):
+    """
+    Downloads the WET file into `save_dir` and returns its path.
+    """
     filename = save_dir / Path(url).name
 
-    with open(filename, 'wb') as f:
-        for chunk in response.iter_content(chunk_size=8192):
-            f.write(chunk)
+    with get_session().get(url, stream=True, timeout=REQUEST_TIMEOUT) as response:
+        response.raise_for_status()
+        with open(filename, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                f.write(chunk)
+
+    return filename
+
+
+def download_and_process_wet(url, save_dir, compression=OUTPUT_COMPRESSION, shard_size_mb=SHARD_SIZE_MB):
+    """
+    Downloads the WET file and extracts relevant web pages.
+    """
+    filename = download_wet(url, save_dir)
+
+    extract_relevant_pages(filename, output_path(url),
+                           compression=compression, shard_size_mb=shard_size_mb)
+
 
-    s3_output_path = f"s3://my-cc-pipeline-s3/extracted/{filename.stem}_extracted.txt"
-    s3_log_path = "s3://my-cc-pipeline-s3/logs/extraction_log.txt"
-    extract_relevant_pages(filename, s3_output_path, s3_log_path)
+def stream_and_process_wet(url, max_retries=MAX_RETRIES, compression=OUTPUT_COMPRESSION,
+                           shard_size_mb=SHARD_SIZE_MB):
+    """
+    Parses the WET file directly from the HTTP response without writing it
+    to local disk. Dropped connections are resumed with Range requests.
+    """
+    raw = ResumableHTTPStream(url, session=get_session(), max_retries=max_retries)
+    with io.BufferedReader(PrefetchingReader(raw), buffer_size=STREAM_CHUNK_SIZE) as stream:
+        extract_relevant_pages(stream, output_path(url), source_name=Path(url).name,
+                               compression=compression, shard_size_mb=shard_size_mb)
+    if raw.retries:
+        print(f"🔁 Resumed {url} {raw.retries} time(s)")
 
 
-def extract_relevant_pages(wet_file_path, s3_output_path, s3_log_path):
+def extract_relevant_pages(wet_file_path, s3_output_path, source_name=None,
+                           compression=OUTPUT_COMPRESSION, shard_size_mb=SHARD_SIZE_MB):
     """
     Parses WET file and saves relevant web pages to the raw directory.
     Applies domain, content keyword, and URL keyword filters with smart
     matching. Logs detailed reasons for keeping or skipping pages.
+
+    `wet_file_path` may be a local path or an already-open binary stream
+    (e.g. a streaming HTTP response); pass `source_name` for the latter.
+    Kept pages are streamed to `s3_output_path` shards as they are found,
+    optionally compressed and rolled every `shard_size_mb` megabytes.
     """
 
     kept_pages = 0
     skipped_pages = 0
     total_records = 0
-    buffer = StringIO()
+    bytes_in = 0
+    writer = ShardedWriter(s3_output_path, compression=compression,
+                           shard_size=shard_size_mb * 1024 * 1024)
+
+    if isinstance(wet_file_path, Path):
+        source_name = source_name or wet_file_path.name
+        stream = open(wet_file_path, 'rb')
+    else:
+        stream = wet_file_path
+    metrics = StageMetrics("ingest", source_name)
 
-    with open(wet_file_path, 'rb') as stream:
+    with stream, writer:
         for record in ArchiveIterator(stream):
             total_records += 1
             if record.rec_type != 'conversion':
@@ -86,97 +374,202 @@ def extract_relevant_pages(wet_file_path, s3_output_path, s3_log_path):
                 skipped_pages += 1
                 continue
 
-            url_lower = url.lower()
-            url_normalized = url_lower.replace('_', ' ').replace('-', ' ')
-            content_lower = content.lower()
+            url_normalized = url.lower().replace('_', ' ').replace('-', ' ')
 
             # URL include check
-            url_include_match = None
-            for keyword in cfg.filters.url_includes:
-                if keyword.lower() in url_normalized:
-                    url_include_match = keyword
-                    break
-            if not url_include_match:
+            if not url_include_matcher.any_match(url_normalized):
                 skipped_pages += 1
                 continue
 
             # URL exclude check
-            url_exclude_trigger = None
-            for keyword in cfg.filters.url_excludes:
-                if keyword.lower() in url_normalized:
-                    url_exclude_trigger = keyword
-                    break
-            if url_exclude_trigger:
+            if url_exclude_matcher.any_match(url_normalized):
                 skipped_pages += 1
                 continue
 
             # Required page keyword check (must match all)
-            if not all(kw.lower() in content_lower for kw in cfg.filters.required_page_keywords):
+            if not required_page_matcher.all_match(content):
                 skipped_pages += 1
                 continue
 
             # Exclude page keywords check
-            exclude_page_trigger = None
-            for keyword in cfg.filters.exclude_page_keywords:
-                if keyword.lower() in content_lower:
-                    exclude_page_trigger = keyword
-                    break
-            if exclude_page_trigger:
+            if exclude_page_matcher.any_match(content):
                 skipped_pages += 1
                 continue
 
-
-            buffer.write("[DOC_START]\n")
-            buffer.write(f"URL: {url}\n")
-            buffer.write(f"{content.strip()}\n\n")
+            writer.write_record(f"[DOC_START]\nURL: {url}\n{content.strip()}\n\n")
             kept_pages += 1
 
-    # Upload only if buffer is non-empty and pages were kept
-    if kept_pages > 0 and buffer.getvalue().strip():
-        with s3_open(s3_output_path, 'w', encoding='utf-8') as fout:
-            fout.write(buffer.getvalue())
-        upload_status = "✅ Uploaded"
+        bytes_in = stream.tell()
+
+    # The writer only creates shards once a page is kept
+    if writer.paths:
+        upload_status = f"✅ Uploaded {len(writer.paths)} shard(s)"
     else:
         upload_status = "⚠️ Skipped upload (no valid content)"
+    # Always log, as this task's own metrics record
+    metrics.records = total_records
+    metrics.bytes_in = bytes_in
+    metrics.bytes_out = writer.bytes_written
+    metrics.update(total_records=total_records, pages_kept=kept_pages, pages_skipped=skipped_pages)
+    metrics.extra["shards"] = writer.paths
+    metrics.write()
+
+    print(f"\n📊 WET file summary:")
+    print(f"  Total records processed: {total_records}")
+    print(f"  Pages kept: {kept_pages}")
+    print(f"  Pages skipped: {skipped_pages}")
+    print(f"{upload_status}: {', '.join(writer.paths) if writer.paths else 'N/A'}")
+
+
+def load_manifest(path):
+    """
+    Reads WET URLs from a local or S3 manifest: either JSON (a list, or an
+    object with a "warc_urls" list such as input.json) or one URL per line.
+    """
+    with s3_open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    return parse_url_list(text)
+
+
+def parse_url_list(text):
+    text = text.strip()
+    if text.startswith(("[", "{")):
+        data = json.loads(text)
+        return list(data["warc_urls"] if isinstance(data, dict) else data)
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+
+def _error_message(e):
+    return f"{type(e).__name__}: {e}"
+
+
+def stream_one(url, **options):
+    """
+    Pool task for --stream mode: download and parse one WET file.
+    Returns (url, error message or None) so one bad file does not stop the batch.
+    """
+    try:
+        stream_and_process_wet(url, **options)
+        return url, None
+    except Exception as e:
+        return url, _error_message(e)
 
 
-    # Read existing log contents if file exists
+def fetch_one(url, save_dir):
+    """
+    Thread task: download one WET file. Returns (url, path, error).
+    """
     try:
-        with s3_open(s3_log_path, 'r', encoding='utf-8') as existing_log:
-            previous_logs = existing_log.read()
-    except Exception:
-        previous_logs = ""
+        return url, download_wet(url, save_dir), None
+    except Exception as e:
+        return url, None, _error_message(e)
 
 
-    # Always log
-    log_entry = (
-        f"File: {wet_file_path.name}\n"
-        f"Total records: {total_records}\n"
-        f"Pages kept: {kept_pages}\n"
-        f"Pages skipped: {skipped_pages}\n\n"
-    )
+def parse_one(fetched, compression=OUTPUT_COMPRESSION, shard_size_mb=SHARD_SIZE_MB):
+    """
+    Pool task: parse one downloaded WET file, then delete it so disk use
+    stays bounded by the number of files in flight.
+    """
+    url, filename, error = fetched
+    if error:
+        return url, error
+    try:
+        extract_relevant_pages(filename, output_path(url),
+                               compression=compression, shard_size_mb=shard_size_mb)
+        return url, None
+    except Exception as e:
+        return url, _error_message(e)
+    finally:
+        filename.unlink(missing_ok=True)
 
-    # Write full updated log to S3
-    with s3_open(s3_log_path, 'w', encoding='utf-8') as log_file:
-        log_file.write(previous_logs + log_entry)
 
-    print(f"\n📊 WET file summary:")
-    print(f"  Total records processed: {total_records}")
-    print(f"  Pages kept: {kept_pages}")
-    print(f"  Pages skipped: {skipped_pages}")
-    print(f"{upload_status}: {s3_output_path if kept_pages > 0 else 'N/A'}")
+def ingest_urls(urls, save_dir, workers, max_in_flight, stream=False, max_retries=MAX_RETRIES,
+                compression=OUTPUT_COMPRESSION, shard_size_mb=SHARD_SIZE_MB):
+    """
+    Ingests many WET files in one container. Parsing runs in a process pool
+    of `workers`; at most `max_in_flight` downloads run at once, each over
+    its process's pooled session. In --stream mode every worker streams and
+    parses its own file; otherwise a thread pool downloads to `save_dir`
+    while the process pool parses completed downloads.
+
+    The process pool uses the "spawn" start method: its workers start on
+    the first parse task, while download threads are already running, and
+    forking a process that has other threads can deadlock the child.
+
+    Returns the list of (url, error) for files that failed.
+    """
+    output_options = dict(compression=compression, shard_size_mb=shard_size_mb)
+    failures = []
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        if stream:
+            task = partial(stream_one, max_retries=max_retries, **output_options)
+            results = bounded_map(pool, task, urls, min(workers, max_in_flight), ordered=False)
+            failures = [(url, error) for url, error in results if error]
+        else:
+            with ThreadPoolExecutor(max_workers=max_in_flight) as downloader:
+                downloads = bounded_map(downloader, partial(fetch_one, save_dir=save_dir),
+                                        urls, max_in_flight, ordered=False)
+                results = bounded_map(pool, partial(parse_one, **output_options),
+                                      downloads, workers, ordered=False)
+                failures = [(url, error) for url, error in results if error]
+
+    return failures
 
 
 def main():
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("--warc_url", required=True, help="Full WET file URL to ingest")
+    urls_group = parser.add_mutually_exclusive_group(required=True)
+    urls_group.add_argument("--warc_url", help="Full WET file URL to ingest")
+    urls_group.add_argument("--warc_urls", nargs="+", help="Several WET file URLs to ingest in this container")
+    urls_group.add_argument("--warc_urls_json", help="JSON list of WET file URLs (as passed by Step Functions)")
+    urls_group.add_argument("--manifest", help="Local or s3:// manifest of WET URLs (JSON or one per line)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Parse the WET file straight from HTTP instead of saving it to data/raw")
+    parser.add_argument("--max_retries", type=int, default=MAX_RETRIES,
+                        help="Range-resume attempts per dropped connection in --stream mode")
+    parser.add_argument("--compression", choices=sorted(COMPRESSION_SUFFIXES), default=OUTPUT_COMPRESSION,
+                        help="Compression for the extracted output shards")
+    parser.add_argument("--shard_size_mb", type=int, default=SHARD_SIZE_MB,
+                        help="Start a new output shard at this size (0 = single file)")
+    parser.add_argument("--workers", type=int, default=available_cpus(),
+                        help="Parsing processes when ingesting several URLs")
+    parser.add_argument("--max_in_flight", type=int, default=None,
+                        help="Maximum concurrent downloads when ingesting several URLs (default: workers)")
     args = parser.parse_args()
 
     raw_dir = Path("data/raw")
     raw_dir.mkdir(parents=True, exist_ok=True)
 
-    download_and_process_wet(args.warc_url, raw_dir)
+    if args.warc_url:
+        if args.stream:
+            stream_and_process_wet(args.warc_url, max_retries=args.max_retries,
+                                   compression=args.compression, shard_size_mb=args.shard_size_mb)
+        else:
+            download_and_process_wet(args.warc_url, raw_dir,
+                                     compression=args.compression, shard_size_mb=args.shard_size_mb)
+        return
+
+    if args.manifest:
+        urls = load_manifest(args.manifest)
+    elif args.warc_urls_json:
+        urls = parse_url_list(args.warc_urls_json)
+    else:
+        urls = args.warc_urls
+
+    start = time.time()
+    failures = ingest_urls(urls, raw_dir, workers=args.workers,
+                           max_in_flight=args.max_in_flight or args.workers,
+                           stream=args.stream, max_retries=args.max_retries,
+                           compression=args.compression, shard_size_mb=args.shard_size_mb)
+
+    print(f"\n📦 Ingested {len(urls) - len(failures)}/{len(urls)} WET files in {time.time() - start:.1f}s")
+    for url, error in failures:
+        print(f"❌ {url}: {error}")
+    if failures:
+        raise SystemExit(1)
+
 
 if __name__ == "__main__":
     main()
@@ -9,12 +9,22 @@ Normalizes deduplicated text files:
 
 Output:
 - Normalized files saved to `normalized/`.
+
+With --workers N the input is split into byte ranges of about --chunk_mb
+that start at a [DOC_START] line, chunks are normalized in a process pool,
+and their outputs are written back in input order, so the result is
+byte-identical to the serial pass.
 """
 
+import argparse
+import io
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import boto3
 from smart_open import open as s3_open
-import unicodedata
-import re
+from common.metrics import StageMetrics, utf8_len
+from common.parallel import bounded_map
+from common.text_clean import is_normalized, normalize_line
 
 # S3 config
 s3 = boto3.client('s3')
@@ -24,61 +34,171 @@ OUTPUT_KEY = "normalized/normalized.txt"
 INPUT_PATH = f"s3://{BUCKET}/{INPUT_KEY}"
 OUTPUT_PATH = f"s3://{BUCKET}/{OUTPUT_KEY}"
 
-# Cleaning patterns
-url_pattern = re.compile(r'(https?://\S+|www\.\S+)', re.IGNORECASE)
-non_printable_pattern = re.compile(r'[^\x20-\x7E]+')
-
-
-def clean_unicode(text):
-    text = text.replace('\u2028', ' ').replace('\u2029', ' ')
-    text = text.replace('“', '"').replace('”', '"').replace("‘", "'").replace("’", "'")
-    text = text.replace("–", "-").replace("—", "-")
-    return unicodedata.normalize('NFKC', text)
-
-
-def normalize_line(line):
-    text = clean_unicode(line)
-    text = url_pattern.sub('', text)
-    text = non_printable_pattern.sub('', text)
-    text = re.sub(r'\s+', ' ', text)
-    return text.strip()
+# Parallel mode: target chunk size, and read size when searching for the
+# next document boundary
+CHUNK_MB = 64
+ALIGN_READ_BYTES = 1 << 20
+DOC_MARKER = b"\n[DOC_START]"
 
 
 def is_special_line(line):
     return line == "[DOC_START]" or line.startswith("URL:")
 
 
-def main():
-    kept = 0
-    removed = 0
-
-    with s3_open(INPUT_PATH, 'r', encoding='utf-8') as fin, \
-         s3_open(OUTPUT_PATH, 'w', encoding='utf-8') as fout:
-        for line in fin:
-            line = line.strip()
-            if not line:
-                removed += 1
-                continue
-
-            if is_special_line(line):
-                fout.write(line + '\n')
-                kept += 1
-                continue
-
+def normalize_lines(fin, counts):
+    """
+    Normalizes every line of `fin`, yielding newline-terminated output
+    lines; `counts` gets the line and byte counts.
+    """
+    for name in ("lines_in", "bytes_in", "bytes_out", "kept", "removed", "already_normalized"):
+        counts.setdefault(name, 0)
+    for line in fin:
+        counts["lines_in"] += 1
+        counts["bytes_in"] += utf8_len(line)
+        line = line.strip()
+        if not line:
+            counts["removed"] += 1
+            continue
+
+        if is_special_line(line):
+            yield line + '\n'
+            counts["bytes_out"] += utf8_len(line) + 1
+            counts["kept"] += 1
+            continue
+
+        if is_normalized(line):
+            # Already clean (e.g. cleaned by the filter stage): unchanged
+            counts["already_normalized"] += 1
+            normalized = line
+        else:
             normalized = normalize_line(line)
-            if normalized:
-                fout.write(normalized + '\n')
-                kept += 1
-            else:
-                removed += 1
+        if normalized:
+            yield normalized + '\n'
+            counts["bytes_out"] += utf8_len(normalized) + 1
+            counts["kept"] += 1
+        else:
+            counts["removed"] += 1
+
+
+def normalize_stream(fin, fout):
+    """
+    Normalizes every line of `fin` into `fout`; returns the line and byte
+    counts.
+    """
+    counts = {}
+    for line in normalize_lines(fin, counts):
+        fout.write(line)
+    return counts
+
+
+def record_counts(metrics, counts):
+    metrics.records = counts["lines_in"]
+    metrics.bytes_in = counts["bytes_in"]
+    metrics.bytes_out = counts["bytes_out"]
+    metrics.update(kept=counts["kept"], removed=counts["removed"],
+                   already_normalized=counts["already_normalized"])
+
+
+def next_doc_start(f, pos):
+    """
+    Offset of the first line at or after `pos` (> 0) that starts with
+    [DOC_START], or None if there is none.
+    """
+    f.seek(pos - 1)
+    offset = pos - 1
+    tail = b""
+    while True:
+        block = f.read(ALIGN_READ_BYTES)
+        if not block:
+            return None
+        data = tail + block
+        i = data.find(DOC_MARKER)
+        if i >= 0:
+            return offset - len(tail) + i + 1
+        tail = data[-(len(DOC_MARKER) - 1):]
+        offset += len(block)
+
+
+def chunk_ranges(path, chunk_bytes):
+    """
+    (start, end) byte ranges covering `path`, each about `chunk_bytes`
+    long and starting at a document boundary.
+    """
+    with s3_open(path, 'rb') as f:
+        size = f.seek(0, io.SEEK_END)
+        bounds = [0]
+        while bounds[-1] + chunk_bytes < size:
+            start = next_doc_start(f, bounds[-1] + chunk_bytes)
+            if start is None:
+                break
+            bounds.append(start)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def normalize_chunk(byte_range, path):
+    """
+    Pool task: normalizes one byte range of `path`.
+
+    Returns:
+        tuple: (UTF-8 output, counts)
+    """
+    start, end = byte_range
+    with s3_open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    fout = io.StringIO()
+    counts = normalize_stream(io.TextIOWrapper(io.BytesIO(data), encoding='utf-8'), fout)
+    return fout.getvalue().encode('utf-8'), counts
+
+
+def normalize_parallel(input_path, output_path, workers, chunk_bytes):
+    """
+    Normalizes byte-range chunks in a process pool and writes their output
+    in input order (smart_open uploads it as multipart parts).
+    """
+    ranges = chunk_ranges(input_path, chunk_bytes)
+    totals = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool, s3_open(output_path, 'wb') as fout:
+        task = partial(normalize_chunk, path=input_path)
+        for data, counts in bounded_map(pool, task, ranges, 2 * workers):
+            fout.write(data)
+            for name, value in counts.items():
+                totals[name] = totals.get(name, 0) + value
+    return totals, len(ranges)
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
 
-    print(f"✅ Normalization complete: s3://{BUCKET}/{OUTPUT_KEY}")
 
-    log_path = "s3://my-cc-pipeline-s3/logs/normalized_log.txt"
-    log_entry = f"{OUTPUT_KEY} | Kept: {kept}, Removed: {removed}\n"
-
-    with s3_open(log_path, 'w', encoding='utf-8') as log_file:
-        log_file.write(log_entry)
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default=INPUT_PATH, help="s3:// or local input file")
+    parser.add_argument("--output", default=OUTPUT_PATH, help="s3:// or local output file")
+    parser.add_argument("--workers", type=positive_int, default=1,
+                        help="Processes normalizing byte-range chunks (1 = serial); output is byte-identical")
+    parser.add_argument("--chunk_mb", type=positive_int, default=CHUNK_MB, help="Target chunk size for --workers > 1")
+    args = parser.parse_args()
+
+    # Keyed like the other stages (bucket key) unless --input points elsewhere
+    metrics = StageMetrics("text_normalize", args.input.removeprefix(f"s3://{BUCKET}/"))
+
+    if args.workers > 1:
+        counts, chunks = normalize_parallel(args.input, args.output, args.workers, args.chunk_mb << 20)
+        metrics.extra.update(workers=args.workers, chunks=chunks)
+    else:
+        with s3_open(args.input, 'r', encoding='utf-8') as fin, \
+             s3_open(args.output, 'w', encoding='utf-8') as fout:
+            counts = normalize_stream(fin, fout)
+
+    print(f"✅ Normalization complete: {args.output}")
+
+    record_counts(metrics, counts)
+    metrics.write()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,260 @@
+"""
+Module: run_fused.py
+
+Runs consecutive pipeline stages in one process, chaining each stage's
+line generator into the next instead of writing every intermediate file to
+S3 and parsing it again in the next container.
+
+Per-file stages (text_filter -> toxicity_filter -> deduplicate) run once
+per input key of the first selected stage, so --shard_index/--num_shards
+spread them over workers as with the separate scripts. Global stages
+(global_deduplicate -> text_normalize -> tokenize) run once over the whole
+corpus. global_deduplicate reads every deduplicated file, so a selection
+spanning both groups writes the deduplicate output and runs the global
+stages after all files (and only with a single shard).
+
+Only the last selected stage's output is written, unless --checkpoint also
+writes every intermediate output to its usual key, so the separate stage
+scripts can pick up from any boundary. Each stage still writes its own
+metrics record. Options not exposed here take the stage defaults; the
+stage scripts keep their full option sets.
+"""
+
+import argparse
+import importlib
+from contextlib import ExitStack
+import boto3
+from smart_open import open as s3_open
+from common.shards import open_shard
+from common.work import add_work_arguments, list_inputs, resolve_keys
+from common.metrics import StageMetrics
+from common.parallel import available_cpus
+
+s3 = boto3.client('s3')
+BUCKET = "my-cc-pipeline-s3"
+
+STAGES = ("text_filter", "toxicity_filter", "deduplicate",
+          "global_deduplicate", "text_normalize", "tokenize")
+FILE_STAGES = STAGES[:3]
+GLOBAL_STAGES = STAGES[3:]
+
+# Input listing (prefix, file tag) of each per-file stage
+FILE_STAGE_INPUTS = {
+    "text_filter": ("extracted/", "_extracted"),
+    "toxicity_filter": ("filtered/", "_filtered"),
+    "deduplicate": ("detoxified/", "_detoxified"),
+}
+
+
+def tee(lines, fout):
+    """
+    Writes every line to `fout` on its way through.
+    """
+    for line in lines:
+        fout.write(line)
+        yield line
+
+
+def tee_documents(docs, writer):
+    """
+    Writes every (doc_id, tokens) document to a token shard writer on its
+    way through.
+    """
+    for doc in docs:
+        writer.write_document(doc[1])
+        yield doc
+
+
+def text_filter_stage(args):
+    tf = importlib.import_module("filtering.text_filter")
+    settings = tf.LanguageSettings(mode=args.lang_mode or tf.LANG_MODE)
+    line_cache, lang_cache, doc_cache = tf.make_caches(
+        tf.DECISION_CACHE_MB if args.cache_mb is None else args.cache_mb, settings.mode)
+
+    def run(lines, key, metrics):
+        output_key = tf.output_key_for(key)
+        generator = tf.filter_lines(lines, metrics, settings, line_cache=line_cache, lang_cache=lang_cache,
+                                    doc_cache=doc_cache)
+        return generator, output_key, lambda: tf.report_file(metrics, f"s3://{BUCKET}/{output_key}")
+
+    return run, None
+
+
+def toxicity_filter_stage(args):
+    tox = importlib.import_module("filtering.toxicity_filter")
+    cascade_module = importlib.import_module("filtering.toxicity_cascade")
+    backend = tox.load_backend(args.backend or "torch", args.threads, args.onnx_dir or tox.ONNX_DIR)
+    batch_size = args.batch_size or tox.BATCH_SIZE
+    cascade = None
+    if args.lexicon:
+        cascade = cascade_module.ToxicityCascade(cascade_module.LexiconScorer.load(args.lexicon),
+                                                 tox.TOXICITY_THRESHOLD)
+
+    def run(lines, key, metrics):
+        output_key = tox.output_key_for(key)
+        generator = tox.toxicity_lines(lines, metrics, backend, batch_size, args.threads, cascade,
+                                       window_tokens=args.window_tokens)
+        return generator, output_key, lambda: tox.report_file(metrics, output_key)
+
+    return run, None
+
+
+def deduplicate_stage(args):
+    dd = importlib.import_module("deduplication.deduplicate")
+    engine = dd.MINHASH_ENGINE
+    if args.ngram not in (None, dd.NGRAM):
+        engine = dd.MinHashEngine(dd.NUM_PERM, ngram=args.ngram)
+    exact_index = None
+    if args.index_path:
+        lsh = dd.PersistentLSHIndex(args.index_path, dd.SIMILARITY_THRESHOLD, engine)
+        if args.exact_index != "none":
+            exact_index = lsh.exact
+    else:
+        lsh = dd.MinHashLSH(threshold=dd.SIMILARITY_THRESHOLD, num_perm=dd.NUM_PERM)
+        if args.exact_index != "none":
+            exact_index = dd.make_exact_index(args.exact_index)
+
+    def run(lines, key, metrics):
+        output_key = dd.output_key_for(key)
+        generator = dd.deduplicate_lines(lines, metrics, lsh, exact_index, engine)
+        return generator, output_key, lambda: dd.report_file(metrics, output_key)
+
+    return run, lsh.flush if args.index_path else None
+
+
+FILE_STAGE_SETUP = {
+    "text_filter": text_filter_stage,
+    "toxicity_filter": toxicity_filter_stage,
+    "deduplicate": deduplicate_stage,
+}
+
+
+def run_file(key, stages, runners, checkpoint):
+    """
+    Runs `stages` over one input key, writing the last stage's output (and
+    every stage's with `checkpoint`).
+    """
+    reports = []
+    with ExitStack() as stack:
+        lines = stack.enter_context(open_shard(f"s3://{BUCKET}/{key}", 'r'))
+        for i, stage in enumerate(stages):
+            metrics = StageMetrics(stage, key)
+            metrics.extra["fused_stages"] = list(stages)
+            lines, key, report = runners[stage](lines, key, metrics)
+            reports.append(report)
+            if checkpoint or i == len(stages) - 1:
+                lines = tee(lines, stack.enter_context(open_shard(f"s3://{BUCKET}/{key}", 'w')))
+        for _ in lines:
+            pass
+    for report in reports:
+        report()
+
+
+def run_global(stages, checkpoint, token_format="jsonl", shard_mb=None):
+    """
+    Runs the selected global stages in one chain over the whole corpus.
+    """
+    reports = []
+    with ExitStack() as stack:
+        lines = None
+        for i, stage in enumerate(stages):
+            finish = None
+            if stage == "global_deduplicate":
+                gd = importlib.import_module("deduplication.global_deduplicate")
+                metrics = StageMetrics(stage, gd.FINAL_OUTPUT_KEY)
+                lines = gd.deduplicate_documents(list_inputs(gd.INPUT_ROOT, "_deduped", s3), metrics)
+                output_path = gd.FINAL_OUTPUT_PATH
+
+            elif stage == "text_normalize":
+                tn = importlib.import_module("normalization.text_normalize")
+                metrics = StageMetrics(stage, tn.INPUT_KEY)
+                if lines is None:
+                    lines = stack.enter_context(s3_open(tn.INPUT_PATH, 'r', encoding='utf-8'))
+                counts = {}
+                lines = tn.normalize_lines(lines, counts)
+                output_path = tn.OUTPUT_PATH
+                finish = lambda metrics=metrics, counts=counts: tn.record_counts(metrics, counts)
+
+            else:
+                tk = importlib.import_module("tokenization.tokenize_llama")
+                metrics = StageMetrics(stage, tk.input_key)
+                if lines is None:
+                    lines = stack.enter_context(s3_open(tk.input_path, 'r', encoding='utf-8'))
+                if token_format == "bin":
+                    writer = stack.enter_context(tk.token_shard_writer(shard_mb or tk.SHARD_MB))
+                    lines = tee_documents(tk.tokenize_docs(lines, metrics), writer)
+                    output_path = tk.bin_output_base + ".json"
+                    finish = lambda metrics=metrics, writer=writer: tk.record_shards(metrics, writer)
+                else:
+                    lines = tk.tokenize_lines(lines, metrics)
+                    output_path = tk.output_path
+
+            metrics.extra["fused_stages"] = list(stages)
+            reports.append((metrics, output_path, finish))
+            if stage == "tokenize" and token_format == "bin":
+                continue  # written by the shard writer
+            if checkpoint or i == len(stages) - 1:
+                lines = tee(lines, stack.enter_context(s3_open(output_path, 'w', encoding='utf-8')))
+        for _ in lines:
+            pass
+
+    for metrics, output_path, finish in reports:
+        if finish is not None:
+            finish()
+        metrics.write()
+        print(f"✅ {metrics.stage} complete: {output_path} | {dict(metrics.counts)}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(FILE_STAGES),
+                        help="Consecutive stages to run fused in this process")
+    parser.add_argument("--checkpoint", action="store_true",
+                        help="Also write every intermediate stage output to its usual S3 key")
+    # Stage options, as on the stage scripts (unset: the stage's default)
+    parser.add_argument("--lang_mode", choices=["line", "document"], help="text_filter")
+    parser.add_argument("--cache_mb", type=int, help="text_filter")
+    parser.add_argument("--backend", help="toxicity_filter")
+    parser.add_argument("--onnx_dir", help="toxicity_filter")
+    parser.add_argument("--batch_size", type=int, help="toxicity_filter")
+    parser.add_argument("--threads", type=int, default=available_cpus(), help="toxicity_filter")
+    parser.add_argument("--window_tokens", type=int, default=0, help="toxicity_filter")
+    parser.add_argument("--lexicon", help="toxicity_filter")
+    parser.add_argument("--exact_index", choices=["set", "bloom", "none"], default="set", help="deduplicate")
+    parser.add_argument("--index_path", help="deduplicate")
+    parser.add_argument("--ngram", type=int, help="deduplicate")
+    parser.add_argument("--output_format", choices=["jsonl", "bin"], default="jsonl", help="tokenize")
+    parser.add_argument("--shard_mb", type=int, help="tokenize")
+    add_work_arguments(parser)
+    args = parser.parse_args()
+
+    first = STAGES.index(args.stages[0])
+    stages = STAGES[first:first + len(args.stages)]
+    if list(stages) != args.stages:
+        parser.error(f"--stages must be consecutive pipeline stages in order: {' '.join(STAGES)}")
+
+    file_stages = [stage for stage in stages if stage in FILE_STAGES]
+    global_stages = [stage for stage in stages if stage in GLOBAL_STAGES]
+    if file_stages and global_stages and args.num_shards > 1:
+        parser.error("a selection spanning per-file and global stages needs a single shard")
+
+    if file_stages:
+        runners = {}
+        closers = []
+        for stage in file_stages:
+            runners[stage], close = FILE_STAGE_SETUP[stage](args)
+            if close is not None:
+                closers.append(close)
+
+        prefix, tag = FILE_STAGE_INPUTS[file_stages[0]]
+        for key in resolve_keys(args, s3, BUCKET, prefix, tag):
+            run_file(key, file_stages, runners, args.checkpoint)
+        for close in closers:
+            close()
+
+    if global_stages:
+        run_global(global_stages, args.checkpoint, args.output_format, args.shard_mb)
+
+
+if __name__ == "__main__":
+    main()
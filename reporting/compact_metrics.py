@@ -0,0 +1,78 @@
+"""
+Module: compact_metrics.py
+
+Merges the per-task metrics records of one pipeline run into a single
+report at `logs/metrics/<run_id>/report.json` and prints a summary per stage.
+"""
+
+import argparse
+import json
+import os
+import boto3
+from smart_open import open as s3_open
+from common.metrics import DEFAULT_RUN_ID, METRICS_PREFIX, current_run_id, merge_records
+
+s3 = boto3.client('s3')
+REPORT_NAME = "report.json"
+
+
+def record_paths(run_id, prefix=METRICS_PREFIX):
+    """
+    Paths of every task record of the run under an s3:// or local metrics
+    prefix (S3 listing is paginated, so any number of tasks).
+    """
+    run_prefix = f"{prefix}/{run_id}/"
+    if not run_prefix.startswith("s3://"):
+        for directory, _, files in sorted(os.walk(run_prefix)):
+            for name in sorted(files):
+                path = os.path.join(directory, name)
+                if name.endswith(".json") and path != run_prefix + REPORT_NAME:
+                    yield path
+        return
+
+    bucket, _, key_prefix = run_prefix[len("s3://"):].partition("/")
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=key_prefix):
+        for obj in page.get('Contents', []):
+            key = obj['Key']
+            if key.endswith(".json") and key != key_prefix + REPORT_NAME:
+                yield f"s3://{bucket}/{key}"
+
+
+def load_records(run_id, prefix=METRICS_PREFIX):
+    """
+    Reads every task record of the run.
+    """
+    records = []
+    for path in record_paths(run_id, prefix):
+        with s3_open(path, 'r', encoding='utf-8') as f:
+            records.append(json.load(f))
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--run_id", default=current_run_id(),
+                        help="Pipeline run to compact (default: PIPELINE_RUN_ID)")
+    args = parser.parse_args()
+    if args.run_id == DEFAULT_RUN_ID:
+        # No run named: this process's fresh ad-hoc id has no records
+        parser.error("--run_id is required when PIPELINE_RUN_ID is not set")
+
+    records = load_records(args.run_id)
+    report = {"run_id": args.run_id, "stages": merge_records(records)}
+
+    report_path = f"{METRICS_PREFIX}/{args.run_id}/{REPORT_NAME}"
+    if "://" not in report_path:
+        os.makedirs(os.path.dirname(report_path), exist_ok=True)
+    with s3_open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+
+    for stage, summary in report["stages"].items():
+        print(f"📊 {stage}: {summary['tasks']} tasks, {summary['records']} records, "
+              f"{summary['records_per_sec']} records/sec, counts={summary['counts']}")
+    print(f"✅ Metrics report: {report_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,9 @@ locals {
   definition = templatefile("${path.module}/definition.asl.json", {
     job_queue_arn       = var.job_queue_arn
     job_definition_arns = var.job_definition_arns
+    ingest_batch_size   = var.ingest_batch_size
+    num_shards          = var.num_shards
+    last_shard_index    = var.num_shards - 1
   })
 }
 
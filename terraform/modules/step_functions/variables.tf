@@ -2,3 +2,15 @@ variable "state_machine_name" { type = string }
 variable "role_arn"           { type = string }
 variable "job_queue_arn"      { type = string }
 variable "job_definition_arns"{ type = map(string) }
+
+variable "ingest_batch_size" {
+  type        = number
+  default     = 10
+  description = "WET URLs handled by each ingest container"
+}
+
+variable "num_shards" {
+  type        = number
+  default     = 10
+  description = "Parallel workers for the text and toxicity filter stages"
+}
@@ -0,0 +1,35 @@
+"""
+Shared test helpers. Stage modules create their S3 client, config and
+models at import time; `import_with` imports a stage with stand-ins for
+those modules and restores `sys.modules` afterwards.
+"""
+
+import importlib
+import sys
+import types
+from contextlib import contextmanager
+
+
+@contextmanager
+def import_with(module_name, stand_ins):
+    """
+    Imports `module_name` with `stand_ins` (module name -> module object)
+    in place of the real modules, yielding the freshly imported module.
+    """
+    saved = {name: sys.modules.get(name) for name in set(stand_ins) | {module_name}}
+    sys.modules.update(stand_ins)
+    sys.modules.pop(module_name, None)
+    try:
+        yield importlib.import_module(module_name)
+    finally:
+        for name, module in saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+
+def fake_boto3():
+    boto3 = types.ModuleType("boto3")
+    boto3.client = lambda *args, **kwargs: None
+    return boto3
@@ -0,0 +1,32 @@
+"""
+Tests for common/decision_cache.py.
+"""
+
+from common.decision_cache import DecisionCache
+
+
+class _SameHash(str):
+    """A line whose hash collides with every other _SameHash line."""
+
+    def __hash__(self):
+        return 42
+
+
+def test_colliding_hashes_do_not_share_an_entry():
+    cache = DecisionCache(1024 * 1024)
+    cache.put(_SameHash("Home | About | Contact"), ("boilerplate",))
+
+    assert cache.get(_SameHash("A different line of article text.")) is None
+    assert cache.get(_SameHash("Home | About | Contact")) == ("boilerplate",)
+
+
+def test_evicts_least_recently_used_within_budget():
+    cache = DecisionCache(1000)
+    for i in range(50):
+        cache.put(f"line {i}", (i,))
+        cache.get("line 0")
+
+    assert cache.bytes <= 1000
+    assert cache.get("line 0") == (0,)
+    assert cache.get("line 1") is None
+    assert cache.evictions > 0
@@ -0,0 +1,44 @@
+"""
+Tests for common/keyword_matcher.py: every query must agree with plain
+`keyword.lower() in text.lower()` checks, on both the direct path (few
+keywords) and the compiled-trie path.
+"""
+
+import random
+import pytest
+from common.keyword_matcher import SCAN_MIN_KEYWORDS, KeywordMatcher
+
+ALPHABET = "abcAB .-"
+
+
+def _random_word(rng, max_len):
+    return "".join(rng.choice(ALPHABET) for _ in range(rng.randint(1, max_len)))
+
+
+@pytest.mark.parametrize("num_keywords", [3, SCAN_MIN_KEYWORDS + 16])
+def test_matches_naive_substring_checks(num_keywords):
+    rng = random.Random(num_keywords)
+    for _ in range(50):
+        # Short keywords over a small alphabet overlap and nest often
+        keywords = [_random_word(rng, 4) for _ in range(num_keywords)]
+        matcher = KeywordMatcher(keywords)
+        for _ in range(20):
+            text = _random_word(rng, 30)
+            lowered = text.lower()
+            hits = {k for k in keywords if k.lower() in lowered}
+
+            assert matcher.any_match(text) == bool(hits)
+            assert matcher.all_match(text) == all(k.lower() in lowered for k in keywords)
+            assert {k.lower() for k in matcher.find_all(text)} == {k.lower() for k in hits}
+            first = matcher.first_match(text)
+            if hits:
+                assert lowered.find(first.lower()) == min(lowered.find(k.lower()) for k in hits)
+            else:
+                assert first is None
+
+
+def test_empty_keyword_lists_and_keywords():
+    assert not KeywordMatcher([]).any_match("anything")
+    assert KeywordMatcher([]).all_match("anything")
+    assert KeywordMatcher(["", "zzz"]).any_match("anything")
+    assert not KeywordMatcher(["", "zzz"]).all_match("anything")
@@ -0,0 +1,75 @@
+"""
+Tests for common/lsh_index.py: an index reopened after flush answers like
+the one that wrote it, compaction keeps every key, and batched exact
+lookups give the same answers as one-by-one lookups.
+"""
+
+import functools
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("datasketch")
+
+from common import lsh_index  # noqa: E402
+from common.lsh_index import MAX_SEGMENTS, PersistentLSHIndex  # noqa: E402
+from common.minhash import MinHashEngine  # noqa: E402
+
+THRESHOLD = 0.8
+DOCS = [f"document number {i} about topic {i % 7} with some shared filler words" for i in range(30)]
+
+
+def _open(path, **kwargs):
+    return PersistentLSHIndex(str(path), THRESHOLD, MinHashEngine(num_perm=64), **kwargs)
+
+
+def test_reopen_after_flush(tmp_path):
+    index = _open(tmp_path)
+    engine = MinHashEngine(num_perm=64)
+    for i, minhash in enumerate(engine.minhashes(DOCS[:20])):
+        index.insert(i, minhash)
+    assert index.add_exact_many([1, 2, 3]).tolist() == [False, False, False]
+    index.flush()
+
+    reopened = _open(tmp_path)
+    assert reopened.segments == index.segments
+    assert reopened.exact_count() == 3
+    assert all(reopened.query(m) for m in engine.minhashes(DOCS[:20]))
+    assert reopened.add_exact_many([3, 4, 4]).tolist() == [True, False, True]
+
+
+def test_reopen_rejects_other_parameters(tmp_path):
+    _open(tmp_path).flush()
+    _open(tmp_path).add_segment(exact=[1])
+    with pytest.raises(ValueError):
+        PersistentLSHIndex(str(tmp_path), 0.5, MinHashEngine(num_perm=64))
+
+
+def test_compact_merges_every_segment(tmp_path, monkeypatch):
+    # Tiny merge blocks exercise the block boundaries of the k-way merge
+    monkeypatch.setattr(lsh_index, "_merge_sorted", functools.partial(lsh_index._merge_sorted, block=7))
+    rng = np.random.default_rng(0)
+    index = _open(tmp_path)
+    bands, exact = [], []
+    for _ in range(MAX_SEGMENTS + 1):
+        bands.append(rng.integers(0, 5000, 300, dtype=np.uint64))
+        exact.append(rng.integers(0, 2000, 50, dtype=np.uint64))
+        index.add_segment(bands=bands[-1], exact=exact[-1], compact=False)
+    index.add_segment(exact=[])
+    assert len(index.segments) == 1
+
+    reopened = _open(tmp_path)
+    np.testing.assert_array_equal(reopened._band_tables[0], np.unique(np.concatenate(bands)))
+    np.testing.assert_array_equal(reopened._exact_tables[0], np.unique(np.concatenate(exact)))
+    assert len(reopened.retired) == MAX_SEGMENTS + 2
+
+
+def test_add_exact_many_matches_add_exact(tmp_path):
+    values = np.random.default_rng(1).integers(0, 3000, 5000, dtype=np.uint64)
+    one_by_one = _open(tmp_path / "one", buffer_items=700)
+    batched = _open(tmp_path / "batched", buffer_items=700)
+
+    expected = [one_by_one.add_exact(int(v)) for v in values]
+    got = [bool(x) for i in range(0, len(values), 333) for x in batched.add_exact_many(values[i:i + 333])]
+
+    assert got == expected
+    assert batched.exact_count() == one_by_one.exact_count() == len(np.unique(values))
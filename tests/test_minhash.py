@@ -0,0 +1,48 @@
+"""
+Tests for common/minhash.py: batched signatures must equal a
+`datasketch.MinHash` built per text with one `update()` per shingle.
+"""
+
+import pytest
+
+datasketch = pytest.importorskip("datasketch")
+np = pytest.importorskip("numpy")
+
+from common.minhash import MinHashEngine  # noqa: E402
+
+TEXTS = [
+    "the quick brown fox jumps over the lazy dog",
+    "the quick brown fox jumps over the lazy cat",
+    "Café crème — naïve résumé",
+    "",
+    "   ",
+    "one",
+    "repeat repeat repeat repeat",
+] + [f"document {i} shares some words with document {i + 1}" for i in range(40)]
+
+
+def _reference(text, engine):
+    m = datasketch.MinHash(num_perm=engine.num_perm, seed=engine.seed)
+    for shingle in engine.shingles(text):
+        m.update(shingle.encode('utf-8'))
+    return m
+
+
+@pytest.mark.parametrize("ngram", [1, 3])
+@pytest.mark.parametrize("chunk_tokens", [5, 8192])
+def test_signatures_match_datasketch(ngram, chunk_tokens):
+    engine = MinHashEngine(num_perm=64, seed=7, ngram=ngram, chunk_tokens=chunk_tokens)
+    signatures = engine.signatures(TEXTS)
+
+    assert signatures.shape == (len(TEXTS), 64)
+    for text, row in zip(TEXTS, signatures):
+        np.testing.assert_array_equal(row, _reference(text, engine).hashvalues)
+
+
+def test_minhashes_equal_datasketch_objects():
+    engine = MinHashEngine(num_perm=128)
+    a, b = engine.minhashes(TEXTS[:2])
+    ref_a, ref_b = (_reference(text, engine) for text in TEXTS[:2])
+
+    assert a == ref_a
+    assert a.jaccard(b) == ref_a.jaccard(ref_b)
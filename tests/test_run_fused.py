@@ -0,0 +1,178 @@
+"""
+Tests for pipeline/run_fused.py: the per-file stages chained in one
+process must write the same output and counts as the stage scripts' own
+per-file functions run one after another.
+
+The stages' config, fastText model, Detoxify backend and S3 client are
+replaced with stand-ins, and s3://my-cc-pipeline-s3/ paths are redirected
+to a temporary directory, so the real stage code runs on a tiny local
+input. Run from the repo root: python -m pytest tests
+"""
+
+import argparse
+import json
+import types
+from contextlib import ExitStack
+import pytest
+from conftest import fake_boto3, import_with
+
+pytest.importorskip("datasketch")
+pytest.importorskip("justext")
+
+BUCKET_URI = "s3://my-cc-pipeline-s3/"
+INPUT_KEY = "extracted/sample_extracted.txt"
+
+
+class _Config(dict):
+    def __getattr__(self, name):
+        return self[name]
+
+
+class _Initialize:
+    def __init__(self, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _LanguageModel:
+    """English for lines containing "the", Spanish otherwise."""
+
+    def predict(self, texts):
+        return ([["__label__en" if " the " in f" {t} " else "__label__es"] for t in texts],
+                [[0.95] for _ in texts])
+
+
+class _KeywordBackend:
+    name = "keyword"
+
+    def score(self, texts):
+        return [0.9 if "toxic" in text else 0.1 for text in texts]
+
+
+def _stand_ins():
+    cfg = _Config(filters=_Config(boilerplate_phrases=["cookie policy"],
+                                  section_cutoff_phrases=["references"],
+                                  min_word_count=3, punctuation_ratio_threshold=0.5),
+                  deduplication=_Config(similarity_threshold=0.8, num_perm=128))
+    hydra = types.ModuleType("hydra")
+    hydra.initialize = _Initialize
+    hydra.compose = lambda **kwargs: cfg
+    fasttext = types.ModuleType("fasttext")
+    fasttext.load_model = lambda path: _LanguageModel()
+    backends = types.ModuleType("filtering.toxicity_backends")
+    backends.BACKENDS = ("keyword",)
+    backends.ONNX_DIR = None
+    backends.load_backend = lambda name, threads=None, onnx_dir=None: _KeywordBackend()
+    return {"hydra": hydra, "fasttext": fasttext, "boto3": fake_boto3(),
+            "filtering.toxicity_backends": backends}
+
+
+@pytest.fixture(scope="module")
+def modules():
+    stand_ins = _stand_ins()
+    names = ("filtering.text_filter", "filtering.toxicity_filter",
+             "deduplication.deduplicate", "pipeline.run_fused")
+    with ExitStack() as stack:
+        yield types.SimpleNamespace(**{
+            name.split(".")[1]: stack.enter_context(import_with(name, stand_ins)) for name in names
+        })
+
+
+@pytest.fixture
+def bucket(tmp_path, monkeypatch):
+    """
+    Redirects bucket paths opened by the shard and metrics helpers to a
+    local root; returns a function that selects the root in use.
+    """
+    from common import metrics, shards
+
+    root = {"path": tmp_path}
+    real_open = shards.s3_open
+
+    def local_open(path, mode='r', *args, **kwargs):
+        if path.startswith(BUCKET_URI):
+            local = root["path"] / path[len(BUCKET_URI):]
+            local.parent.mkdir(parents=True, exist_ok=True)
+            path = str(local)
+            kwargs.pop("transport_params", None)
+        return real_open(path, mode, *args, **kwargs)
+
+    monkeypatch.setattr(shards, "s3_open", local_open)
+    monkeypatch.setattr(metrics, "s3_open", local_open)
+
+    def use(name):
+        root["path"] = tmp_path / name
+        (root["path"] / INPUT_KEY).parent.mkdir(parents=True, exist_ok=True)
+        (root["path"] / INPUT_KEY).write_text(sample_input(), encoding='utf-8')
+        return root["path"]
+
+    return use
+
+
+def sample_input():
+    lines = []
+    for doc in range(12):
+        lines += ["[DOC_START]", f"URL: https://example.com/{doc}"]
+        lines += [
+            f"Document {doc} explains the installation steps in plain words for readers.",
+            "This shared paragraph about the warranty repeats across every page here.",
+            f"Una frase en otro idioma número {doc} que se descarta.",
+            f"A toxic remark number {doc} that the scorer flags on the page.",
+            "Please read the cookie policy before you continue on this site.",
+            f"The closing line {doc % 3} repeats on some of the pages in the sample.",
+            "ok",
+        ]
+    return "\n".join(lines) + "\n"
+
+
+def _counts(root):
+    counts = {}
+    for path in sorted(root.glob("logs/metrics/**/*.json")):
+        record = json.loads(path.read_text(encoding='utf-8'))
+        counts[record["stage"]] = record["counts"]
+    return counts
+
+
+@pytest.mark.parametrize("lang_mode", ["line", "document"])
+def test_fused_file_stages_match_staged(modules, bucket, lang_mode):
+    tf, tox, dd, fused = modules.text_filter, modules.toxicity_filter, modules.deduplicate, modules.run_fused
+
+    staged_root = bucket("staged")
+    settings = tf.LanguageSettings(mode=lang_mode)
+    line_cache, lang_cache, doc_cache = tf.make_caches(tf.DECISION_CACHE_MB, lang_mode)
+    tf.filter_file(INPUT_KEY, settings, line_cache=line_cache, lang_cache=lang_cache, doc_cache=doc_cache)
+    filtered_key = tf.output_key_for(INPUT_KEY)
+    tox.filter_toxicity(filtered_key, _KeywordBackend(), threads=1)
+    detoxified_key = tox.output_key_for(filtered_key)
+    dd.deduplicate_file(detoxified_key, dd.MinHashLSH(threshold=dd.SIMILARITY_THRESHOLD, num_perm=dd.NUM_PERM),
+                        dd.make_exact_index("set"))
+    output_key = dd.output_key_for(detoxified_key)
+
+    fused_root = bucket("fused")
+    args = argparse.Namespace(lang_mode=lang_mode, cache_mb=None, backend=None, onnx_dir=None, batch_size=None,
+                              threads=1, window_tokens=0, lexicon=None, exact_index="set",
+                              index_path=None, ngram=None)
+    runners = {stage: fused.FILE_STAGE_SETUP[stage](args)[0] for stage in fused.FILE_STAGES}
+    fused.run_file(INPUT_KEY, fused.FILE_STAGES, runners, checkpoint=False)
+
+    staged_output = (staged_root / output_key).read_text(encoding='utf-8')
+    assert (fused_root / output_key).read_text(encoding='utf-8') == staged_output
+    # Only the last stage's output is written without --checkpoint
+    assert not (fused_root / filtered_key).exists()
+    assert not (fused_root / detoxified_key).exists()
+    assert _counts(fused_root) == _counts(staged_root)
+    assert len(_counts(staged_root)) == 3
+
+    # The sample exercises every stage: language, toxicity and duplicates
+    # (document mode keeps the stray Spanish line of an English document)
+    assert ("Una frase" in staged_output) == (lang_mode == "document")
+    assert "toxic" not in staged_output
+    assert staged_output.count("shared paragraph") == 1
+    # Document samples are cached apart from line texts
+    filter_counts = _counts(staged_root)["text_filter"]
+    assert ("doc_cache_lookups" in filter_counts) == (lang_mode == "document")
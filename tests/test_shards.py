@@ -0,0 +1,67 @@
+"""
+Tests for common/shards.py on local paths: records written through
+ShardedWriter read back unchanged through open_shard for every
+compression, and is_shard_key recognizes every shard layout.
+"""
+
+import random
+import pytest
+from common.shards import COMPRESSION_SUFFIXES, ShardedWriter, is_shard_key, open_shard, shard_path
+
+# Random hex so compressed shards still fill up past the compressors' buffers
+_rng = random.Random(0)
+RECORDS = [f"line {i} café — {_rng.randbytes(100 + i % 50).hex()}\n" for i in range(3000)]
+
+
+@pytest.mark.parametrize("compression", sorted(COMPRESSION_SUFFIXES))
+@pytest.mark.parametrize("shard_size", [None, 64 * 1024])
+def test_round_trip(tmp_path, compression, shard_size):
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    base = str(tmp_path / "doc_extracted")
+    with ShardedWriter(base, compression, shard_size) as writer:
+        for record in RECORDS:
+            writer.write_record(record)
+
+    if shard_size:
+        assert len(writer.paths) > 1
+        assert writer.paths[0] == shard_path(base, 0, compression)
+    else:
+        assert writer.paths == [shard_path(base, None, compression)]
+    assert writer.records == len(RECORDS)
+    assert writer.bytes_in == sum(len(r.encode('utf-8')) for r in RECORDS)
+
+    read = []
+    for path in writer.paths:
+        with open_shard(path) as f:
+            read.extend(f)
+    assert read == RECORDS
+
+
+def test_nothing_is_created_without_records(tmp_path):
+    with ShardedWriter(str(tmp_path / "empty_extracted"), "gzip") as writer:
+        pass
+    assert writer.paths == []
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize("key", [
+    "extracted/doc_extracted.txt",
+    "extracted/doc_extracted.txt.gz",
+    "extracted/doc_extracted.txt.zst",
+    "extracted/doc_extracted-00000.txt",
+    "extracted/doc_extracted-00042.txt.zst",
+])
+def test_is_shard_key_accepts_every_layout(key):
+    assert is_shard_key(key, "_extracted")
+
+
+@pytest.mark.parametrize("key", [
+    "extracted/doc_filtered.txt",
+    "extracted/doc_extracted.txt.bz2",
+    "extracted/doc_extracted-1.txt",
+    "extracted/doc_extracted.txt.gz.tmp",
+    "extracted/doc_extracted.json",
+])
+def test_is_shard_key_rejects_other_files(key):
+    assert not is_shard_key(key, "_extracted")
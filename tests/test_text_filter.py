@@ -0,0 +1,78 @@
+"""
+Tests for filtering/text_filter.py main-content extraction.
+
+The stage loads its Hydra config, the fastText model and an S3 client at
+import time; those are replaced with stand-ins here so jusText (the part
+under test) runs for real. Run from the repo root: python -m pytest tests
+"""
+
+import types
+import pytest
+from conftest import fake_boto3, import_with
+
+justext = pytest.importorskip("justext")
+
+
+class _Config(dict):
+    def __getattr__(self, name):
+        return self[name]
+
+
+class _Initialize:
+    def __init__(self, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+@pytest.fixture(scope="module")
+def text_filter():
+    cfg = _Config(filters=_Config(boilerplate_phrases=["cookie policy"], section_cutoff_phrases=["references"]))
+    hydra = types.ModuleType("hydra")
+    hydra.initialize = _Initialize
+    hydra.compose = lambda **kwargs: cfg
+    fasttext = types.ModuleType("fasttext")
+    fasttext.load_model = lambda path: None
+
+    stand_ins = {"hydra": hydra, "fasttext": fasttext, "boto3": fake_boto3()}
+    with import_with("filtering.text_filter", stand_ins) as module:
+        yield module
+
+
+ARTICLE = [
+    "Home | About | Contact",
+    "The recommended drill bit for these anchors is a masonry bit with a diameter of "
+    "< 5 mm, which keeps the plug tight in the wall and stops it from turning when the "
+    "screw is driven in, even in older brick that has become soft over the years.",
+    "After drilling, clean the dust out of the hole with a small brush or a blast of air, "
+    "because dust left in the hole reduces the grip of the plug and the screw may work "
+    "loose over time if the fixing has to carry a heavy shelf or cabinet.",
+    "Copyright 2024 Example Ltd. All rights reserved.",
+]
+
+
+def test_literal_less_than_is_text_not_markup(text_filter):
+    content = text_filter.extract_main_content("\n".join(ARTICLE))
+    lines = content.splitlines()
+
+    # Each line is classified on its own: the article survives intact...
+    assert ARTICLE[1] in lines
+    assert ARTICLE[2] in lines
+    # ...and the navigation and copyright boilerplate around it is dropped
+    assert ARTICLE[0] not in lines
+    assert ARTICLE[3] not in lines
+
+
+def test_markup_like_text_is_kept_verbatim(text_filter):
+    line = ("In the template, write <b>bold</b> around the warning and & between the two "
+            "names, then save the file and reload the page so the browser picks up the "
+            "change before you compare the output with the reference rendering again.")
+    assert text_filter.extract_main_content(line) == line
+
+
+def test_blank_text(text_filter):
+    assert text_filter.extract_main_content(" \n\n ") == ""
@@ -0,0 +1,56 @@
+"""
+Tests for common/token_shards.py: documents written with TokenShardWriter
+read back unchanged through TokenShards, across shard boundaries and for
+both token dtypes.
+"""
+
+import json
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from common.token_shards import TokenShards, TokenShardWriter, dtype_for_vocab  # noqa: E402
+
+
+def _documents(vocab_size, count=200):
+    rng = np.random.default_rng(vocab_size)
+    # Include empty documents, which add an offset but no tokens
+    return [rng.integers(0, vocab_size, rng.integers(0, 60)) for _ in range(count)]
+
+
+@pytest.mark.parametrize("vocab_size", [32000, 128256])
+@pytest.mark.parametrize("shard_size", [None, 1024])
+def test_round_trip(tmp_path, vocab_size, shard_size):
+    base = str(tmp_path / "doc_tokens")
+    documents = _documents(vocab_size)
+    with TokenShardWriter(base, dtype_for_vocab(vocab_size), shard_size) as writer:
+        for tokens in documents:
+            writer.write_document(tokens)
+
+    shards = TokenShards(base)
+    assert len(shards) == len(documents)
+    assert shards.num_shards == (1 if shard_size is None else len(writer.shards))
+    if shard_size:
+        assert shards.num_shards > 1
+    for doc_id, tokens in enumerate(documents):
+        np.testing.assert_array_equal(shards.document(doc_id), tokens)
+
+    with open(base + ".json", encoding='utf-8') as f:
+        manifest = json.load(f)
+    assert manifest["dtype"] == ("uint16" if vocab_size <= 1 << 16 else "uint32")
+    assert manifest["tokens"] == sum(len(tokens) for tokens in documents)
+    assert sum(shard["documents"] for shard in manifest["shards"]) == len(documents)
+
+
+def test_offsets_index_the_bin_file(tmp_path):
+    base = str(tmp_path / "doc_tokens")
+    with TokenShardWriter(base, np.uint16) as writer:
+        writer.write_document([1, 2, 3])
+        writer.write_document([])
+        writer.write_document([4])
+
+    shard = TokenShards(base).shard(0)
+    assert shard.offsets.tolist() == [0, 3, 3, 4]
+    assert shard.token_range(0, shard.num_tokens).tolist() == [1, 2, 3, 4]
+    with pytest.raises(IndexError):
+        shard.document(3)
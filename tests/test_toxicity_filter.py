@@ -0,0 +1,97 @@
+"""
+Tests for the forked scoring path of filtering/toxicity_filter.py
+(--workers). The Detoxify backends are replaced by a keyword scorer that
+records its thread setting, so the real fork pool, initializer and
+windowed ordering run without the model.
+"""
+
+import io
+import os
+import types
+import pytest
+from conftest import fake_boto3, import_with
+
+if not hasattr(os, "fork"):
+    pytest.skip("the scoring pool forks", allow_module_level=True)
+
+
+class KeywordBackend:
+    name = "keyword"
+
+    def __init__(self, threads):
+        self.threads = threads
+        self.pid = os.getpid()
+
+    def set_threads(self, threads):
+        self.threads = threads
+
+    def score(self, texts):
+        return [0.9 if "toxic" in text else 0.1 for text in texts]
+
+
+class ThreadsBackend(KeywordBackend):
+    """Scores every text with (pid, thread setting) of the scoring process."""
+
+    def score(self, texts):
+        return [(os.getpid(), self.threads) for _ in texts]
+
+
+@pytest.fixture(scope="module")
+def toxicity_filter():
+    backends = types.ModuleType("filtering.toxicity_backends")
+    backends.BACKENDS = ("keyword",)
+    backends.ONNX_DIR = None
+    backends.load_backend = lambda name, threads=None, onnx_dir=None: KeywordBackend(threads)
+
+    stand_ins = {"boto3": fake_boto3(), "filtering.toxicity_backends": backends}
+    with import_with("filtering.toxicity_filter", stand_ins) as module:
+        yield module
+
+
+def sample_file():
+    lines = []
+    for doc in range(40):
+        lines += ["[DOC_START]\n", f"URL: https://example.com/{doc}\n"]
+        lines += [f"doc {doc} line {i} {'toxic' if (doc + i) % 7 == 0 else 'fine'} " + "word " * (i % 9) + "\n"
+                  for i in range(30)]
+    return "".join(lines)
+
+
+def run(tox, pool=None, workers=1, **kwargs):
+    metrics = types.SimpleNamespace(records=0, bytes_in=0, bytes_out=0, extra={}, counts={},
+                                    update=lambda **counts: metrics.counts.update(counts))
+    backend = KeywordBackend(1)
+    lines = list(tox.toxicity_lines(io.StringIO(sample_file()), metrics, backend, batch_size=8,
+                                    pool=pool, workers=workers, **kwargs))
+    return lines, metrics.counts
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"window_tokens": 40}, {"window_tokens": 40, "rescore": True}])
+def test_forked_workers_match_serial(toxicity_filter, kwargs):
+    serial = run(toxicity_filter, **kwargs)
+
+    pool = toxicity_filter.make_pool(KeywordBackend(1), 3, 2)
+    try:
+        forked = run(toxicity_filter, pool, 3, **kwargs)
+    finally:
+        pool.shutdown()
+
+    assert forked == serial
+    assert serial[1]["removed"] > 0
+
+
+def test_workers_set_threads_after_fork(toxicity_filter):
+    backend = ThreadsBackend(1)
+    pool = toxicity_filter.make_pool(backend, 2, 3)
+    try:
+        items = ((i, f"line {i}") for i in range(200))
+        scored = list(toxicity_filter.score_items(items, backend, 8, pool, 2))
+    finally:
+        pool.shutdown()
+
+    assert [payload for payload, _ in scored] == list(range(200))
+    pids = {pid for _, (pid, _) in scored}
+    assert os.getpid() not in pids
+    assert {threads for _, (_, threads) in scored} == {3}
+    # The parent's copy keeps the single-threaded setting it was loaded with
+    assert backend.threads == 1
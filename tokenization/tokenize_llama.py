@@ -2,13 +2,27 @@
 Module: tokenize_llama.py
 
 Tokenizes normalized text files using Hugging Face's LLaMA tokenizer.
-Outputs JSONL files: {"tokens": [...], "doc_id": "..."}
+Outputs JSONL files: {"tokens": [...], "doc_id": "..."}, or with
+--output_format bin, binary token shards (common/token_shards.py): flat
+uint16/uint32 token arrays plus per-document offset indexes, sharded by
+--shard_mb, that the trainer memory-maps instead of parsing JSON.
+
+Documents are encoded in batches (up to BATCH_DOCS documents or
+BATCH_CHARS characters each) with the fast tokenizer's batch call, which
+spreads a batch over its Rust thread pool; ids and output order are the
+same as encoding one document at a time.
 """
 
+import argparse
+import os
+import time
 import boto3
 from smart_open import open as s3_open
 import json
 from transformers import LlamaTokenizerFast
+from common.metrics import StageMetrics
+from common.parallel import available_cpus
+from common.token_shards import TokenShardWriter, dtype_for_vocab
 
 
 s3 = boto3.client('s3')
@@ -19,59 +33,184 @@ output_key = "tokenized/global_tokenized.jsonl"
 input_path = f"s3://{bucket}/{input_key}"
 output_path = f"s3://{bucket}/{output_key}"
 
-# Initialize LLaMA tokenizer
-tokenizer = LlamaTokenizerFast.from_pretrained("hf-internal-testing/llama-tokenizer")
+# Binary output: <base>-NNNNN.bin / .idx shards and <base>.json manifest
+bin_output_key = "tokenized/global_tokens"
+bin_output_base = f"s3://{bucket}/{bin_output_key}"
+SHARD_MB = 1024
 
-# Initialize doc_id properly before main()
-doc_id = 0
+BATCH_DOCS = 1024
+BATCH_CHARS = 8_000_000
 
+TOKENIZER_NAME = "hf-internal-testing/llama-tokenizer"
+_tokenizer = None
 
-def main():
-    global doc_id
-    current_doc_lines = []
-
-    with s3_open(input_path, 'r', encoding='utf-8') as fin, \
-         s3_open(output_path, 'w', encoding='utf-8') as fout:
-
-        for line in fin:
-            line = line.strip()
-            if not line:
-                continue
-
-            if line == "[DOC_START]":
-                # Emit previous doc if exists
-                if current_doc_lines:
-                    emit_doc(current_doc_lines, fout)
-                    current_doc_lines = []
-                continue
 
-            if line.startswith("URL:"):
-                continue  # Skip metadata during tokenization, or keep if required.
+def get_tokenizer():
+    """
+    LLaMA tokenizer, loaded on first use so that main() sets the thread
+    pool environment (TOKENIZERS_PARALLELISM, RAYON_NUM_THREADS) before it.
+    """
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = LlamaTokenizerFast.from_pretrained(TOKENIZER_NAME)
+    return _tokenizer
 
-            current_doc_lines.append(line)
-
-        # Emit last doc if any
-        if current_doc_lines:
-            emit_doc(current_doc_lines, fout)
-
-    print(f"✅ Tokenization complete: s3://{bucket}/{output_key}")
-
-    log_path = "s3://my-cc-pipeline-s3/logs/tokenized_log.txt"
-    with s3_open(log_path, 'w', encoding='utf-8') as log_file:
-        log_file.write(f"{output_key} | Total documents tokenized: {doc_id}\n")
 
+def iter_doc_texts(fin):
+    """
+    Content of each [DOC_START] document as one space-joined text; URL:
+    metadata lines are skipped.
+    """
+    current_doc_lines = []
+    for line in fin:
+        line = line.strip()
+        if not line:
+            continue
+
+        if line == "[DOC_START]":
+            # Emit previous doc if exists
+            if current_doc_lines:
+                yield " ".join(current_doc_lines)
+                current_doc_lines = []
+            continue
+
+        if line.startswith("URL:"):
+            continue  # Skip metadata during tokenization, or keep if required.
+
+        current_doc_lines.append(line)
+
+    # Emit last doc if any
+    if current_doc_lines:
+        yield " ".join(current_doc_lines)
+
+
+def batched_texts(texts, batch_docs=BATCH_DOCS, batch_chars=BATCH_CHARS):
+    """
+    Groups texts into lists of at most `batch_docs` documents and about
+    `batch_chars` characters (a longer document is a batch of its own).
+    """
+    batch = []
+    chars = 0
+    for text in texts:
+        if batch and (len(batch) >= batch_docs or chars + len(text) > batch_chars):
+            yield batch
+            batch = []
+            chars = 0
+        batch.append(text)
+        chars += len(text)
+    if batch:
+        yield batch
+
+
+def encode_batch(texts):
+    """
+    Token ids of each text, as `tokenizer.encode(text, add_special_tokens=False)`.
+    """
+    tokenizer = get_tokenizer()
+    encoded = tokenizer(texts, add_special_tokens=False,
+                        return_attention_mask=False, return_token_type_ids=False)
+    return encoded["input_ids"]
+
+
+def tokenize_docs(fin, metrics, batch_docs=BATCH_DOCS, batch_chars=BATCH_CHARS):
+    """
+    Yields (doc_id, tokens) per document, with sequential doc ids;
+    `metrics` is filled in once the generator is exhausted.
+    """
+    doc_id = 0
+    token_count = 0
+    batches = 0
+    encode_s = 0.0
+    started = time.perf_counter()
+    for batch in batched_texts(iter_doc_texts(fin), batch_docs, batch_chars):
+        encode_start = time.perf_counter()
+        batch_tokens = encode_batch(batch)
+        encode_s += time.perf_counter() - encode_start
+        batches += 1
+        for tokens in batch_tokens:
+            yield doc_id, tokens
+            doc_id += 1
+            token_count += len(tokens)
+
+    elapsed = time.perf_counter() - started
+    metrics.records = doc_id
+    metrics.update(documents=doc_id, tokens=token_count, batches=batches)
+    metrics.extra.update({
+        "batch_docs": batch_docs,
+        "batch_chars": batch_chars,
+        "encode_s": round(encode_s, 3),
+        "docs_per_sec": round(doc_id / elapsed, 2) if elapsed > 0 else None,
+        "tokens_per_sec": round(token_count / elapsed, 2) if elapsed > 0 else None,
+        "encode_tokens_per_sec": round(token_count / encode_s, 2) if encode_s > 0 else None,
+    })
+
+
+def tokenize_lines(fin, metrics, batch_docs=BATCH_DOCS, batch_chars=BATCH_CHARS):
+    """
+    Yields one JSON record line per document (the JSONL output format).
+    """
+    for doc_id, tokens in tokenize_docs(fin, metrics, batch_docs, batch_chars):
+        record = {
+            "id": doc_id,
+            "tokens": tokens
+        }
+        yield json.dumps(record) + "\n"
+
+
+def token_shard_writer(shard_mb=SHARD_MB):
+    """
+    Writer for the binary output, with the smallest dtype for the vocabulary.
+    """
+    return TokenShardWriter(bin_output_base, dtype_for_vocab(len(get_tokenizer())), shard_mb * 1024 * 1024)
+
+
+def record_shards(metrics, writer):
+    metrics.bytes_out = writer.bytes_written
+    metrics.extra.update({
+        "output_format": "bin",
+        "dtype": writer.dtype.name,
+        "shards": len(writer.shards),
+    })
 
-def emit_doc(doc_lines, fout):
-    global doc_id
-    text = " ".join(doc_lines)
-    tokens = tokenizer.encode(text, add_special_tokens=False)
 
-    record = {
-        "id": doc_id,
-        "tokens": tokens
-    }
-    fout.write(json.dumps(record) + "\n")
-    doc_id += 1
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_docs", type=int, default=BATCH_DOCS,
+                        help="Maximum documents per tokenizer batch")
+    parser.add_argument("--batch_chars", type=int, default=BATCH_CHARS,
+                        help="Approximate maximum characters per tokenizer batch")
+    parser.add_argument("--threads", type=int, default=available_cpus(),
+                        help="Tokenizer threads per batch (RAYON_NUM_THREADS)")
+    parser.add_argument("--output_format", choices=["jsonl", "bin"], default="jsonl",
+                        help="JSON lines, or binary token shards with offset indexes")
+    parser.add_argument("--shard_mb", type=int, default=SHARD_MB,
+                        help="Target size of each binary token shard")
+    args = parser.parse_args()
+
+    # Read by the tokenizers thread pool, so set before the tokenizer loads
+    os.environ["TOKENIZERS_PARALLELISM"] = "true"
+    os.environ["RAYON_NUM_THREADS"] = str(max(1, args.threads))
+
+    metrics = StageMetrics("tokenize", input_key)
+    metrics.extra["threads"] = args.threads
+
+    if args.output_format == "bin":
+        with s3_open(input_path, 'r', encoding='utf-8') as fin, token_shard_writer(args.shard_mb) as writer:
+            for _, tokens in tokenize_docs(fin, metrics, args.batch_docs, args.batch_chars):
+                writer.write_document(tokens)
+        record_shards(metrics, writer)
+        print(f"✅ Tokenization complete: {bin_output_base}.json ({len(writer.shards)} {writer.dtype.name} shards)")
+    else:
+        with s3_open(input_path, 'r', encoding='utf-8') as fin, \
+             s3_open(output_path, 'w', encoding='utf-8') as fout:
+            for line in tokenize_lines(fin, metrics, args.batch_docs, args.batch_chars):
+                fout.write(line)
+        print(f"✅ Tokenization complete: s3://{bucket}/{output_key}")
+
+    print(f"📊 {metrics.counts['documents']} docs, {metrics.counts['tokens']} tokens in "
+          f"{metrics.counts['batches']} batches: {metrics.extra['docs_per_sec']} docs/sec, "
+          f"{metrics.extra['tokens_per_sec']} tokens/sec")
+    metrics.write()
 
 
 if __name__ == "__main__":